@@ -17,17 +17,39 @@
 # limitations under the License.
 ##############################################################################
 
+import time
+_start_time = time.time()
+
 import sys
-from clang import cindex
-from clang.cindex import CursorKind as ck
-from clang.cindex import TypeKind as tk
-from IPython import embed
 from clike import *
+import clike
 import click
 import os
-from collections import namedtuple
-
-CleanupInfo = namedtuple('CleanupInfo', ['expression', 'label'])
+import hashlib
+import json
+import tempfile
+import shutil
+import re
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+
+# libclang is only loaded once there is a header to parse, see _load_clang()
+cindex = ck = tk = None
+
+def _load_clang():
+    global cindex, ck, tk
+    if cindex is None:
+        from clang import cindex
+        from clang.cindex import CursorKind as ck
+        from clang.cindex import TypeKind as tk
+        _numeric_kinds[:] = [tk.INT, tk.ENUM, tk.LONG, tk.LONGLONG]
+        _num_type_to_unpack_fmt.update({tk.LONGLONG : 'I',
+                                        tk.LONG : 'I',
+                                        tk.INT : 'i',
+                                        tk.ENUM : 'i'})
+
+GeneratorOptions = namedtuple('GeneratorOptions', ['backends', 'key_dispatch', 'alloc', 'instrument', 'parallel',
+                                                   'mode'])
 
 class CantSerializeUnion(Exception):
     pass
@@ -53,6 +75,9 @@ class CantParseField(Exception):
 class CantParse(Exception):
     pass
 
+class CantBorrowField(Exception):
+    pass
+
 def _is_struct_jsonable(sd):
     for field in sd.get_children():
         if field.kind != ck.FIELD_DECL:
@@ -84,6 +109,22 @@ def _is_static_string(t):
     return (t.kind == tk.CONSTANTARRAY and
     t.get_array_element_type().kind == tk.CHAR_S)
 
+def _is_record_static_array(t):
+    return (t.kind == tk.CONSTANTARRAY and
+            t.get_array_element_type().get_canonical().kind == tk.RECORD)
+
+def _is_numeric_static_array(t):
+    return (t.kind == tk.CONSTANTARRAY and
+            t.get_array_element_type().get_canonical().kind in _numeric_kinds)
+
+def _array_record_declaration(t):
+    return t.get_array_element_type().get_canonical().get_declaration()
+
+def _needs_integer_value(fields):
+    return any(f.type.get_canonical().kind in _numeric_kinds or _is_numeric_static_array(f.type.get_canonical()) or
+               (_count_field(f) and _counted_element(f).kind in _numeric_kinds)
+               for f in fields)
+
 def _is_var_string(t):
     t = t.get_canonical()
     if t.kind != tk.POINTER:
@@ -91,19 +132,53 @@ def _is_var_string(t):
 
     return t.get_pointee().kind == tk.CHAR_S
 
+def _referenced_records(sd):
+    """The JSONABLE structs sd holds, by value, in arrays or in var arrays"""
+    for f in sd.get_children():
+        if f.kind != ck.FIELD_DECL:
+            continue
+
+        t = f.type.get_canonical()
+        if t.kind == tk.RECORD:
+            record = t.get_declaration()
+        elif _is_record_static_array(t):
+            record = _array_record_declaration(t)
+        elif _is_var_array(t):
+            record = t.get_pointee().get_pointee().get_declaration()
+        else:
+            continue
+
+        if _is_struct_jsonable(record):
+            yield record
+
 def _get_jsonable_structs(root, h_file):
-    jsonables = {}
+    """The JSONABLE structs defined in the main file and those they reference, in that order.
+
+    Only the cursors of the main file are visited, with an explicit stack:
+    the system headers it includes can hold many thousands of declarations
+    that are of no interest, and deep nesting must not hit the recursion
+    limit. Structs from other headers are then reached through the fields
+    that hold them.
+    """
+    jsonables = OrderedDict()
     filename = root.translation_unit.spelling
-    def aux(node):
-        if _is_struct_jsonable(node):
+    pending = [node for node in reversed(list(root.get_children()))
+               if node.location.file is not None and node.location.file.name == filename]
+    while pending:
+        node = pending.pop()
+        if node.kind == ck.STRUCT_DECL and node.spelling not in jsonables and _is_struct_jsonable(node):
             jsonables[node.spelling] = node
 
-        for node in node.get_children():
-            aux(node)
+        pending.extend(reversed(list(node.get_children())))
 
-        return jsonables
+    referenced = list(jsonables.itervalues())
+    while referenced:
+        for record in _referenced_records(referenced.pop()):
+            if record.spelling not in jsonables:
+                jsonables[record.spelling] = record
+                referenced.append(record)
 
-    return aux(root)
+    return jsonables
 
 
 def _validate_struct_decl(sd):
@@ -132,11 +207,277 @@ def struct_parser_function_name(sd):
     _validate_struct_decl(sd)
     return '{0}_from_json'.format(sd.spelling)
 
+def struct_reuse_parser_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_from_json_reuse'.format(sd.spelling)
+
+def struct_writer_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_write_json'.format(sd.spelling)
+
+def struct_parallel_writer_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_write_json_parallel'.format(sd.spelling)
+
+def struct_stream_parser_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_parse_json'.format(sd.spelling)
+
+def struct_lexer_parser_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_parse_json_lexer'.format(sd.spelling)
+
+def struct_array_writer_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_write_json_array'.format(sd.spelling)
+
+def struct_lines_writer_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_write_json_lines'.format(sd.spelling)
+
+def struct_lines_parser_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_parse_json_lines'.format(sd.spelling)
+
+def struct_push_parser_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_parser'.format(sd.spelling)
+
+def struct_push_handler_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_push_event'.format(sd.spelling)
+
+def struct_json_size_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_json_size'.format(sd.spelling)
+
+def struct_msgpack_writer_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_to_msgpack'.format(sd.spelling)
+
+def struct_msgpack_parser_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_from_msgpack'.format(sd.spelling)
+
+def struct_msgpack_reader_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_from_msgpack_reader'.format(sd.spelling)
+
+def struct_equal_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_equal'.format(sd.spelling)
+
+def struct_diff_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_diff_to_json'.format(sd.spelling)
+
+def struct_patch_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_patch_from_json'.format(sd.spelling)
+
+def struct_projection_parser_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_from_json_fields'.format(sd.spelling)
+
+def struct_path_index_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_path_index'.format(sd.spelling)
+
+def struct_path_enum_value(sd, path):
+    sd = sd.type.get_canonical().get_declaration()
+    if path is None:
+        return '{0}_PATHS'.format(sd.spelling.upper())
+    return '{0}_PATH_{1}'.format(sd.spelling.upper(), '__'.join(path))
+
+def struct_dtype_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_DTYPE'.format(sd.spelling.upper())
+
+def struct_numpy_lines_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_to_json_lines'.format(sd.spelling)
+
+def struct_descriptor_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_descriptor'.format(sd.spelling)
+
+def struct_stats_name(sd):
+    return '{0}_stats'.format(sd.spelling)
+
+def struct_field_index_function_name(sd):
+    sd = sd.type.get_canonical().get_declaration()
+    _validate_struct_decl(sd)
+    return '{0}_field_index'.format(sd.spelling)
+
+def struct_field_enum_value(sd, f):
+    sd = sd.type.get_canonical().get_declaration()
+    if f is None:
+        return '{0}_FIELDS'.format(sd.spelling.upper())
+    return '{0}_FIELD_{1}'.format(sd.spelling.upper(), f.displayname)
+
+_annotation_flags = set(['noserialize', 'borrow', 'trusted'])
+_annotation_keys = set(['len', 'count', 'cap'])
+
+def _annotations(cursor):
+    """The cautojson annotations in a field's ///< comment or a struct's /// comment.
+
+    An annotation comment is a list of flags and key=value pairs, e.g.
+    ///< borrow len=name_len. Comments with any other words are plain
+    documentation and carry no annotations.
+    """
+    annotations = {}
+    for word in (cursor.brief_comment or '').split():
+        key, _, value = word.partition('=')
+        if (value and key not in _annotation_keys) or (not value and key not in _annotation_flags):
+            return {}
+        annotations[key] = value or True
+
+    return annotations
+
+def _is_borrowed(f):
+    """char * fields that point into the parsed input instead of owning a copy"""
+    if not _is_var_string(f.type.get_canonical()):
+        return False
+
+    return 'borrow' in _annotations(f) or 'borrow' in _annotations(f.semantic_parent)
+
+def _is_trusted(f):
+    """Strings the application already validated as UTF-8, which jansson needn't check again"""
+    return 'trusted' in _annotations(f) or 'trusted' in _annotations(f.semantic_parent)
+
+# Per struct of the translation unit being generated, by USR: the type kind of each field and
+# the fields that only describe a sibling. Annotations are checked against them for every field
+# by some 20 generators, which mustn't rescan the struct each time on headers with huge structs.
+_field_kinds = {}
+_companion_fields = {}
+
+def _kinds(s):
+    """The canonical type kind of every field of struct s, by name"""
+    usr = s.get_usr()
+    if usr not in _field_kinds:
+        _field_kinds[usr] = dict((f.spelling, f.type.get_canonical().kind)
+                                 for f in s.get_children() if f.kind == ck.FIELD_DECL)
+
+    return _field_kinds[usr]
+
+def _size_field(f, name, annotation, exception = CantSerializeField):
+    """The sibling of f named by its annotation=, which must be a size_t: parsers store it through a size_t *"""
+    if _kinds(f.semantic_parent).get(name) not in (tk.ULONG, tk.ULONGLONG):
+        raise exception('{0}.{1}: {2}= needs a size_t field'.format(f.semantic_parent.spelling, f.spelling,
+                                                                   annotation))
+
+    return name
+
+def _length_field(f):
+    """The name of the field holding the length of a borrowed string, if any"""
+    if not _is_borrowed(f):
+        return None
+
+    length_field = _annotations(f).get('len')
+    if length_field is None:
+        return None
+
+    return _size_field(f, length_field, 'len', CantBorrowField)
+
+def _borrow_length_field(f):
+    """Like _length_field, for backends that can't borrow without a length"""
+    length_field = _length_field(f)
+    if _is_borrowed(f) and length_field is None:
+        raise CantBorrowField('{0}.{1}: borrowing from JSON text or MessagePack needs a len= field'.format(
+            f.semantic_parent.spelling, f.spelling))
+
+    return length_field
+
+def _count_field(f):
+    """The name of the field holding the number of elements of a counted array, if f is one"""
+    if f.type.get_canonical().kind != tk.POINTER:
+        return None
+
+    return _annotations(f).get('count')
+
+def _counted_element(f):
+    """The type of the elements of counted array f: a JSONABLE struct or an integer"""
+    t = f.type.get_canonical().get_pointee().get_canonical()
+    if t.kind in _numeric_kinds or (t.kind == tk.RECORD and _is_struct_jsonable(t.get_declaration())):
+        return t
+
+    raise CantSerializeField('{0}.{1}: count= needs a pointer to a JSONABLE struct or an integer'.format(
+        f.semantic_parent.spelling, f.spelling))
+
+def _capacity_field(f):
+    """The name of the size_t field holding how many elements f has room for, if any
+
+    Owned strings, var arrays and counted arrays can be annotated with
+    cap=, which the _from_json_reuse parsers keep up to date so that they
+    know when a buffer is big enough without asking the allocator.
+    """
+    capacity_field = _annotations(f).get('cap')
+    if capacity_field is None:
+        return None
+
+    ct = f.type.get_canonical()
+    if not ((_is_var_string(ct) and not _is_borrowed(f)) or _is_var_array(ct) or _count_field(f)):
+        raise CantSerializeField('{0}.{1}: cap= needs an owned string, a var array or a counted array'.format(
+            f.semantic_parent.spelling, f.spelling))
+
+    return _size_field(f, capacity_field, 'cap')
+
+def _companions(s):
+    """The names of the fields of s that only describe a sibling: len=, count= and cap= fields"""
+    usr = s.get_usr()
+    if usr not in _companion_fields:
+        _companion_fields[usr] = frozenset(companion
+                                           for f in s.get_children() if f.kind == ck.FIELD_DECL
+                                           for companion in (_length_field(f), _count_field(f), _capacity_field(f))
+                                           if companion)
+
+    return _companion_fields[usr]
+
 def _ignore_field(f):
-    if f.brief_comment == 'noserialize' or f.spelling == '__jsonable':
+    if 'noserialize' in _annotations(f) or f.spelling == '__jsonable':
         return True
-    else:
-        return False
+
+    # The length of a borrowed string travels with the string itself, a count with its array,
+    # and a capacity only matters to the memory behind it
+    return f.spelling in _companions(f.semantic_parent)
+
+def _string_length(f, string):
+    length_field = _length_field(f)
+    if length_field is None:
+        return 'strlen({0})'.format(string)
+    return 'this->{0}'.format(length_field)
+
+def _serialized_fields(s):
+    fields = [f
+              for f in s.get_children()
+              if f.kind == ck.FIELD_DECL and not _ignore_field(f)]
+    for f in fields:
+        if _count_field(f):
+            _counted_element(f)
+
+    return fields
 
 def _serialize_record_array(s, sd, full_field_name, loop_fmt, lvalue_modifier, mod):
     BLOCK = mod.block
@@ -144,7 +485,6 @@ def _serialize_record_array(s, sd, full_field_name, loop_fmt, lvalue_modifier, m
     array_name = _mangle_ptr(full_field_name) + "_array"
     STMT('json_t *{0} = json_array()'.format(array_name))
     struct_serializer_func = struct_serializer_function_name(sd.get_declaration())
-    loop_fmt = 'if (NULL != {0}) ' + loop_fmt
     with BLOCK(loop_fmt.format(full_field_name)):
         STMT('json_array_append_new({0}, {1}({2}{3}[i]))'.format(array_name,
                                                              struct_serializer_func,
@@ -154,28 +494,50 @@ def _serialize_record_array(s, sd, full_field_name, loop_fmt, lvalue_modifier, m
     return array_name
 
 def _serialize_string(s, ct, full_field_name, mod):
-    return "json_string({0})".format(full_field_name)
+    return "json_string{0}({1})".format('_nocheck' if _is_trusted(s) else '', full_field_name)
 
 def _serialize_record_static_array(s, ct, full_field_name, mod):
     loop_fmt = 'for (int i = 0; i < sizeof({0}) / sizeof({0}[0]); i++)'
     return _serialize_record_array(s, ct.get_array_element_type().get_canonical(), full_field_name, loop_fmt, '&', mod)
 
 def _serialize_record_var_array(s, ct, full_field_name, mod):
-    loop_fmt = 'for (int i = 0; {0}[i] != 0; i++)'
+    loop_fmt = 'if (NULL != {0}) for (int i = 0; {0}[i] != 0; i++)'
     return _serialize_record_array(s, ct.get_pointee().get_pointee(), full_field_name, loop_fmt, '', mod)
 
 
-def _handle_array_serialization(s, ct, full_field_name, mod):
-    element_type_kind = ct.get_array_element_type().kind
-    if not element_type_kind in [tk.CHAR_S, tk.RECORD]:
-        raise CantSerializeConstantArray(s.displayname)
+def _serialize_counted_array(s, full_field_name, mod):
+    element = _counted_element(s)
+    array_name = _mangle_ptr(full_field_name) + "_array"
+    mod.stmt('json_t *{0} = json_array()'.format(array_name))
+    if element.kind == tk.RECORD:
+        value = '{0}(&{1}[i])'.format(struct_serializer_function_name(element.get_declaration()), full_field_name)
+    else:
+        value = 'json_integer({0}[i])'.format(full_field_name)
+    with mod.block('if (NULL != {0}) for (size_t i = 0; i < this->{1}; i++)'.format(full_field_name, _count_field(s))):
+        mod.stmt('json_array_append_new({0}, {1})'.format(array_name, value))
+
+    return array_name
+
+def _serialize_numeric_static_array(s, ct, full_field_name, mod):
+    array_name = _mangle_ptr(full_field_name) + "_array"
+    mod.stmt('json_t *{0} = json_array()'.format(array_name))
+    with mod.block('for (int i = 0; i < sizeof({0}) / sizeof({0}[0]); i++)'.format(full_field_name)):
+        mod.stmt('json_array_append_new({0}, json_integer({1}[i]))'.format(array_name, full_field_name))
+
+    return array_name
 
-    if element_type_kind == tk.RECORD:
-        raise NotImplemented()
-    elif element_type_kind == tk.CHAR_S:
+def _handle_array_serialization(s, ct, full_field_name, mod):
+    if _is_record_static_array(ct):
+        return _serialize_record_static_array(s, ct, full_field_name, mod)
+    elif _is_numeric_static_array(ct):
+        return _serialize_numeric_static_array(s, ct, full_field_name, mod)
+    elif _is_static_string(ct):
         return _serialize_string(s, ct, full_field_name, mod)
 
-_numeric_kinds = [tk.INT, tk.ENUM, tk.LONG, tk.LONGLONG]
+    raise CantSerializeConstantArray(s.displayname)
+
+# TypeKind tables, filled in by _load_clang()
+_numeric_kinds = []
 def recursively__generate_serializer(s, mod):
     BLOCK = mod.block
     STMT = mod.stmt
@@ -195,35 +557,322 @@ def recursively__generate_serializer(s, mod):
 
         STMT("return obj")
 
+    if s.kind == ck.FIELD_DECL:
+        # obj takes over the value's reference; member names are C identifiers, no need to check they are UTF-8
+        STMT('json_object_set_new_nocheck(obj, "{0}", {1})', s.displayname, _serialize_field(s, mod))
+
+def _serialize_field(s, mod):
+    """Emits whatever the field needs and returns the expression of its new json_t"""
+    ct = s.type.get_canonical()
+    full_field_name = "this->{0}".format(s.spelling)
+    if ct.kind == tk.RECORD:
+        sd = ct.get_declaration()
+        return '{0}(&{1})'.format(struct_serializer_function_name(sd), full_field_name)
+    elif ct.kind in _numeric_kinds:
+        return "json_integer({0})".format(full_field_name)
+    elif ct.kind == tk.CONSTANTARRAY:
+        return _handle_array_serialization(s, ct, full_field_name, mod)
+    elif _is_var_array(ct):
+        return _serialize_record_var_array(s, ct, full_field_name, mod)
+    elif _count_field(s):
+        return _serialize_counted_array(s, full_field_name, mod)
+    elif _is_var_string(ct) and _length_field(s):
+        return 'json_stringn{0}({1}, {2})'.format('_nocheck' if _is_trusted(s) else '', full_field_name,
+                                                  _string_length(s, full_field_name))
+    elif _is_var_string(ct):
+        return _serialize_string(s, ct, full_field_name, mod)
+
+    raise CantSerializeField(s.displayname, ct.kind)
+
+class _BufWriter(object):
+    """Emits code that writes into a struct autojson_buf.
+
+    Constant bytes are accumulated and written with a single
+    autojson_buf_put() call per run.
+    """
+    def __init__(self, mod):
+        self.mod = mod
+        self.pending = ''
+
+    def flush(self):
+        if self.pending:
+            self.mod.stmt('autojson_buf_put(buf, {0}, {1})'.format(_c_string_literal(self.pending),
+                                                                 len(self.pending)))
+        self.pending = ''
+
+    def literal(self, text):
+        self.pending += text
+
+    def stmt(self, *args, **kwargs):
+        self.flush()
+        self.mod.stmt(*args, **kwargs)
+
+    @contextmanager
+    def block(self, *args, **kwargs):
+        self.flush()
+        with self.mod.block(*args, **kwargs) as blk:
+            yield blk
+            self.flush()
+
+class _JsonWriter(_BufWriter):
+    """Prints JSON text, the constant text being braces, quoted keys and separators"""
+    def __init__(self, mod):
+        super(_JsonWriter, self).__init__(mod)
+        self.state = 'none'
+
+    def key(self, name, optional = False):
+        text = '"{0}":'.format(name)
+        if self.state == 'unknown':
+            self.stmt("if (sep) autojson_buf_putc(buf, ',')")
+            self.literal(text)
+        elif self.state == 'some':
+            self.literal(',' + text)
+        else:
+            self.literal(text)
+
+        if not optional:
+            self.state = 'some'
+        elif self.state != 'some':
+            self.stmt('sep = 1')
+            self.state = 'unknown'
+
+def recursively__generate_writer(s, out, parallel = False):
+    """parallel writes the lists of s through autojson_write_parallel() and the pool"""
+    if s.kind == ck.STRUCT_DECL:
+        fields = _serialized_fields(s)
+        if fields and _is_var_string(fields[0].type.get_canonical()):
+            out.stmt('int sep = 0')
+
+        out.literal('{')
+        for f in fields:
+            recursively__generate_writer(f, out, parallel)
+
+        out.literal('}')
+        out.stmt('return buf->error ? -1 : 0')
+
     if s.kind == ck.FIELD_DECL:
         ct = s.type.get_canonical()
         full_field_name = "this->{0}".format(s.spelling)
+        if _is_var_string(ct):
+            # json_string(NULL) makes jansson drop the key, so do we
+            with out.block('if (NULL != {0})'.format(full_field_name)):
+                out.key(s.displayname, optional = True)
+                if _length_field(s):
+                    out.stmt('autojson_buf_put_stringn(buf, {0}, {1})'.format(full_field_name,
+                                                                              _string_length(s, full_field_name)))
+                else:
+                    out.stmt('autojson_buf_put_string(buf, {0})'.format(full_field_name))
+            return
+
+        out.key(s.displayname)
         if ct.kind == tk.RECORD:
             sd = ct.get_declaration()
-            field_value = '{0}(&{1})'.format(struct_serializer_function_name(sd), full_field_name)
+            out.stmt('{0}(&{1}, buf)'.format(struct_writer_function_name(sd), full_field_name))
         elif ct.kind in _numeric_kinds:
-            field_value = "json_integer({0})".format(full_field_name)
+            out.stmt('autojson_buf_put_integer(buf, {0})'.format(full_field_name))
+        elif _is_record_static_array(ct):
+            out.literal('[')
+            with out.block('for (int i = 0; i < {0}; i++)'.format(ct.get_array_size())):
+                out.stmt("if (0 != i) autojson_buf_putc(buf, ',')")
+                out.stmt('{0}(&{1}[i], buf)'.format(struct_writer_function_name(_array_record_declaration(ct)),
+                                                    full_field_name))
+            out.literal(']')
+        elif _is_numeric_static_array(ct):
+            # Room for every element up front, so each one takes the fast path
+            out.stmt('autojson_buf_reserve(buf, {0})'.format(ct.get_array_size() * 21 + 1))
+            out.literal('[')
+            with out.block('for (int i = 0; i < {0}; i++)'.format(ct.get_array_size())):
+                out.stmt("if (0 != i) autojson_buf_putc(buf, ',')")
+                out.stmt('autojson_buf_put_integer(buf, {0}[i])'.format(full_field_name))
+            out.literal(']')
+        elif _is_static_string(ct):
+            out.stmt('autojson_buf_put_stringn(buf, {0}, strnlen({0}, sizeof({0})))'.format(full_field_name))
         elif ct.kind == tk.CONSTANTARRAY:
-            field_value = _handle_array_serialization(s, ct, full_field_name, mod)
+            raise CantSerializeConstantArray(s.displayname)
+        elif _count_field(s):
+            element = _counted_element(s)
+            count = 'this->{0}'.format(_count_field(s))
+            if element.kind == tk.RECORD:
+                value = '{0}(&{1}[i], buf)'.format(struct_writer_function_name(element.get_declaration()),
+                                                   full_field_name)
+            else:
+                # The count tells how much room the integers need up front
+                out.stmt('autojson_buf_reserve(buf, {0} * 21 + 1)'.format(count))
+                value = 'autojson_buf_put_integer(buf, {0}[i])'.format(full_field_name)
+            out.literal('[')
+            with out.block('if (NULL != {0}) for (size_t i = 0; i < {1}; i++)'.format(full_field_name, count)):
+                out.stmt("if (0 != i) autojson_buf_putc(buf, ',')")
+                out.stmt(value)
+            out.literal(']')
+        elif _is_var_array(ct) and parallel:
+            out.literal('[')
+            out.stmt('autojson_write_parallel(pool, buf, (const void *const *) {0}, {1})'.format(
+                full_field_name, _parallel_item_writer_name(s)))
+            out.literal(']')
         elif _is_var_array(ct):
-            field_value = _serialize_record_var_array(s, ct, full_field_name, mod)
-        elif _is_var_string(ct):
-            field_value = _serialize_string(s, ct, full_field_name, mod)
+            sd = ct.get_pointee().get_pointee().get_declaration()
+            out.literal('[')
+            with out.block('if (NULL != {0}) for (int i = 0; {0}[i] != 0; i++)'.format(full_field_name)):
+                out.stmt("if (0 != i) autojson_buf_putc(buf, ',')")
+                out.stmt('{0}({1}[i], buf)'.format(struct_writer_function_name(sd), full_field_name))
+            out.literal(']')
         else:
             raise CantSerializeField(s.displayname, ct.kind)
 
-        STMT('json_object_set(obj, "{0}", {1})', s.displayname, field_value)
+def recursively__generate_json_size(s, mod):
+    """Sums up what recursively__generate_writer() writes for s, byte for byte"""
+    STMT = mod.stmt
+    if s.kind == ck.STRUCT_DECL:
+        fields = _serialized_fields(s)
+        optional = [f for f in fields if _is_var_string(f.type.get_canonical())]
+        constant = 2 + sum(len('"{0}":'.format(f.displayname)) for f in fields if f not in optional)
+        if optional:
+            STMT('size_t size = {0}'.format(constant))
+            STMT('size_t members = {0}'.format(len(fields) - len(optional)))
+        else:
+            STMT('size_t size = {0}'.format(constant + max(len(fields) - 1, 0)))
+
+        for f in fields:
+            recursively__generate_json_size(f, mod)
+
+        if optional:
+            STMT('if (members) size += members - 1')
+        STMT('return size')
+
+    if s.kind == ck.FIELD_DECL:
+        ct = s.type.get_canonical()
+        full_field_name = "this->{0}".format(s.spelling)
+        if _is_var_string(ct):
+            key_size = len('"{0}":'.format(s.displayname))
+            STMT('if (NULL != {0}) {{ members++; size += {1} + autojson_string_json_size({0}, {2}); }}'.format(
+                full_field_name, key_size, _string_length(s, full_field_name)), suffix = '')
+        elif ct.kind == tk.RECORD:
+            sd = ct.get_declaration()
+            STMT('size += {0}(&{1})'.format(struct_json_size_function_name(sd), full_field_name))
+        elif ct.kind in _numeric_kinds:
+            STMT('size += autojson_integer_json_size({0})'.format(full_field_name))
+        elif _is_record_static_array(ct) or _is_numeric_static_array(ct):
+            length = ct.get_array_size()
+            STMT('size += {0}'.format(2 + max(length - 1, 0)))
+            if _is_record_static_array(ct):
+                element_size = '{0}(&{1}[i])'.format(struct_json_size_function_name(_array_record_declaration(ct)),
+                                                     full_field_name)
+            else:
+                element_size = 'autojson_integer_json_size({0}[i])'.format(full_field_name)
+            STMT('for (int i = 0; i < {0}; i++) size += {1}'.format(length, element_size))
+        elif _is_static_string(ct):
+            STMT('size += autojson_string_json_size({0}, strnlen({0}, sizeof({0})))'.format(full_field_name))
+        elif ct.kind == tk.CONSTANTARRAY:
+            raise CantSerializeConstantArray(s.displayname)
+        elif _count_field(s):
+            element = _counted_element(s)
+            if element.kind == tk.RECORD:
+                element_size = '{0}(&{1}[i])'.format(struct_json_size_function_name(element.get_declaration()),
+                                                     full_field_name)
+            else:
+                element_size = 'autojson_integer_json_size({0}[i])'.format(full_field_name)
+            STMT('size += 2')
+            with mod.block('if (NULL != {0}) for (size_t i = 0; i < this->{1}; i++)'.format(full_field_name,
+                                                                                       _count_field(s))):
+                STMT('size += (0 != i) + {0}'.format(element_size))
+        elif _is_var_array(ct):
+            sd = ct.get_pointee().get_pointee().get_declaration()
+            STMT('size += 2')
+            with mod.block('if (NULL != {0}) for (int i = 0; {0}[i] != 0; i++)'.format(full_field_name)):
+                STMT('size += (0 != i) + {0}({1}[i])'.format(struct_json_size_function_name(sd), full_field_name))
+        else:
+            raise CantSerializeField(s.displayname, ct.kind)
+
+def _msgpack_header(n, fix, fix_limit, tags):
+    """The shortest MessagePack header for a container or string of n elements"""
+    if n < fix_limit:
+        return chr(fix | n)
+    for tag, size in tags:
+        if n < 1 << (8 * size):
+            return chr(tag) + ''.join(chr((n >> (8 * i)) & 0xff) for i in reversed(range(size)))
+    raise ValueError(n)
+
+def _msgpack_map_header(n):
+    return _msgpack_header(n, 0x80, 16, [(0xde, 2), (0xdf, 4)])
+
+def _msgpack_str(s):
+    return _msgpack_header(len(s), 0xa0, 32, [(0xd9, 1), (0xda, 2), (0xdb, 4)]) + s
+
+def recursively__generate_msgpack_writer(s, out):
+    if s.kind == ck.STRUCT_DECL:
+        fields = _serialized_fields(s)
+        out.literal(_msgpack_map_header(len(fields)))
+        for f in fields:
+            recursively__generate_msgpack_writer(f, out)
+
+        out.stmt('return buf->error ? -1 : 0')
+
+    if s.kind == ck.FIELD_DECL:
+        ct = s.type.get_canonical()
+        full_field_name = "this->{0}".format(s.spelling)
+        out.literal(_msgpack_str(s.displayname))
+        if ct.kind == tk.RECORD:
+            sd = ct.get_declaration()
+            out.stmt('{0}(&{1}, buf)'.format(struct_msgpack_writer_function_name(sd), full_field_name))
+        elif ct.kind in _numeric_kinds:
+            out.stmt('autojson_buf_put_msgpack_integer(buf, {0})'.format(full_field_name))
+        elif _is_static_string(ct):
+            out.stmt('autojson_buf_put_msgpack_stringn(buf, {0}, strnlen({0}, sizeof({0})))'.format(full_field_name))
+        elif _is_var_string(ct) and _length_field(s):
+            out.stmt('if (NULL == {0}) autojson_buf_putc(buf, (char) 0xc0); '
+                     'else autojson_buf_put_msgpack_stringn(buf, {0}, {1})'.format(full_field_name,
+                                                                                  _string_length(s, full_field_name)))
+        elif _is_var_string(ct):
+            out.stmt('autojson_buf_put_msgpack_string(buf, {0})'.format(full_field_name))
+        elif _is_record_static_array(ct) or _is_numeric_static_array(ct):
+            length = ct.get_array_size()
+            out.literal(_msgpack_header(length, 0x90, 16, [(0xdc, 2), (0xdd, 4)]))
+            if _is_record_static_array(ct):
+                element = '{0}(&{1}[i], buf)'.format(struct_msgpack_writer_function_name(_array_record_declaration(ct)),
+                                                    full_field_name)
+            else:
+                element = 'autojson_buf_put_msgpack_integer(buf, {0}[i])'.format(full_field_name)
+            out.stmt('for (int i = 0; i < {0}; i++) {1}'.format(length, element))
+        elif ct.kind == tk.CONSTANTARRAY:
+            raise CantSerializeConstantArray(s.displayname)
+        elif _count_field(s):
+            element = _counted_element(s)
+            count = 'this->{0}'.format(_count_field(s))
+            if element.kind == tk.RECORD:
+                value = '{0}(&{1}[i], buf)'.format(struct_msgpack_writer_function_name(element.get_declaration()),
+                                                   full_field_name)
+            else:
+                value = 'autojson_buf_put_msgpack_integer(buf, {0}[i])'.format(full_field_name)
+            out.stmt('autojson_buf_put_msgpack_array(buf, NULL == {0} ? 0 : {1})'.format(full_field_name, count))
+            out.stmt('if (NULL != {0}) for (size_t i = 0; i < {1}; i++) {2}'.format(full_field_name, count, value))
+        elif _is_var_array(ct):
+            sd = ct.get_pointee().get_pointee().get_declaration()
+            count = '{0}_count'.format(s.spelling)
+            out.stmt('size_t {0} = 0'.format(count))
+            out.stmt('if (NULL != {0}) while (NULL != {0}[{1}]) {1}++'.format(full_field_name, count))
+            out.stmt('autojson_buf_put_msgpack_array(buf, {0})'.format(count))
+            out.stmt('for (size_t i = 0; i < {0}; i++) {1}({2}[i], buf)'.format(
+                count, struct_msgpack_writer_function_name(sd), full_field_name))
+        else:
+            raise CantSerializeField(s.displayname, ct.kind)
 
 def _quote(s):
     return '"{0}"'.format(s)
 
+def _c_string_literal(s):
+    def escape(c):
+        if c in '\\"':
+            return '\\' + c
+        if ' ' <= c <= '~':
+            return c
+        return '\\{0:03o}'.format(ord(c))
+
+    return _quote(''.join(escape(c) for c in s))
+
 def _normalize_typename(typename):
     typename = typename.replace('*', 'pointer')
     return typename.translate(None, ' []')
 
-def _normalize_labelname(var):
-    return var.replace('->', '_').replace('.', '_')
-
 def _mangle_ptr(ptr):
     if 'CRAZYBASTARD' in ptr or 'CRIMINALTRICKER' in ptr:
         raise CantManglePtr(ptr)
@@ -246,10 +895,7 @@ def recursively__generate_struct_parser(s, mod, out, unpack, add_ptr, add_array)
             recursively__generate_parser(f, mod, out, unpack, add_ptr, add_array)
         unpack("}")
 
-_num_type_to_unpack_fmt = {tk.LONGLONG : 'I',
-                     tk.LONG : 'I',
-                     tk.INT : 'i',
-                     tk.ENUM : 'i'}
+_num_type_to_unpack_fmt = {}
 def recursively__generate_field_parser(s, mod, out, unpack, add_ptr, add_array):
     STMT = mod.stmt
     BLOCK = mod.block
@@ -267,24 +913,23 @@ def recursively__generate_field_parser(s, mod, out, unpack, add_ptr, add_array):
         unpack(", ")
     elif ct.kind in _numeric_kinds:
         unpack("s:{0},".format(_num_type_to_unpack_fmt[ct.kind]), _quoted_field_name, ptr(full_field_name))
+    elif _is_borrowed(s):
+        length_field = _length_field(s)
+        if length_field is None:
+            unpack("s:s,", _quoted_field_name, ptr(full_field_name))
+        else:
+            unpack("s:s%,", _quoted_field_name, ptr(full_field_name), ptr(out + length_field))
     elif _is_var_string(ct) or _is_static_string(ct):
         is_var = _is_var_string(ct)
         tmp_ptr = _mangle_ptr(full_field_name)
         STMT('char *{0} = NULL'.format(tmp_ptr))
         add_ptr(tmp_ptr, ct.get_array_size(), is_var)
         unpack("s:s,", _quoted_field_name, ptr(tmp_ptr))
-    elif (ct.kind == tk.CONSTANTARRAY and
-          ct.get_array_element_type().get_canonical().kind == tk.RECORD):
-        raise NotImplemented()
-        # tmp_json_obj = _mangle_ptr(full_field_name)
-        # unpack("s:[{0}]", _quoted_field_name, ptr(tmp_json_obj))
-        # add_array(tmp_json_obj, ct)
-    elif _is_var_array(ct):
-        #raise NotImplemented()
+    elif _is_record_static_array(ct) or _is_numeric_static_array(ct) or _is_var_array(ct) or _count_field(s):
         tmp_json_obj = _mangle_ptr(full_field_name)
         STMT('json_t *{0} = NULL'.format(tmp_json_obj))
         unpack("s:o", _quoted_field_name, ptr(tmp_json_obj))
-        add_array(tmp_json_obj, ct)
+        add_array(tmp_json_obj, s)
     else:
         raise CantParseField(s.spelling)
 
@@ -298,144 +943,1761 @@ def recursively__generate_parser(s, mod, out, unpack, add_ptr, add_array):
 
     raise CantParse(s.spelling)
 
-def _safe_allocation(stmt, allocated_type, allocated_ptr, allocation_size, cleanups, create_local_var = True):
-    base_fmt = '{1} = ({0})malloc({2})'
-    if create_local_var:
-        fmt = '{0} ' + base_fmt
-    else:
-        fmt = base_fmt;
-    stmt(fmt.format(allocated_type, allocated_ptr, allocation_size))
-    if not cleanups:
-        goto_expr = 'goto exit'
-    else:
-        goto_expr = 'goto ' + cleanups[-1].label
-    stmt('if (NULL == {0}) {1}'.format(allocated_ptr, goto_expr))
-    cleanups.append(
-        CleanupInfo('free({0})'.format(allocated_ptr),
-                    _normalize_labelname(allocated_ptr + '_cleanup')))
-
-def _generate_cleanups(stmt, block, cleanups):
-    if not cleanups:
-        return
+def _count_allocation(options, allocation):
+    if options is not None and options.instrument:
+        return 'AUTOJSON_STATS_ALLOC({0})'.format(allocation)
+    return allocation
 
-    del cleanups[-1]
-    for cleanup in cleanups[::-1]:
-        stmt(cleanup.label + ':', suffix = '')
-        stmt(cleanup.expression)
+def _allocate(options, size):
+    if options.alloc == 'arena':
+        return _count_allocation(options, 'autojson_arena_alloc(arena, {0})'.format(size))
+    return _count_allocation(options, 'malloc({0})'.format(size))
 
-def _generate_var_array_parser(C_STMT, C_BLOCK, arrays, cleanups):
+def _duplicate_string(options, s):
+    if options.alloc == 'arena':
+        return _count_allocation(options, 'autojson_arena_strdup(arena, {0})'.format(s))
+    return _count_allocation(options, 'strdup({0})'.format(s))
+
+def _arena_parameter(options):
+    return ', struct autojson_arena *arena' if options.alloc == 'arena' else ''
+
+def _arena_argument(options):
+    return ', arena' if options.alloc == 'arena' else ''
+
+def _generate_var_array_parser(C_STMT, C_BLOCK, arrays, options):
+    """Fills struct X **list fields, leaving a list _free can release whatever element fails"""
+    arena = options.alloc == 'arena'
     for array_ptr, array_type in arrays:
-        array_ptr_size = array_ptr + '_size'
-        array_ptr_buffer = array_ptr + '_buffer'
-        struct_type = array_type.get_pointee().get_pointee().spelling
+        ptr = _demangle_ptr(array_ptr)
+        size = array_ptr + '_size'
+        buffer = array_ptr + '_buffer'
+        parsed = array_ptr + '_parsed'
         struct_decl = array_type.get_pointee().get_pointee().get_declaration()
         with C_BLOCK('if (!json_is_array({0}))'.format(array_ptr)):
-            C_STMT('return -1');
-
+            C_STMT('rc = -1')
+            C_STMT('goto exit')
+
+        C_STMT('size_t {0} = json_array_size({1}), {2}'.format(size, array_ptr, parsed))
+        C_STMT('struct {0} *{1} = {2} ? {3} : NULL'.format(struct_decl.spelling, buffer, size,
+                                                          _allocate(options, 'sizeof(*{0}) * {1}'.format(buffer, size))))
+        C_STMT('{0} = {1}'.format(ptr, _allocate(options, 'sizeof(*{0}) * ({1} + 1)'.format(ptr, size))))
+        with C_BLOCK('if (({0} && NULL == {1}) || NULL == {2})'.format(size, buffer, ptr)):
+            if not arena:
+                C_STMT('free({0})'.format(buffer))
+                C_STMT('free({0})'.format(ptr))
+            # An unterminated vector would send _free through garbage
+            C_STMT('{0} = NULL'.format(ptr))
+            C_STMT('rc = -1')
+            C_STMT('goto exit')
+
+        with C_BLOCK('for ({0} = 0; {0} < {1}; {0}++)'.format(parsed, size)):
+            C_STMT('rc = {0}(json_array_get({1}, {2}), &{3}[{2}]{4})'.format(struct_parser_function_name(struct_decl),
+                                                                             array_ptr, parsed, buffer,
+                                                                             _arena_argument(options)))
+            C_STMT('if (0 != rc) break')
+            C_STMT('{0}[{1}] = &{2}[{1}]'.format(ptr, parsed, buffer))
+
+        C_STMT('{0}[{1}] = NULL'.format(ptr, parsed))
+        if not arena:
+            # _free releases the elements through the first list entry, which an empty list doesn't have
+            C_STMT('if (0 == {0}) free({1})'.format(parsed, buffer))
+        C_STMT('if (0 != rc) goto exit')
+
+def _generate_counted_array_parser(C_STMT, C_BLOCK, arrays, options):
+    """Fills T *items; size_t n_items; pairs with a single allocation of exactly the array's size"""
+    for array_ptr, f in arrays:
         ptr = _demangle_ptr(array_ptr)
-        C_STMT('int {0} = json_array_size({1})'.format(array_ptr_size, array_ptr))
-        _safe_allocation(C_STMT, struct_type + '*', array_ptr_buffer,
-                         'sizeof({0}) * {1}'.format(struct_type, array_ptr_size), cleanups,
-                         create_local_var = True)
-        _safe_allocation(C_STMT, struct_type + '**', ptr, 'sizeof(intptr_t) * {0} + 1'.format(array_ptr_size),
-                         cleanups, create_local_var = False)
-        with C_BLOCK('for (int i = 0; i < {0}; i++)'.format(array_ptr_size)):
-            C_STMT('rc = {0}(json_array_get({1}, i), &{2}[i])'.format(struct_parser_function_name(struct_decl),
-                                                                      array_ptr, array_ptr_buffer))
-            with C_BLOCK('if (0 != rc)'):
-                C_STMT('goto {0}'.format(cleanups[0].label))
-
-            C_STMT('{0}[i] = &{1}[i]'.format(ptr, array_ptr_buffer))
-
-        C_STMT('{0}[{1}] = NULL'.format(ptr, array_ptr_size))
-
-    C_STMT('goto exit');
-    _generate_cleanups(C_STMT, C_BLOCK, cleanups)
+        count = ptr[:-len(f.spelling)] + _count_field(f)
+        element = _counted_element(f)
+        length = array_ptr + '_count'
+        with C_BLOCK('if (!json_is_array({0}))'.format(array_ptr)):
+            C_STMT('rc = -1')
+            C_STMT('goto exit')
+
+        C_STMT('size_t {0} = json_array_size({1})'.format(length, array_ptr))
+        C_STMT('{0} = {1} ? {2} : NULL'.format(ptr, length, _allocate(options, 'sizeof(*{0}) * {1}'.format(ptr, length))))
+        C_STMT('{0} = 0'.format(count))
+        C_STMT(r'if ({0} && NULL == {1}) {{ rc = -1; goto exit; }}'.format(length, ptr), suffix = '')
+        # Only the elements parsed so far are counted, so _free releases exactly those
+        with C_BLOCK('for (; {0} < {1}; {0}++)'.format(count, length)):
+            C_STMT('json_t *element = json_array_get({0}, {1})'.format(array_ptr, count))
+            if element.kind == tk.RECORD:
+                C_STMT('rc = {0}(element, &{1}[{2}]{3})'.format(struct_parser_function_name(element.get_declaration()),
+                                                                ptr, count, _arena_argument(options)))
+                C_STMT('if (0 != rc) goto exit')
+            else:
+                C_STMT('if (!json_is_integer(element)) { rc = -1; goto exit; }', suffix = '')
+                C_STMT('{0}[{1}] = json_integer_value(element)'.format(ptr, count))
 
+def _generate_fixed_array_parser(C_STMT, C_BLOCK, arrays, options):
+    """Fills struct X arr[N] and numeric arr[N] fields from arrays of exactly N elements"""
+    for array_ptr, array_type in arrays:
+        ptr = _demangle_ptr(array_ptr)
+        length = array_type.get_array_size()
+        with C_BLOCK('if (!json_is_array({0}) || {1} != json_array_size({0}))'.format(array_ptr, length)):
+            C_STMT('rc = -1')
+            C_STMT('goto exit')
+
+        with C_BLOCK('for (int i = 0; i < {0}; i++)'.format(length)):
+            C_STMT('json_t *element = json_array_get({0}, i)'.format(array_ptr))
+            if _is_record_static_array(array_type):
+                sd = _array_record_declaration(array_type)
+                C_STMT('rc = {0}(element, &{1}[i]{2})'.format(struct_parser_function_name(sd), ptr,
+                                                              _arena_argument(options)))
+                C_STMT('if (0 != rc) goto exit')
+            else:
+                C_STMT('if (!json_is_integer(element)) { rc = -1; goto exit; }', suffix = '')
+                C_STMT('{0}[i] = json_integer_value(element)'.format(ptr))
 
-def _generate_free_implementation(s, h_module, C_BLOCK, C_STMT, function_name):
+def _generate_free_implementation(s, h_module, C_BLOCK, C_STMT, function_name, options):
     fields = [f
               for f in s.get_children()
               if f.kind == ck.FIELD_DECL]
 
     with C_BLOCK(function_name):
-        for f in fields:
-            if _is_var_string(f.type.get_canonical()):
-                C_STMT('free(this->{0})'.format(f.displayname))
-            if f.type.get_canonical().kind == tk.RECORD and _is_struct_jsonable(f.type.get_canonical().get_declaration()):
-                C_STMT('{0}(&this->{1})'.format(struct_free_function_name(f), f.displayname))
-            if _is_var_array(f.type.get_canonical()):
-                sd = f.type.get_canonical().get_pointee().get_pointee().get_declaration()
-                with C_BLOCK('for (int ___i = 0; this->{0}[___i] != NULL; ___i++)'.format(f.displayname)):
-                    C_STMT('{0}(this->{1}[___i])'.format(struct_free_function_name(sd), f.displayname))
+        if options.alloc == 'arena':
+            # Everything the parsers allocate lives in the caller's arena
+            return
 
-                C_STMT('free(*this->{0})'.format(f.displayname))
-                C_STMT('free(this->{0})'.format(f.displayname))
+        for f in fields:
+            _generate_field_release(f, 'this', C_STMT, C_BLOCK)
+
+def _generate_field_release(f, this, C_STMT, C_BLOCK):
+    """Emits code that frees what the parsers allocated for field f of this"""
+    ct = f.type.get_canonical()
+    if _is_var_string(ct) and not _is_borrowed(f):
+        C_STMT('free({0}->{1})'.format(this, f.displayname))
+    if ct.kind == tk.RECORD and _is_struct_jsonable(ct.get_declaration()):
+        C_STMT('{0}(&{1}->{2})'.format(struct_free_function_name(f), this, f.displayname))
+    if _is_record_static_array(ct):
+        with C_BLOCK('for (int ___i = 0; ___i < {0}; ___i++)'.format(ct.get_array_size())):
+            C_STMT('{0}(&{1}->{2}[___i])'.format(struct_free_function_name(_array_record_declaration(ct)),
+                                                 this, f.displayname))
+    if _count_field(f):
+        element = _counted_element(f)
+        if element.kind == tk.RECORD:
+            C_STMT('if (NULL != {0}->{1}) for (size_t ___i = 0; ___i < {0}->{2}; ___i++) {3}(&{0}->{1}[___i])'.format(
+                this, f.spelling, _count_field(f), struct_free_function_name(element.get_declaration())))
+        C_STMT('free({0}->{1})'.format(this, f.spelling))
+    if _is_var_array(ct):
+        sd = ct.get_pointee().get_pointee().get_declaration()
+        with C_BLOCK('if (NULL != {0}->{1})'.format(this, f.displayname)):
+            with C_BLOCK('for (int ___i = 0; {0}->{1}[___i] != NULL; ___i++)'.format(this, f.displayname)):
+                C_STMT('{0}({1}->{2}[___i])'.format(struct_free_function_name(sd), this, f.displayname))
+
+            C_STMT('free(*{0}->{1})'.format(this, f.displayname))
+            C_STMT('free({0}->{1})'.format(this, f.displayname))
+
+
+
+def _generate_field_changed(f, old, new, C_STMT, C_BLOCK):
+    """Emits code that sets changed when field f differs between old and new"""
+    ct = f.type.get_canonical()
+    a = '{0}->{1}'.format(old, f.spelling)
+    b = '{0}->{1}'.format(new, f.spelling)
+    if ct.kind == tk.RECORD:
+        C_STMT('changed = !{0}(&{1}, &{2})'.format(struct_equal_function_name(ct.get_declaration()), a, b))
+    elif ct.kind in _numeric_kinds:
+        C_STMT('changed = {0} != {1}'.format(a, b))
+    elif _is_static_string(ct):
+        C_STMT('changed = 0 != strncmp({0}, {1}, sizeof({0}))'.format(a, b))
+    elif _is_numeric_static_array(ct):
+        C_STMT('changed = 0 != memcmp({0}, {1}, sizeof({0}))'.format(a, b))
+    elif _is_record_static_array(ct):
+        C_STMT('changed = 0')
+        with C_BLOCK('for (int i = 0; i < {0} && !changed; i++)'.format(ct.get_array_size())):
+            C_STMT('changed = !{0}(&{1}[i], &{2}[i])'.format(
+                struct_equal_function_name(_array_record_declaration(ct)), a, b))
+    elif _is_var_array(ct):
+        # NULL lists serialize as empty ones
+        sd = ct.get_pointee().get_pointee().get_declaration()
+        C_STMT('changed = 0')
+        with C_BLOCK('for (int i = 0; !changed; i++)'):
+            C_STMT('const struct {0} *x = NULL == {1} ? NULL : {1}[i]'.format(sd.spelling, a))
+            C_STMT('const struct {0} *y = NULL == {1} ? NULL : {1}[i]'.format(sd.spelling, b))
+            C_STMT(r'if (NULL == x || NULL == y) {{ changed = x != y; break; }}', suffix = '')
+            C_STMT('changed = !{0}(x, y)'.format(struct_equal_function_name(sd)))
+    elif _count_field(f):
+        element = _counted_element(f)
+        count = _count_field(f)
+        if element.kind == tk.RECORD:
+            C_STMT('changed = {0}->{2} != {1}->{2}'.format(old, new, count))
+            with C_BLOCK('for (size_t i = 0; i < {0}->{1} && !changed; i++)'.format(old, count)):
+                C_STMT('changed = !{0}(&{1}[i], &{2}[i])'.format(struct_equal_function_name(element.get_declaration()),
+                                                                a, b))
+        else:
+            C_STMT('changed = {0}->{2} != {1}->{2} || (0 != {0}->{2} && 0 != memcmp({3}, {4}, sizeof(*{3}) * {0}->{2}))'.format(
+                old, new, count, a, b))
+    elif _is_var_string(ct) and _length_field(f):
+        C_STMT('changed = (NULL == {0}) != (NULL == {1}) || {2}->{4} != {3}->{4} || '
+               '(NULL != {0} && 0 != memcmp({0}, {1}, {2}->{4}))'.format(a, b, old, new, _length_field(f)))
+    elif _is_var_string(ct):
+        C_STMT('changed = (NULL == {0}) != (NULL == {1}) || (NULL != {0} && 0 != strcmp({0}, {1}))'.format(a, b))
+    else:
+        raise CantSerializeField(f.displayname, ct.kind)
 
+def _generate_equal(main_filename, s, c_module, h_module):
+    function_name = 'int {0}(const struct {1} *a, const struct {1} *b)'.format(struct_equal_function_name(s),
+                                                                             s.displayname)
+    h_module.stmt(function_name)
+    if s.location.file.name != main_filename:
+        return
 
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+    with C_BLOCK(function_name):
+        if _serialized_fields(s):
+            C_STMT('int changed')
+        for f in _serialized_fields(s):
+            _generate_field_changed(f, 'a', 'b', C_STMT, C_BLOCK)
+            C_STMT('if (changed) return 0')
 
-def _generate_parser(main_filename, s, c_module, h_module):
-    function_name = 'int {0}(json_t *json, struct {1} *out)'.format(struct_parser_function_name(s),
-                                                                    s.displayname)
-    free_function_name = 'void {0}(struct {1} *this)'.format(struct_free_function_name(s),
-                                                             s.displayname)
+        C_STMT('return 1')
 
+def _generate_diff_serializer(main_filename, s, c_module, h_module):
+    function_name = 'json_t *{0}(const struct {1} *old, const struct {1} *this)'.format(
+        struct_diff_function_name(s), s.displayname)
+    h_module.stmt(function_name)
+    if s.location.file.name != main_filename:
+        return
 
     C_STMT = c_module.stmt
     C_BLOCK = c_module.block
+    with C_BLOCK(function_name):
+        C_STMT('json_t *obj = json_object()')
+        if any(f.type.get_canonical().kind != tk.RECORD for f in _serialized_fields(s)):
+            C_STMT('int changed')
+        for f in _serialized_fields(s):
+            ct = f.type.get_canonical()
+            if ct.kind == tk.RECORD:
+                # Nested records only carry their own changes
+                diff = '{0}_diff'.format(f.spelling)
+                C_STMT('json_t *{0} = {1}(&old->{2}, &this->{2})'.format(
+                    diff, struct_diff_function_name(ct.get_declaration()), f.spelling))
+                C_STMT('if (0 == json_object_size({0})) json_decref({0})'.format(diff))
+                C_STMT('else json_object_set_new_nocheck(obj, "{0}", {1})'.format(f.displayname, diff))
+                continue
 
+            _generate_field_changed(f, 'old', 'this', C_STMT, C_BLOCK)
+            with C_BLOCK('if (changed)'):
+                value = _serialize_field(f, c_module)
+                if _is_var_string(ct):
+                    # A string that went away is sent as null
+                    value = 'NULL == this->{0} ? json_null() : {1}'.format(f.spelling, value)
+                C_STMT('json_object_set_new_nocheck(obj, "{0}", {1})'.format(f.displayname, value))
+
+        C_STMT('return obj')
+
+def _generate_patch_parser(main_filename, s, c_module, h_module, options):
+    """Applies a partial object: only the keys present are parsed and replaced.
+
+    Fields are parsed into a zeroed update first and only moved into
+    inout, releasing what they replace, once the whole object parsed.
+    Nested records are then patched in place, recursively, in field
+    order: a failure in one of them leaves inout's own fields alone, but
+    not the records patched before it.
+    """
+    function_name = 'int {0}(json_t *json, struct {1} *inout{2})'.format(struct_patch_function_name(s),
+                                                                         s.displayname,
+                                                                         _arena_parameter(options))
     h_module.stmt(function_name)
-    h_module.stmt(free_function_name)
     if s.location.file.name != main_filename:
         return
 
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+    fields = _serialized_fields(s)
+    seen_words = (len(fields) + 63) / 64
     with C_BLOCK(function_name):
+        C_STMT('const char *key')
+        C_STMT('json_t *value')
+        C_STMT('const char *error = "invalid value"')
+        C_STMT('struct {0} update'.format(s.displayname))
+        if any(f.type.get_canonical().kind != tk.RECORD for f in fields):
+            # Only flat fields are parsed through out
+            C_STMT('struct {0} *out = &update'.format(s.displayname))
+        if fields:
+            C_STMT('uint64_t seen[{0}] = {{0}}'.format(seen_words))
+
+        C_STMT('memset(&update, 0, sizeof(update))')
+        with C_BLOCK('if (!json_is_object(json))'):
+            C_STMT('error = "object expected"')
+            C_STMT('goto fail')
+
+        with C_BLOCK('json_object_foreach(json, key, value)'):
+            with C_BLOCK('switch ({0}(key, strlen(key)))'.format(struct_field_index_function_name(s))):
+                for index, f in enumerate(fields):
+                    ct = f.type.get_canonical()
+                    with _case(C_BLOCK, struct_field_enum_value(s, f), scope = True):
+                        C_STMT('seen[{0}] |= 1ULL << {1}'.format(index / 64, index % 64))
+                        if ct.kind == tk.RECORD:
+                            # Patched once every other key parsed
+                            C_STMT('break')
+                            continue
+
+                        if _is_var_string(ct):
+                            C_STMT('if (json_is_null(value)) break')
+                        _generate_json_field_parser(f, 'value', C_STMT, C_BLOCK, options)
+                        C_STMT('break')
+
+                with _case(C_BLOCK, None):
+                    C_STMT('break')
+
+        for index, f in enumerate(fields):
+            ct = f.type.get_canonical()
+            if ct.kind != tk.RECORD:
+                continue
+
+            with C_BLOCK('if (seen[{0}] & (1ULL << {1}))'.format(index / 64, index % 64)):
+                C_STMT('if (0 != {0}(json_object_get(json, "{1}"), &inout->{2}{3})) goto fail'.format(
+                    struct_patch_function_name(ct.get_declaration()), f.displayname, f.spelling,
+                    _arena_argument(options)))
+
+        for index, f in enumerate(fields):
+            if f.type.get_canonical().kind == tk.RECORD:
+                continue
+
+            with C_BLOCK('if (seen[{0}] & (1ULL << {1}))'.format(index / 64, index % 64)):
+                if options.alloc != 'arena':
+                    _generate_field_release(f, 'inout', C_STMT, C_BLOCK)
+                C_STMT('memcpy(&inout->{0}, &update.{0}, sizeof(inout->{0}))'.format(f.spelling))
+                for companion in (_length_field(f), _count_field(f), _capacity_field(f)):
+                    if companion:
+                        C_STMT('inout->{0} = update.{0}'.format(companion))
+
+        C_STMT('return 0')
+        C_STMT('fail:', suffix = '')
+        C_STMT(r'fprintf(stderr, "{0} error: %s\n", error)'.format(struct_patch_function_name(s)))
+        C_STMT('{0}(&update)'.format(struct_free_function_name(s)))
+        C_STMT('return -1')
+
+_stats_ops = {
+    struct_serializer_function_name: 'AUTOJSON_STATS_TO_JSON',
+    struct_parser_function_name: 'AUTOJSON_STATS_FROM_JSON',
+    struct_writer_function_name: 'AUTOJSON_STATS_WRITE_JSON',
+    struct_stream_parser_function_name: 'AUTOJSON_STATS_PARSE_JSON',
+    struct_array_writer_function_name: 'AUTOJSON_STATS_WRITE_JSON_ARRAY',
+    struct_lines_writer_function_name: 'AUTOJSON_STATS_WRITE_JSON_LINES',
+    struct_lines_parser_function_name: 'AUTOJSON_STATS_PARSE_JSON_LINES',
+    struct_msgpack_writer_function_name: 'AUTOJSON_STATS_TO_MSGPACK',
+    struct_msgpack_parser_function_name: 'AUTOJSON_STATS_FROM_MSGPACK',
+}
+
+def _generate_stats(main_filename, s, c_module, options):
+    if not options.instrument or s.location.file.name != main_filename:
+        return
+
+    c_module.stmt('#ifdef AUTOJSON_STATS', suffix = '')
+    c_module.stmt('static struct autojson_stats {0} = {{"{1}"}}'.format(struct_stats_name(s), s.spelling))
+    c_module.stmt('#endif', suffix = '')
+
+@contextmanager
+def _public_function(c_module, s, options, signature, name_function, transferred = None):
+    """The block of an entry point, wrapped in a counting function with --instrument.
+
+    When AUTOJSON_STATS is defined the body is compiled as a static
+    <function>__uninstrumented() and <function>() becomes a wrapper that
+    records the call in the struct's autojson_stats. transferred is the
+    expression for the bytes the call consumed (len) or 'buf' for the
+    bytes it appended to buf.
+    """
+    if not options.instrument:
+        with c_module.block(signature):
+            yield
+        return
+
+    name = name_function(s)
+    return_type, parameters = re.match(r'(.*?)\b{0}\((.*)\)$'.format(name), signature).groups()
+    arguments = ', '.join(re.search(r'(\w+)$', parameter).group(1) for parameter in parameters.split(','))
+    uninstrumented = name + '__uninstrumented'
+
+    C_STMT = c_module.stmt
+    C_STMT('#ifdef AUTOJSON_STATS', suffix = '')
+    C_STMT('#define {0} {1}'.format(name, uninstrumented), suffix = '')
+    C_STMT('static', suffix = '')
+    C_STMT('#endif', suffix = '')
+    with c_module.block(signature):
+        yield
+
+    C_STMT('#ifdef AUTOJSON_STATS', suffix = '')
+    C_STMT('#undef {0}'.format(name), suffix = '')
+    with c_module.block(signature):
+        C_STMT('struct autojson_stats_call autojson_call')
+        if transferred == 'buf':
+            C_STMT('size_t autojson_len = buf->len')
+            transferred = 'buf->len - autojson_len'
+        C_STMT('autojson_stats_begin(&autojson_call)')
+        C_STMT('{0}autojson_rc = {1}({2})'.format(return_type, uninstrumented, arguments))
+        failed = 'NULL == autojson_rc' if return_type.endswith('*') else '0 != autojson_rc'
+        C_STMT('autojson_stats_end(&{0}, {1}, &autojson_call, {2}, {3})'.format(
+            struct_stats_name(s), _stats_ops[name_function], failed, transferred or 0))
+        C_STMT('return autojson_rc')
+
+    C_STMT('#endif', suffix = '')
+
+def _generate_parser(main_filename, s, c_module, h_module, options):
+    function_name = 'int {0}(json_t *json, struct {1} *out{2})'.format(struct_parser_function_name(s),
+                                                                       s.displayname,
+                                                                       _arena_parameter(options))
+
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+
+    h_module.stmt(function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    if options.key_dispatch:
+        return _generate_dispatch_parser(s, c_module, function_name, options)
+
+    with _public_function(c_module, s, options, function_name, struct_parser_function_name):
         unpack_str = []
         destinations = []
         str_ptrs = []
         arrays = []
-        cleanups = []
         def unpack(fmt, *to):
             unpack_str.append(fmt)
             destinations.extend(list(to))
 
-        def add_array(array_json_name, array_type):
-            arrays.append((array_json_name, array_type))
+        def add_array(array_json_name, field):
+            arrays.append((array_json_name, field))
 
         def add_ptr(ptr_name, buffer_size, is_var):
             str_ptrs.append((ptr_name, buffer_size, is_var))
 
         recursively__generate_parser(s, c_module, "out->", unpack, add_ptr, add_array)
+        # Everything the parse allocates hangs off out, so a failure anywhere can _free it
+        C_STMT('memset(out, 0, sizeof(*out))')
         C_STMT('json_error_t json_err')
         function_body = 'json_unpack_ex(json, &json_err, 0, {0}, {1})'.format('"' + ''.join(unpack_str).replace(",}","}") + '"'
                                                             , ', '.join(destinations))
         C_STMT("int rc = {0}".format(function_body))
-        C_STMT(r'if (0 != rc) { fprintf(stderr, "json_unpack_ex error: %s\n", json_err.text); return rc;}')
+        C_STMT(r'if (0 != rc) { fprintf(stderr, "json_unpack_ex error: %s\n", json_err.text); goto exit; }',
+               suffix = '')
         for str_ptr, buffer_size, is_var in str_ptrs:
             ptr = _demangle_ptr(str_ptr)
             if is_var:
-                C_STMT('{0} = strdup({1})'.format(ptr, str_ptr))
+                C_STMT('{0} = {1}'.format(ptr, _duplicate_string(options, str_ptr)))
             else:
                 C_STMT('strncpy({0}, {1}, {2})'.format(ptr, str_ptr, buffer_size - 1))
 
-        _generate_var_array_parser(C_STMT, C_BLOCK, arrays, cleanups)
+        arrays = [(array, f, f.type.get_canonical()) for array, f in arrays]
+        _generate_fixed_array_parser(C_STMT, C_BLOCK, [(array, ct) for array, f, ct in arrays
+                                                       if ct.kind == tk.CONSTANTARRAY],
+                                     options)
+        _generate_counted_array_parser(C_STMT, C_BLOCK, [(array, f) for array, f, ct in arrays if _count_field(f)],
+                                       options)
+        _generate_var_array_parser(C_STMT, C_BLOCK, [(array, ct) for array, f, ct in arrays if _is_var_array(ct)],
+                                   options)
         C_STMT('exit:', suffix = '')
+        with C_BLOCK('if (0 != rc)'):
+            C_STMT('{0}(out)'.format(struct_free_function_name(s)))
+            C_STMT('memset(out, 0, sizeof(*out))')
+        C_STMT('return rc')
+
+
+def _generate_json_var_array_parser(f, value, C_STMT, C_BLOCK, options):
+    full_field_name = 'out->{0}'.format(f.spelling)
+    sd = f.type.get_canonical().get_pointee().get_pointee().get_declaration()
+    arena = options.alloc == 'arena'
+    C_STMT('if (!json_is_array({0})) goto fail'.format(value))
+    C_STMT('size_t count = json_array_size({0}), i'.format(value))
+    C_STMT('struct {0} *items = count ? {1} : NULL'.format(sd.spelling, _allocate(options, 'sizeof(*items) * count')))
+    C_STMT('{0} = {1}'.format(full_field_name, _allocate(options, 'sizeof(*{0}) * (count + 1)'.format(full_field_name))))
+    with C_BLOCK('if ((count && NULL == items) || NULL == {0})'.format(full_field_name)):
+        if not arena:
+            C_STMT('free(items)')
+            C_STMT('free({0})'.format(full_field_name))
+        # _free(out) at fail mustn't walk an unterminated vector
+        C_STMT('{0} = NULL'.format(full_field_name))
+        C_STMT('error = "out of memory"')
+        C_STMT('goto fail')
+
+    with C_BLOCK('for (i = 0; i < count; i++)'):
+        C_STMT('if (0 != {0}(json_array_get({1}, i), &items[i]{2})) break'.format(struct_parser_function_name(sd), value,
+                                                                              _arena_argument(options)))
+        C_STMT('{0}[i] = &items[i]'.format(full_field_name))
+
+    C_STMT('{0}[i] = NULL'.format(full_field_name))
+    if arena:
+        C_STMT('if (i != count) goto fail')
+    else:
+        # Once the first element is in place, _free releases items through it
+        C_STMT(r'if (i != count) { if (0 == i) free(items); goto fail; }', suffix = '')
+
+def _generate_json_counted_array_parser(f, value, C_STMT, C_BLOCK, options):
+    full_field_name = 'out->{0}'.format(f.spelling)
+    count = 'out->{0}'.format(_count_field(f))
+    element = _counted_element(f)
+    C_STMT('if (!json_is_array({0})) goto fail'.format(value))
+    C_STMT('size_t count = json_array_size({0})'.format(value))
+    C_STMT('{0} = count ? {1} : NULL'.format(full_field_name, _allocate(options, 'sizeof(*{0}) * count'.format(
+        full_field_name))))
+    C_STMT(r'if (count && NULL == {0}) {{ error = "out of memory"; goto fail; }}'.format(full_field_name), suffix = '')
+    # Only the elements parsed so far are counted, so _free releases exactly those
+    with C_BLOCK('for ({0} = 0; {0} < count; {0}++)'.format(count)):
+        C_STMT('json_t *element = json_array_get({0}, {1})'.format(value, count))
+        if element.kind == tk.RECORD:
+            C_STMT('if (0 != {0}(element, &{1}[{2}]{3})) goto fail'.format(
+                struct_parser_function_name(element.get_declaration()), full_field_name, count,
+                _arena_argument(options)))
+        else:
+            C_STMT('if (!json_is_integer(element)) goto fail')
+            C_STMT('{0}[{1}] = json_integer_value(element)'.format(full_field_name, count))
+
+def _generate_json_field_parser(f, value, C_STMT, C_BLOCK, options):
+    """Emits code that stores the json_t *value into field f of out.
+
+    Failures jump to the fail label, the generated code may set error
+    to describe the failure first.
+    """
+    ct = f.type.get_canonical()
+    full_field_name = 'out->{0}'.format(f.spelling)
+    if ct.kind == tk.RECORD:
+        C_STMT('if (0 != {0}({1}, &{2}{3})) goto fail'.format(struct_parser_function_name(ct.get_declaration()),
+                                                            value, full_field_name, _arena_argument(options)))
+    elif ct.kind in _numeric_kinds:
+        C_STMT('if (!json_is_integer({0})) goto fail'.format(value))
+        C_STMT('{0} = json_integer_value({1})'.format(full_field_name, value))
+    elif _is_static_string(ct):
+        C_STMT('if (!json_is_string({0})) goto fail'.format(value))
+        C_STMT('strncpy({0}, json_string_value({1}), {2})'.format(full_field_name, value, ct.get_array_size() - 1))
+    elif _is_borrowed(f):
+        C_STMT('if (!json_is_string({0})) goto fail'.format(value))
+        C_STMT('{0} = json_string_value({1})'.format(full_field_name, value))
+        if _length_field(f):
+            C_STMT('out->{0} = json_string_length({1})'.format(_length_field(f), value))
+    elif _is_var_string(ct):
+        C_STMT('if (!json_is_string({0})) goto fail'.format(value))
+        C_STMT('{0} = {1}'.format(full_field_name, _duplicate_string(options, 'json_string_value({0})'.format(value))))
+        C_STMT(r'if (NULL == {0}) {{ error = "out of memory"; goto fail; }}'.format(full_field_name), suffix = '')
+    elif _is_record_static_array(ct) or _is_numeric_static_array(ct):
+        length = ct.get_array_size()
+        C_STMT('if (!json_is_array({0}) || {1} != json_array_size({0})) goto fail'.format(value, length))
+        with C_BLOCK('for (int i = 0; i < {0}; i++)'.format(length)):
+            C_STMT('json_t *element = json_array_get({0}, i)'.format(value))
+            if _is_record_static_array(ct):
+                C_STMT('if (0 != {0}(element, &{1}[i]{2})) goto fail'.format(
+                    struct_parser_function_name(_array_record_declaration(ct)), full_field_name,
+                    _arena_argument(options)))
+            else:
+                C_STMT('if (!json_is_integer(element)) goto fail')
+                C_STMT('{0}[i] = json_integer_value(element)'.format(full_field_name))
+    elif _is_var_array(ct):
+        _generate_json_var_array_parser(f, value, C_STMT, C_BLOCK, options)
+    elif _count_field(f):
+        _generate_json_counted_array_parser(f, value, C_STMT, C_BLOCK, options)
+    else:
+        raise CantParseField(f.spelling)
+
+def _reuse_too_small(f, buffer, count, slack = ''):
+    """A C condition telling that buffer, the memory behind f, has no room for count elements.
+
+    slack is what buffer holds on top of the elements cap= counts, like
+    the NULL at the end of a var array's pointer vector.
+    """
+    capacity_field = _capacity_field(f)
+    if capacity_field is not None:
+        return 'out->{0} < {1}'.format(capacity_field, count)
+
+    return 'AUTOJSON_USABLE_SIZE({0}) < sizeof(*{0}) * ({1}{2})'.format(buffer, count, slack)
+
+def _generate_reuse_capacity(f, count, C_STMT):
+    capacity_field = _capacity_field(f)
+    if capacity_field is not None:
+        C_STMT('out->{0} = {1}'.format(capacity_field, count))
+
+def _generate_reuse_var_string_parser(f, value, C_STMT, C_BLOCK, options):
+    full_field_name = 'out->{0}'.format(f.spelling)
+    C_STMT('if (!json_is_string({0})) goto fail'.format(value))
+    C_STMT('size_t length = json_string_length({0})'.format(value))
+    with C_BLOCK('if (NULL == {0} || {1})'.format(full_field_name,
+                                                  _reuse_too_small(f, full_field_name, 'length + 1'))):
+        C_STMT('free({0})'.format(full_field_name))
+        C_STMT('{0} = {1}'.format(full_field_name, _allocate(options, 'length + 1')))
+        C_STMT(r'if (NULL == {0}) {{ error = "out of memory"; goto fail; }}'.format(full_field_name), suffix = '')
+        _generate_reuse_capacity(f, 'length + 1', C_STMT)
+
+    C_STMT('memcpy({0}, json_string_value({1}), length + 1)'.format(full_field_name, value))
+
+def _generate_reuse_var_array_parser(f, value, C_STMT, C_BLOCK, options):
+    """Parses into the elements, pointer vector and items buffer already in place.
+
+    Elements past the new length are freed, the two buffers only grow
+    when their cap= field or the allocator says they are too small, and
+    the elements that are added start out zeroed. inout can be freed at
+    every goto fail.
+    """
+    full_field_name = 'out->{0}'.format(f.spelling)
+    capacity_field = _capacity_field(f)
+    sd = f.type.get_canonical().get_pointee().get_pointee().get_declaration()
+    C_STMT('if (!json_is_array({0})) goto fail'.format(value))
+    C_STMT('size_t count = json_array_size({0}), used = 0, i'.format(value))
+    C_STMT('struct {0} *items = NULL'.format(sd.spelling))
+    with C_BLOCK('if (NULL != {0})'.format(full_field_name)):
+        C_STMT('while (NULL != {0}[used]) used++'.format(full_field_name))
+        C_STMT('items = *{0}'.format(full_field_name))
+        C_STMT('for (i = count; i < used; i++) {0}(&items[i])'.format(struct_free_function_name(sd)))
+        C_STMT('if (used > count) used = count')
+        C_STMT('{0}[used] = NULL'.format(full_field_name))
+
+    if capacity_field is None:
+        C_STMT('if (0 == count) { free(items); items = NULL; }', suffix = '')
+    else:
+        # The capacity counts items, which are gone with the last element
+        C_STMT(r'if (0 == count) {{ free(items); items = NULL; out->{0} = 0; }}'.format(capacity_field),
+               suffix = '')
+    with C_BLOCK('if (NULL == {0} || {1})'.format(full_field_name,
+                                                  _reuse_too_small(f, full_field_name, 'count', ' + 1'))):
+        C_STMT('struct {0} **pointers = {1}'.format(sd.spelling, _count_allocation(
+            options, 'realloc({0}, sizeof(*{0}) * (count + 1))'.format(full_field_name))))
+        C_STMT(r'if (NULL == pointers) { error = "out of memory"; goto fail; }', suffix = '')
+        C_STMT('{0} = pointers'.format(full_field_name))
+        C_STMT('{0}[used] = NULL'.format(full_field_name))
+
+    with C_BLOCK('if (count > used && (NULL == items || {0}))'.format(_reuse_too_small(f, 'items', 'count'))):
+        C_STMT('struct {0} *grown = {1}'.format(sd.spelling, _count_allocation(
+            options, 'realloc(items, sizeof(*items) * count)')))
+        C_STMT(r'if (NULL == grown) { error = "out of memory"; goto fail; }', suffix = '')
+        C_STMT('items = grown')
+
+    if capacity_field is not None:
+        C_STMT('if (out->{0} < count) out->{0} = count'.format(capacity_field))
+    C_STMT('if (count > used) memset(&items[used], 0, sizeof(*items) * (count - used))')
+    C_STMT('for (i = 0; i < count; i++) {0}[i] = &items[i]'.format(full_field_name))
+    C_STMT('{0}[count] = NULL'.format(full_field_name))
+    with C_BLOCK('for (i = 0; i < count; i++)'):
+        C_STMT('if (0 != {0}(json_array_get({1}, i), &items[i])) goto fail'.format(
+            struct_reuse_parser_function_name(sd), value))
+
+def _generate_reuse_counted_array_parser(f, value, C_STMT, C_BLOCK, options):
+    """Like the var array reuse, with the count field telling how many elements are in place"""
+    full_field_name = 'out->{0}'.format(f.spelling)
+    count = 'out->{0}'.format(_count_field(f))
+    element = _counted_element(f)
+    C_STMT('if (!json_is_array({0})) goto fail'.format(value))
+    C_STMT('size_t count = json_array_size({0}), i'.format(value))
+    if element.kind == tk.RECORD:
+        C_STMT('for (i = count; i < {0}; i++) {1}(&{2}[i])'.format(
+            count, struct_free_function_name(element.get_declaration()), full_field_name))
+    C_STMT('if ({0} > count) {0} = count'.format(count))
+    with C_BLOCK('if (count > {0} && (NULL == {1} || {2}))'.format(
+            count, full_field_name, _reuse_too_small(f, full_field_name, 'count'))):
+        C_STMT('void *grown = {0}'.format(_count_allocation(
+            options, 'realloc({0}, sizeof(*{0}) * count)'.format(full_field_name))))
+        C_STMT(r'if (NULL == grown) { error = "out of memory"; goto fail; }', suffix = '')
+        C_STMT('{0} = grown'.format(full_field_name))
+        _generate_reuse_capacity(f, 'count', C_STMT)
+
+    C_STMT('if (count > {0}) memset(&{1}[{0}], 0, sizeof(*{1}) * (count - {0}))'.format(count, full_field_name))
+    C_STMT('{0} = count'.format(count))
+    with C_BLOCK('for (i = 0; i < count; i++)'):
+        if element.kind == tk.RECORD:
+            C_STMT('if (0 != {0}(json_array_get({1}, i), &{2}[i])) goto fail'.format(
+                struct_reuse_parser_function_name(element.get_declaration()), value, full_field_name))
+        else:
+            C_STMT('json_t *element = json_array_get({0}, i)'.format(value))
+            C_STMT('if (!json_is_integer(element)) goto fail')
+            C_STMT('{0}[i] = json_integer_value(element)'.format(full_field_name))
+
+def _add_usable_size(m):
+    """AUTOJSON_USABLE_SIZE(), the allocator's idea of a buffer's size for fields without cap=
+
+    Only glibc can tell; elsewhere buffers without a capacity field are
+    reallocated on every parse.
+    """
+    m.stmt('#ifdef __GLIBC__', suffix = '')
+    _add_include(m, '<malloc.h>')
+    m.stmt('#define AUTOJSON_USABLE_SIZE(p) malloc_usable_size(p)', suffix = '')
+    m.stmt('#else', suffix = '')
+    m.stmt('#define AUTOJSON_USABLE_SIZE(p) ((size_t) 0)', suffix = '')
+    m.stmt('#endif', suffix = '')
+
+def _generate_reuse_parser(main_filename, s, c_module, h_module, options):
+    """A _from_json that parses into a structure filled by an earlier parse.
+
+    Strings and var arrays keep the memory they already own and only
+    reallocate when the new value does not fit, so parsing messages of
+    a steady size into the same structure allocates nothing.
+    """
+    if options.alloc == 'arena':
+        # Arena parsers already recycle their memory with autojson_arena_reset()
+        return
+
+    function_name = 'int {0}(json_t *json, struct {1} *inout)'.format(struct_reuse_parser_function_name(s),
+                                                                      s.displayname)
+    h_module.stmt(function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    if not c_module.reuse_parsers:
+        _add_usable_size(c_module)
+        c_module.reuse_parsers = True
+
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+    with C_BLOCK(function_name):
+        C_STMT('struct {0} *out = inout'.format(s.displayname))
+        C_STMT('json_t *value')
+        C_STMT('const char *error = "invalid value"')
+        with C_BLOCK('if (!json_is_object(json))'):
+            C_STMT('error = "object expected"')
+            C_STMT('goto fail')
+
+        for f in _serialized_fields(s):
+            ct = f.type.get_canonical()
+            with C_BLOCK('if (NULL != (value = json_object_get(json, "{0}")))'.format(f.displayname)):
+                if ct.kind == tk.RECORD:
+                    C_STMT('if (0 != {0}(value, &out->{1})) goto fail'.format(
+                        struct_reuse_parser_function_name(ct.get_declaration()), f.spelling))
+                elif _is_record_static_array(ct):
+                    length = ct.get_array_size()
+                    C_STMT('if (!json_is_array(value) || {0} != json_array_size(value)) goto fail'.format(length))
+                    with C_BLOCK('for (int i = 0; i < {0}; i++)'.format(length)):
+                        C_STMT('if (0 != {0}(json_array_get(value, i), &out->{1}[i])) goto fail'.format(
+                            struct_reuse_parser_function_name(_array_record_declaration(ct)), f.spelling))
+                elif _is_var_string(ct) and not _is_borrowed(f):
+                    _generate_reuse_var_string_parser(f, 'value', C_STMT, C_BLOCK, options)
+                elif _is_var_array(ct):
+                    _generate_reuse_var_array_parser(f, 'value', C_STMT, C_BLOCK, options)
+                elif _count_field(f):
+                    _generate_reuse_counted_array_parser(f, 'value', C_STMT, C_BLOCK, options)
+                else:
+                    _generate_json_field_parser(f, 'value', C_STMT, C_BLOCK, options)
+            with C_BLOCK('else'):
+                C_STMT('error = "missing key"')
+                C_STMT('goto fail')
+
+        C_STMT('return 0')
+        C_STMT('fail:', suffix = '')
+        C_STMT(r'fprintf(stderr, "{0} error: %s\n", error)'.format(struct_reuse_parser_function_name(s)))
+        C_STMT('{0}(inout)'.format(struct_free_function_name(s)))
+        C_STMT('memset(inout, 0, sizeof(*inout))')
+        C_STMT('return -1')
+
+def _generate_dispatch_parser(s, c_module, function_name, options):
+    """A _from_json that walks the object's keys once through the field index"""
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+    fields = _serialized_fields(s)
+    seen_words = (len(fields) + 63) / 64
+    with _public_function(c_module, s, options, function_name, struct_parser_function_name):
+        C_STMT('const char *key')
+        C_STMT('json_t *value')
+        C_STMT('const char *error = "invalid value"')
+        if fields:
+            C_STMT('uint64_t seen[{0}] = {{0}}'.format(seen_words))
+
+        C_STMT('memset(out, 0, sizeof(*out))')
+        with C_BLOCK('if (!json_is_object(json))'):
+            C_STMT('error = "object expected"')
+            C_STMT('goto fail')
+
+        with C_BLOCK('json_object_foreach(json, key, value)'):
+            with C_BLOCK('switch ({0}(key, strlen(key)))'.format(struct_field_index_function_name(s))):
+                for index, f in enumerate(fields):
+                    with _case(C_BLOCK, struct_field_enum_value(s, f), scope = True):
+                        C_STMT('seen[{0}] |= 1ULL << {1}'.format(index / 64, index % 64))
+                        _generate_json_field_parser(f, 'value', C_STMT, C_BLOCK, options)
+                        C_STMT('break')
+
+                with _case(C_BLOCK, None):
+                    C_STMT('break')
+
+        for word in range(seen_words):
+            bits = min(64, len(fields) - word * 64)
+            mask = (1 << bits) - 1
+            C_STMT(r'if (0x{0:x}ULL != seen[{1}]) {{ error = "missing key"; goto fail; }}'.format(mask, word),
+                   suffix = '')
+        C_STMT('return 0')
+        C_STMT('fail:', suffix = '')
+        C_STMT(r'fprintf(stderr, "{0} error: %s\n", error)'.format(struct_parser_function_name(s)))
+        C_STMT('{0}(out)'.format(struct_free_function_name(s)))
+        C_STMT('memset(out, 0, sizeof(*out))')
+        C_STMT('return -1')
+
+
+@contextmanager
+def _case(block, label, scope = False):
+    title = 'case {0}:'.format(label) if label else 'default:'
+    if scope:
+        with block(title) as blk:
+            yield blk
+    else:
+        with block(title, prefix = None, suffix = None) as blk:
+            yield blk
+
+def _generate_key_switch(s, C_STMT, C_BLOCK, fields, position = None):
+    """Maps key to the index of one of fields, which all have the same length.
+
+    Switches on the character position that tells most of the remaining
+    names apart until a single candidate is left, which is then confirmed
+    with one memcmp.
+    """
+    if len(fields) == 1:
+        name = fields[0].displayname
+        C_STMT('return 0 == memcmp(key, "{0}", {1}) ? {2} : -1'.format(name, len(name),
+                                                                     struct_field_enum_value(s, fields[0])))
+        return
+
+    length = len(fields[0].displayname)
+    position = max(range(length), key = lambda i: (len(set(f.displayname[i] for f in fields)), -i))
+    with C_BLOCK('switch (key[{0}])'.format(position)):
+        for c in sorted(set(f.displayname[position] for f in fields)):
+            with _case(C_BLOCK, "'{0}'".format(c)):
+                _generate_key_switch(s, C_STMT, C_BLOCK, [f for f in fields if f.displayname[position] == c])
+
+    C_STMT('break')
+
+def _generate_field_index(main_filename, s, c_module, h_module):
+    function_name = 'int {0}(const char *key, size_t len)'.format(struct_field_index_function_name(s))
+    if s.location.file.name != main_filename:
+        return
+
+    fields = _serialized_fields(s)
+    with h_module.block('enum {0}_field'.format(s.displayname), suffix = '};'):
+        for f in fields:
+            h_module.stmt(struct_field_enum_value(s, f), suffix = ',')
+        h_module.stmt(struct_field_enum_value(s, None), suffix = ',')
+
+    h_module.stmt(function_name)
+
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+    with C_BLOCK(function_name):
+        lengths = sorted(set(len(f.displayname) for f in fields))
+        if lengths:
+            with C_BLOCK('switch (len)'):
+                for length in lengths:
+                    with _case(C_BLOCK, length):
+                        _generate_key_switch(s, C_STMT, C_BLOCK,
+                                             [f for f in fields if len(f.displayname) == length])
+
+        C_STMT('return -1')
+
+
+_max_paths = 64
+
+def _projection_paths(s):
+    """The paths a projection mask can select in s, one bit each, e.g. [['a'], ['c'], ['c', 'bla']].
+
+    Every field has a path. Nested records are followed into their own
+    paths, which then immediately follow the record's and keep their
+    order, as long as all of them fit in the 64 bit mask; those that
+    don't are selected as a whole. Fields past the 64th share the last
+    bit, see _projection_bit().
+    """
+    fields = _serialized_fields(s)
+    nested = dict((f.spelling, _projection_paths(f.type.get_canonical().get_declaration()))
+                  for f in fields if f.type.get_canonical().kind == tk.RECORD)
+    total = len(fields)
+    expanded = set()
+    for f in fields:
+        if f.spelling in nested and total + len(nested[f.spelling]) <= _max_paths:
+            total += len(nested[f.spelling])
+            expanded.add(f.spelling)
+
+    paths = []
+    for f in fields:
+        paths.append([f.spelling])
+        if f.spelling in expanded:
+            paths.extend([f.spelling] + path for path in nested[f.spelling])
+
+    return paths
+
+def _projection_bit(paths, path):
+    """The bit of the mask selecting path, one of paths"""
+    return min(paths.index(path), _max_paths - 1)
+
+def _generate_projection_parser(main_filename, s, c_module, h_module, options):
+    """A _from_json that only looks up and parses the fields a mask of paths selects"""
+    paths = _projection_paths(s)
+    function_name = 'int {0}(json_t *json, struct {1} *out, uint64_t mask{2})'.format(
+        struct_projection_parser_function_name(s), s.displayname, _arena_parameter(options))
+    index_function_name = 'int {0}(const char *path)'.format(struct_path_index_function_name(s))
+    if s.location.file.name == main_filename:
+        with h_module.block('enum {0}_path'.format(s.displayname), suffix = '};'):
+            for index, path in enumerate(paths):
+                if index < _max_paths - 1:
+                    h_module.stmt(struct_path_enum_value(s, path), suffix = ',')
+                else:
+                    # Too many fields for a bit each, the rest are selected together
+                    h_module.stmt('{0} = {1}'.format(struct_path_enum_value(s, path), _max_paths - 1), suffix = ',')
+            h_module.stmt(struct_path_enum_value(s, None), suffix = ',')
+
+    h_module.stmt(index_function_name)
+    h_module.stmt(function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+    with C_BLOCK(index_function_name):
+        for path in paths:
+            C_STMT('if (0 == strcmp(path, "{0}")) return {1}'.format('.'.join(path), struct_path_enum_value(s, path)))
+        C_STMT('return -1')
+
+    with C_BLOCK(function_name):
+        C_STMT('json_t *value')
+        C_STMT('const char *error = "invalid value"')
+        C_STMT('memset(out, 0, sizeof(*out))')
+        with C_BLOCK('if (!json_is_object(json))'):
+            C_STMT('error = "object expected"')
+            C_STMT('goto fail')
+
+        for f in _serialized_fields(s):
+            index = _projection_bit(paths, [f.spelling])
+            nested = [path for path in paths if len(path) > 1 and path[0] == f.spelling]
+            bits = '(1ULL << {0})'.format(index)
+            if nested:
+                sub_mask = '(mask >> {0}) & 0x{1:x}ULL'.format(index + 1, (1 << len(nested)) - 1)
+                bits = '0x{0:x}ULL'.format(((1 << (len(nested) + 1)) - 1) << index)
+
+            with C_BLOCK('if (mask & {0})'.format(bits)):
+                C_STMT(r'if (NULL == (value = json_object_get(json, "{0}"))) {{ error = "missing key"; goto fail; }}'.format(
+                    f.displayname), suffix = '')
+                if nested:
+                    # Only some paths below the record: project it too
+                    with C_BLOCK('if (!(mask & (1ULL << {0})))'.format(index)):
+                        C_STMT('if (0 != {0}(value, &out->{1}, {2}{3})) goto fail'.format(
+                            struct_projection_parser_function_name(f.type.get_canonical().get_declaration()),
+                            f.spelling, sub_mask, _arena_argument(options)))
+                    with C_BLOCK('else'):
+                        _generate_json_field_parser(f, 'value', C_STMT, C_BLOCK, options)
+                else:
+                    _generate_json_field_parser(f, 'value', C_STMT, C_BLOCK, options)
+
+        C_STMT('return 0')
+        C_STMT('fail:', suffix = '')
+        C_STMT(r'fprintf(stderr, "{0} error: %s\n", error)'.format(struct_projection_parser_function_name(s)))
+        C_STMT('{0}(out)'.format(struct_free_function_name(s)))
+        C_STMT('memset(out, 0, sizeof(*out))')
+        C_STMT('return -1')
+
+
+def _generate_free(main_filename, s, c_module, h_module, options):
+    free_function_name = 'void {0}(struct {1} *this)'.format(struct_free_function_name(s),
+                                                             s.displayname)
+    borrowed = [f.spelling for f in _serialized_fields(s) if _is_borrowed(f)]
+    if borrowed:
+        h_module.doc('{0} borrows {1} from the parsed input: they point into the json_t or the\n'
+                     'buffer they were parsed from, which must outlive the structure. {2}()\n'
+                     'leaves them alone.'.format('struct ' + s.spelling, ', '.join(borrowed),
+                                                 struct_free_function_name(s)))
+    h_module.stmt(free_function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    _generate_free_implementation(s, h_module, c_module.block, c_module.stmt, free_function_name, options)
+
+
+def _generate_stream_var_array_parser(f, C_STMT, C_BLOCK):
+    full_field_name = 'out->{0}'.format(f.spelling)
+    sd = f.type.get_canonical().get_pointee().get_pointee().get_declaration()
+    struct_type = 'struct {0}'.format(sd.spelling)
+    C_STMT('{0} *items = NULL'.format(struct_type))
+    C_STMT('size_t count = 0, cap = 0')
+    C_STMT('int element = 0, next')
+    C_STMT('if (0 != autojson_lex_array_begin(lex)) goto fail')
+    with C_BLOCK('while (0 < (next = autojson_lex_array_next(lex, &element)))'):
+        with C_BLOCK('if (count == cap)'):
+            C_STMT('{0} *grown = autojson_lex_grow_array(lex, items, &cap, sizeof(*items))'.format(struct_type))
+            C_STMT(r'if (NULL == grown) { next = -1; break; }', suffix = '')
+            C_STMT('items = grown')
+
+        C_STMT(r'if (0 != {0}(lex, &items[count])) {{ next = -1; break; }}'.format(struct_lexer_parser_function_name(sd)),
+               suffix = '')
+        C_STMT('count++')
+
+    with C_BLOCK('if (0 == next)'):
+        C_STMT('{0} = autojson_lex_alloc(lex, sizeof(*{0}) * (count + 1))'.format(full_field_name))
+        C_STMT('if (NULL == {0}) next = -1'.format(full_field_name))
+
+    with C_BLOCK('if (0 != next)'):
+        C_STMT('for (size_t i = 0; i < count; i++) {0}(&items[i])'.format(struct_free_function_name(sd)))
+        C_STMT('autojson_lex_release(lex, items)')
+        C_STMT('goto fail')
+
+    C_STMT('for (size_t i = 0; i < count; i++) {0}[i] = &items[i]'.format(full_field_name))
+    C_STMT('{0}[count] = NULL'.format(full_field_name))
+
+def _generate_stream_counted_array_parser(f, C_STMT, C_BLOCK):
+    full_field_name = 'out->{0}'.format(f.spelling)
+    count = 'out->{0}'.format(_count_field(f))
+    element = _counted_element(f)
+    C_STMT('size_t cap = 0')
+    C_STMT('int element = 0, next')
+    C_STMT('if (0 != autojson_lex_array_begin(lex)) goto fail')
+    with C_BLOCK('while (0 < (next = autojson_lex_array_next(lex, &element)))'):
+        with C_BLOCK('if ({0} == cap)'.format(count)):
+            C_STMT('void *grown = autojson_lex_grow_array(lex, {0}, &cap, sizeof(*{0}))'.format(full_field_name))
+            C_STMT('if (NULL == grown) goto fail')
+            C_STMT('{0} = grown'.format(full_field_name))
+
+        if element.kind == tk.RECORD:
+            C_STMT('if (0 != {0}(lex, &{1}[{2}])) goto fail'.format(
+                struct_lexer_parser_function_name(element.get_declaration()), full_field_name, count))
+        else:
+            C_STMT('if (0 != autojson_lex_integer(lex, &value)) goto fail')
+            C_STMT('{0}[{1}] = value'.format(full_field_name, count))
+        C_STMT('{0}++'.format(count))
+
+    C_STMT('if (0 != next) goto fail')
+
+def _generate_stream_field_parser(f, C_STMT, C_BLOCK):
+    ct = f.type.get_canonical()
+    full_field_name = 'out->{0}'.format(f.spelling)
+    if ct.kind == tk.RECORD:
+        C_STMT('if (0 != {0}(lex, &{1})) goto fail'.format(struct_lexer_parser_function_name(ct.get_declaration()),
+                                                         full_field_name))
+    elif ct.kind in _numeric_kinds:
+        C_STMT('if (0 != autojson_lex_integer(lex, &value)) goto fail')
+        C_STMT('{0} = value'.format(full_field_name))
+    elif _is_static_string(ct):
+        C_STMT('if (0 != autojson_lex_string_copy(lex, {0}, sizeof({0}))) goto fail'.format(full_field_name))
+    elif _is_borrowed(f):
+        C_STMT('if (0 != autojson_lex_string_borrow(lex, &{0}, &out->{1})) goto fail'.format(full_field_name,
+                                                                                          _borrow_length_field(f)))
+    elif _is_var_string(ct):
+        C_STMT('if (0 != autojson_lex_string_dup(lex, &{0})) goto fail'.format(full_field_name))
+    elif _is_record_static_array(ct) or _is_numeric_static_array(ct):
+        length = ct.get_array_size()
+        C_STMT('int element = 0, next, i = 0')
+        C_STMT('if (0 != autojson_lex_array_begin(lex)) goto fail')
+        with C_BLOCK('while (0 < (next = autojson_lex_array_next(lex, &element)))'):
+            C_STMT(r'if ({0} == i) {{ autojson_lex_fail(lex, "too many elements"); goto fail; }}'.format(length),
+                   suffix = '')
+            if _is_record_static_array(ct):
+                C_STMT('if (0 != {0}(lex, &{1}[i])) goto fail'.format(
+                    struct_lexer_parser_function_name(_array_record_declaration(ct)), full_field_name))
+            else:
+                C_STMT('if (0 != autojson_lex_integer(lex, &value)) goto fail')
+                C_STMT('{0}[i] = value'.format(full_field_name))
+            C_STMT('i++')
+
+        C_STMT('if (0 != next) goto fail')
+        C_STMT(r'if ({0} != i) {{ autojson_lex_fail(lex, "too few elements"); goto fail; }}'.format(length), suffix = '')
+    elif _is_var_array(ct):
+        _generate_stream_var_array_parser(f, C_STMT, C_BLOCK)
+    elif _count_field(f):
+        _generate_stream_counted_array_parser(f, C_STMT, C_BLOCK)
+    else:
+        raise CantParseField(f.spelling)
+
+def _generate_stream_parser(main_filename, s, c_module, h_module, options):
+    function_name = 'int {0}(const char *buf, size_t len, struct {1} *out{2}, struct autojson_error *err)'.format(
+        struct_stream_parser_function_name(s), s.displayname, _arena_parameter(options))
+    lexer_function_name = 'int {0}(struct autojson_lexer *lex, struct {1} *out)'.format(
+        struct_lexer_parser_function_name(s), s.displayname)
+
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+
+    h_module.stmt(function_name)
+    h_module.stmt(lexer_function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    with _public_function(c_module, s, options, function_name, struct_stream_parser_function_name, 'len'):
+        C_STMT('struct autojson_lexer lex')
+        C_STMT('autojson_lexer_init(&lex, buf, len)')
+        if options.alloc == 'arena':
+            C_STMT('lex.arena = arena')
+        C_STMT('int rc = {0}(&lex, out)'.format(struct_lexer_parser_function_name(s)))
+        C_STMT('if (0 == rc && 0 != (rc = autojson_lex_end(&lex))) {0}(out)'.format(struct_free_function_name(s)))
+        C_STMT('if (0 != rc) autojson_lex_error(&lex, err)')
         C_STMT('return rc')
 
-    _generate_free_implementation(s, h_module, C_BLOCK, C_STMT, free_function_name)
+    fields = _serialized_fields(s)
+    seen_words = (len(fields) + 63) / 64
+    with C_BLOCK(lexer_function_name):
+        C_STMT('const char *key')
+        C_STMT('size_t key_len')
+        C_STMT('int member = 0, more')
+        if _needs_integer_value(fields):
+            C_STMT('long long value')
+        if fields:
+            C_STMT('uint64_t seen[{0}] = {{0}}'.format(seen_words))
+
+        C_STMT('memset(out, 0, sizeof(*out))')
+        C_STMT('if (0 != autojson_lex_object_begin(lex)) return -1')
+        with C_BLOCK('while (0 < (more = autojson_lex_object_next(lex, &member, &key, &key_len)))'):
+            with C_BLOCK('switch ({0}(key, key_len))'.format(struct_field_index_function_name(s))):
+                for index, f in enumerate(fields):
+                    with _case(C_BLOCK, struct_field_enum_value(s, f), scope = True):
+                        seen_bit = 'seen[{0}] & (1ULL << {1})'.format(index / 64, index % 64)
+                        C_STMT(r'if ({0}) {{ autojson_lex_fail(lex, "duplicate key"); goto fail; }}'.format(seen_bit),
+                               suffix = '')
+                        C_STMT('seen[{0}] |= 1ULL << {1}'.format(index / 64, index % 64))
+                        _generate_stream_field_parser(f, C_STMT, C_BLOCK)
+                        C_STMT('break')
+
+                with _case(C_BLOCK, None):
+                    C_STMT('if (0 != autojson_lex_skip(lex)) goto fail')
+
+        C_STMT('if (0 != more) goto fail')
+        for word in range(seen_words):
+            bits = min(64, len(fields) - word * 64)
+            mask = (1 << bits) - 1
+            C_STMT(r'if (0x{0:x}ULL != seen[{1}]) {{ autojson_lex_fail(lex, "missing key"); goto fail; }}'.format(mask, word),
+                   suffix = '')
+        C_STMT('return 0')
+        C_STMT('fail:', suffix = '')
+        C_STMT('{0}(out)'.format(struct_free_function_name(s)))
+        C_STMT('memset(out, 0, sizeof(*out))')
+        C_STMT('return -1')
+
+
+def _generate_msgpack_var_array_parser(f, C_STMT, C_BLOCK):
+    full_field_name = 'out->{0}'.format(f.spelling)
+    sd = f.type.get_canonical().get_pointee().get_pointee().get_declaration()
+    C_STMT('size_t count, i')
+    C_STMT('if (0 != autojson_mp_array_begin(lex, &count)) goto fail')
+    C_STMT('struct {0} *items = count ? autojson_lex_alloc(lex, sizeof(*items) * count) : NULL'.format(sd.spelling))
+    C_STMT('if (count && NULL == items) goto fail')
+    C_STMT('{0} = autojson_lex_alloc(lex, sizeof(*{0}) * (count + 1))'.format(full_field_name))
+    C_STMT(r'if (NULL == {0}) {{ autojson_lex_release(lex, items); goto fail; }}'.format(full_field_name), suffix = '')
+    with C_BLOCK('for (i = 0; i < count; i++)'):
+        C_STMT('if (0 != {0}(lex, &items[i])) break'.format(struct_msgpack_reader_function_name(sd)))
+        C_STMT('{0}[i] = &items[i]'.format(full_field_name))
+
+    C_STMT('{0}[i] = NULL'.format(full_field_name))
+    # Once the first element is in place, _free releases items through it
+    C_STMT(r'if (i != count) { if (0 == i) autojson_lex_release(lex, items); goto fail; }', suffix = '')
+
+def _generate_msgpack_counted_array_parser(f, C_STMT, C_BLOCK):
+    full_field_name = 'out->{0}'.format(f.spelling)
+    count = 'out->{0}'.format(_count_field(f))
+    element = _counted_element(f)
+    C_STMT('size_t count')
+    C_STMT('if (0 != autojson_mp_array_begin(lex, &count)) goto fail')
+    C_STMT('{0} = count ? autojson_lex_alloc(lex, sizeof(*{0}) * count) : NULL'.format(full_field_name))
+    C_STMT('if (count && NULL == {0}) goto fail'.format(full_field_name))
+    with C_BLOCK('for (; {0} < count; {0}++)'.format(count)):
+        if element.kind == tk.RECORD:
+            C_STMT('if (0 != {0}(lex, &{1}[{2}])) goto fail'.format(
+                struct_msgpack_reader_function_name(element.get_declaration()), full_field_name, count))
+        else:
+            C_STMT('if (0 != autojson_mp_integer(lex, &value)) goto fail')
+            C_STMT('{0}[{1}] = value'.format(full_field_name, count))
+
+def _generate_msgpack_field_parser(f, C_STMT, C_BLOCK):
+    ct = f.type.get_canonical()
+    full_field_name = 'out->{0}'.format(f.spelling)
+    if ct.kind == tk.RECORD:
+        C_STMT('if (0 != {0}(lex, &{1})) goto fail'.format(struct_msgpack_reader_function_name(ct.get_declaration()),
+                                                         full_field_name))
+    elif ct.kind in _numeric_kinds:
+        C_STMT('if (0 != autojson_mp_integer(lex, &value)) goto fail')
+        C_STMT('{0} = value'.format(full_field_name))
+    elif _is_static_string(ct):
+        C_STMT('if (0 != autojson_mp_string_copy(lex, {0}, sizeof({0}))) goto fail'.format(full_field_name))
+    elif _is_borrowed(f):
+        C_STMT('if (0 != autojson_mp_string_borrow(lex, &{0}, &out->{1})) goto fail'.format(full_field_name,
+                                                                                         _borrow_length_field(f)))
+    elif _is_var_string(ct):
+        C_STMT('if (0 != autojson_mp_string_dup(lex, &{0})) goto fail'.format(full_field_name))
+    elif _is_record_static_array(ct) or _is_numeric_static_array(ct):
+        length = ct.get_array_size()
+        C_STMT('size_t count')
+        C_STMT('if (0 != autojson_mp_array_begin(lex, &count)) goto fail')
+        C_STMT(r'if ({0} != count) {{ autojson_lex_fail(lex, "wrong number of elements"); goto fail; }}'.format(length),
+               suffix = '')
+        with C_BLOCK('for (int i = 0; i < {0}; i++)'.format(length)):
+            if _is_record_static_array(ct):
+                C_STMT('if (0 != {0}(lex, &{1}[i])) goto fail'.format(
+                    struct_msgpack_reader_function_name(_array_record_declaration(ct)), full_field_name))
+            else:
+                C_STMT('if (0 != autojson_mp_integer(lex, &value)) goto fail')
+                C_STMT('{0}[i] = value'.format(full_field_name))
+    elif _is_var_array(ct):
+        _generate_msgpack_var_array_parser(f, C_STMT, C_BLOCK)
+    elif _count_field(f):
+        _generate_msgpack_counted_array_parser(f, C_STMT, C_BLOCK)
+    else:
+        raise CantParseField(f.spelling)
+
+def _generate_msgpack_parser(main_filename, s, c_module, h_module, options):
+    function_name = 'int {0}(const char *buf, size_t len, struct {1} *out{2}, struct autojson_error *err)'.format(
+        struct_msgpack_parser_function_name(s), s.displayname, _arena_parameter(options))
+    reader_function_name = 'int {0}(struct autojson_lexer *lex, struct {1} *out)'.format(
+        struct_msgpack_reader_function_name(s), s.displayname)
+
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+
+    h_module.stmt(function_name)
+    h_module.stmt(reader_function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    with _public_function(c_module, s, options, function_name, struct_msgpack_parser_function_name, 'len'):
+        C_STMT('struct autojson_lexer lex')
+        C_STMT('autojson_lexer_init(&lex, buf, len)')
+        if options.alloc == 'arena':
+            C_STMT('lex.arena = arena')
+        C_STMT('int rc = {0}(&lex, out)'.format(struct_msgpack_reader_function_name(s)))
+        C_STMT('if (0 == rc && 0 != (rc = autojson_mp_end(&lex))) {0}(out)'.format(struct_free_function_name(s)))
+        C_STMT('if (0 != rc) autojson_lex_error(&lex, err)')
+        C_STMT('return rc')
+
+    fields = _serialized_fields(s)
+    seen_words = (len(fields) + 63) / 64
+    with C_BLOCK(reader_function_name):
+        C_STMT('const char *key')
+        C_STMT('size_t key_len, members')
+        if _needs_integer_value(fields):
+            C_STMT('long long value')
+        if fields:
+            C_STMT('uint64_t seen[{0}] = {{0}}'.format(seen_words))
+
+        C_STMT('memset(out, 0, sizeof(*out))')
+        C_STMT('if (0 != autojson_mp_map_begin(lex, &members)) return -1')
+        with C_BLOCK('for (size_t member = 0; member < members; member++)'):
+            C_STMT('if (0 != autojson_mp_key(lex, &key, &key_len)) goto fail')
+            with C_BLOCK('switch ({0}(key, key_len))'.format(struct_field_index_function_name(s))):
+                for index, f in enumerate(fields):
+                    with _case(C_BLOCK, struct_field_enum_value(s, f), scope = True):
+                        seen_bit = 'seen[{0}] & (1ULL << {1})'.format(index / 64, index % 64)
+                        C_STMT(r'if ({0}) {{ autojson_lex_fail(lex, "duplicate key"); goto fail; }}'.format(seen_bit),
+                               suffix = '')
+                        C_STMT('seen[{0}] |= 1ULL << {1}'.format(index / 64, index % 64))
+                        _generate_msgpack_field_parser(f, C_STMT, C_BLOCK)
+                        C_STMT('break')
+
+                with _case(C_BLOCK, None):
+                    C_STMT('if (0 != autojson_mp_skip(lex)) goto fail')
+
+        for word in range(seen_words):
+            bits = min(64, len(fields) - word * 64)
+            mask = (1 << bits) - 1
+            C_STMT(r'if (0x{0:x}ULL != seen[{1}]) {{ autojson_lex_fail(lex, "missing key"); goto fail; }}'.format(mask, word),
+                   suffix = '')
+        C_STMT('return 0')
+        C_STMT('fail:', suffix = '')
+        C_STMT('{0}(out)'.format(struct_free_function_name(s)))
+        C_STMT('memset(out, 0, sizeof(*out))')
+        C_STMT('return -1')
+
+
+def _table_length_offset(s, f, length_field, annotation = 'len'):
+    if length_field is None:
+        return 'AUTOJSON_NO_LENGTH'
+
+    # The engine stores counts through a size_t * too, the other backends take any integer
+    _size_field(f, length_field, annotation, CantBorrowField)
+    return 'offsetof(struct {0}, {1})'.format(s.spelling, length_field)
+
+def _table_field(s, f):
+    """The initializer of the struct autojson_field describing field f of s"""
+    ct = f.type.get_canonical()
+    struct_type = 'struct {0}'.format(s.spelling)
+    size, count, length, record = '0', '0', 'AUTOJSON_NO_LENGTH', 'NULL'
+    if _count_field(f):
+        kind = 'COUNTED_ARRAY'
+        length = _table_length_offset(s, f, _count_field(f), 'count')
+        element = _counted_element(f)
+        if element.kind == tk.RECORD:
+            record = '&' + struct_descriptor_name(element.get_declaration())
+        else:
+            size = 'AUTOJSON_MEMBER_SIZE({0}, {1}[0])'.format(struct_type, f.spelling)
+    elif ct.kind in _numeric_kinds:
+        kind = 'INTEGER'
+        size = 'AUTOJSON_MEMBER_SIZE({0}, {1})'.format(struct_type, f.spelling)
+    elif _is_numeric_static_array(ct):
+        kind = 'INTEGER_ARRAY'
+        size = 'AUTOJSON_MEMBER_SIZE({0}, {1}[0])'.format(struct_type, f.spelling)
+        count = ct.get_array_size()
+    elif _is_static_string(ct):
+        kind = 'STATIC_STRING'
+        size = 'AUTOJSON_MEMBER_SIZE({0}, {1})'.format(struct_type, f.spelling)
+    elif _is_borrowed(f):
+        kind = 'BORROWED_STRING'
+        length = _table_length_offset(s, f, _length_field(f))
+    elif _is_var_string(ct):
+        kind = 'STRING'
+    elif ct.kind == tk.RECORD:
+        kind = 'RECORD'
+        record = '&' + struct_descriptor_name(ct.get_declaration())
+    elif _is_record_static_array(ct):
+        kind = 'RECORD_ARRAY'
+        count = ct.get_array_size()
+        record = '&' + struct_descriptor_name(_array_record_declaration(ct))
+    elif _is_var_array(ct):
+        kind = 'VAR_ARRAY'
+        record = '&' + struct_descriptor_name(ct.get_pointee().get_pointee().get_declaration())
+    else:
+        raise CantSerializeField(f.displayname, ct.kind)
+
+    return '{{"{0}", offsetof({1}, {2}), AUTOJSON_FIELD_{3}, {4}, {5}, {6}, {7}}}'.format(
+        f.displayname, struct_type, f.spelling, kind, size, count, length, record)
+
+def _generate_tables(main_filename, s, c_module, h_module):
+    """--mode=tables: a descriptor of s and the entry points that hand it to the engine"""
+    descriptor = struct_descriptor_name(s)
+    functions = [
+        ('json_t *{0}(const struct {1} *this)', struct_serializer_function_name,
+         'return autojson_table_to_json(&{0}, this)'),
+        ('int {0}(json_t *json, struct {1} *out)', struct_parser_function_name,
+         'return autojson_table_from_json(&{0}, json, out)'),
+        ('int {0}(const struct {1} *a, const struct {1} *b)', struct_equal_function_name,
+         'return autojson_table_equal(&{0}, a, b)'),
+        ('void {0}(struct {1} *this)', struct_free_function_name,
+         'autojson_table_free(&{0}, this)'),
+    ]
+    h_module.stmt('extern const struct autojson_struct {0}'.format(descriptor))
+    for signature, name_function, _ in functions:
+        h_module.stmt(signature.format(name_function(s), s.displayname))
+    if s.location.file.name != main_filename:
+        return
+
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+    fields = _serialized_fields(s)
+    if fields:
+        with C_BLOCK('static const struct autojson_field {0}_fields[] ='.format(s.spelling), suffix = '};'):
+            for f in fields:
+                C_STMT(_table_field(s, f), suffix = ',')
+
+    C_STMT('const struct autojson_struct {0} = {{"{1}", sizeof(struct {1}), {2}, {3}}}'.format(
+        descriptor, s.spelling, len(fields), '{0}_fields'.format(s.spelling) if fields else 'NULL'))
+    for signature, name_function, body in functions:
+        with C_BLOCK(signature.format(name_function(s), s.displayname)):
+            C_STMT(body.format(descriptor))
+
+def _numpy_format(ct, dtypes, py_module):
+    """The numpy.dtype format of a member of type ct, None when it has no fixed layout"""
+    if ct.kind in _numeric_kinds:
+        return "'i{0}'".format(ct.get_size())
+    elif _is_static_string(ct):
+        return "'S{0}'".format(ct.get_array_size())
+    elif _is_numeric_static_array(ct):
+        return "('i{0}', ({1},))".format(ct.get_array_element_type().get_canonical().get_size(), ct.get_array_size())
+    elif ct.kind == tk.RECORD:
+        return _generate_dtype(ct.get_declaration(), dtypes, py_module)
+    elif _is_record_static_array(ct):
+        record = _generate_dtype(_array_record_declaration(ct), dtypes, py_module)
+        return record and '({0}, ({1},))'.format(record, ct.get_array_size())
+
+    # Pointers: the records only hold addresses
+    return None
+
+def _generate_dtype(s, dtypes, py_module):
+    """Emits the dtype of s, after those of the structures it contains. Returns its name, None if s
+    has no fixed layout. dtypes remembers what was emitted, by structure."""
+    if s.spelling in dtypes:
+        return dtypes[s.spelling]
+
+    dtypes[s.spelling] = None
+    fields = _serialized_fields(s)
+    formats = []
+    for f in fields:
+        numpy_format = _numpy_format(f.type.get_canonical(), dtypes, py_module)
+        if numpy_format is None:
+            py_module.stmt('# struct {0}: {1} has no fixed layout'.format(s.spelling, f.spelling), suffix = '')
+            return None
+        formats.append(numpy_format)
+
+    # Members that aren't serialized, and the padding, are skipped through the offsets and itemsize
+    dtypes[s.spelling] = struct_dtype_name(s)
+    py_module.stmt("{0} = np.dtype({{'names': [{1}], 'formats': [{2}], 'offsets': [{3}], 'itemsize': {4}}})".format(
+        struct_dtype_name(s), ', '.join("'{0}'".format(f.displayname) for f in fields), ', '.join(formats),
+        ', '.join(str(s.type.get_offset(f.spelling) // 8) for f in fields), s.type.get_size()), suffix = '')
+    return dtypes[s.spelling]
+
+def _generate_numpy_module(input, structs, py_module):
+    """--numpy-module: a numpy.dtype per fixed layout structure and its JSON lines writer"""
+    py_module.stmt('# numpy.dtype of the JSONABLE structures in {0}, generated by autojson.py'.format(input),
+                   suffix = '')
+    py_module.stmt('import numpy as np', suffix = '')
+    py_module.stmt('import autojson_numpy', suffix = '')
+    dtypes = {}
+    for s in structs.itervalues():
+        py_module.sep()
+        dtype = _generate_dtype(s, dtypes, py_module)
+        if dtype is None:
+            continue
 
+        with py_module.block('def {0}(buf):'.format(struct_numpy_lines_function_name(s)), prefix = '', suffix = ''):
+            py_module.stmt('"""The struct {0} records in buf as the JSON lines {1}() writes"""'.format(
+                s.spelling, struct_lines_writer_function_name(s)), suffix = '')
+            py_module.stmt('return autojson_numpy.records_to_json_lines(buf, {0})'.format(dtype), suffix = '')
 
-def _generate_serializer(main_filename, s, c_module, h_module):
+    py_module.sep()
+
+def _generate_serializer(main_filename, s, c_module, h_module, options):
     function_name = 'json_t *{0}(const struct {1} *this)'.format(struct_serializer_function_name(s),
                                                                   s.displayname)
     h_module.stmt("{0}", function_name)
     if s.location.file.name != main_filename:
         return
 
-    with c_module.block(function_name):
+    with _public_function(c_module, s, options, function_name, struct_serializer_function_name):
         recursively__generate_serializer(s, c_module)
 
 
+def _generate_writer(main_filename, s, c_module, h_module, options):
+    function_name = 'int {0}(const struct {1} *this, struct autojson_buf *buf)'.format(struct_writer_function_name(s),
+                                                                                        s.displayname)
+    h_module.stmt(function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    with _public_function(c_module, s, options, function_name, struct_writer_function_name, 'buf'):
+        recursively__generate_writer(s, _JsonWriter(c_module))
+
+
+def _parallel_item_writer_name(f):
+    return '{0}_{1}_write_item'.format(f.semantic_parent.spelling, f.spelling)
+
+def _generate_parallel_writer(main_filename, s, c_module, h_module):
+    """A _write_json that splits long lists across the threads of a struct autojson_pool"""
+    function_name = 'int {0}(const struct {1} *this, struct autojson_buf *buf, struct autojson_pool *pool)'.format(
+        struct_parallel_writer_function_name(s), s.displayname)
+    h_module.stmt(function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    # The pool only knows the items as const void *
+    for f in _serialized_fields(s):
+        ct = f.type.get_canonical()
+        if _is_var_array(ct):
+            sd = ct.get_pointee().get_pointee().get_declaration()
+            with c_module.block('static int {0}(const void *item, struct autojson_buf *buf)'.format(
+                    _parallel_item_writer_name(f))):
+                c_module.stmt('return {0}(item, buf)'.format(struct_writer_function_name(sd)))
+
+    with c_module.block(function_name):
+        recursively__generate_writer(s, _JsonWriter(c_module), parallel = True)
+
+def _generate_bulk_writers(main_filename, s, c_module, h_module, options):
+    """Writers for many records at once: a JSON array and newline delimited JSON"""
+    array_function_name = 'int {0}(const struct {1} *items, size_t n, struct autojson_buf *buf)'.format(
+        struct_array_writer_function_name(s), s.displayname)
+    lines_function_name = 'int {0}(const struct {1} *items, size_t n, struct autojson_buf *buf)'.format(
+        struct_lines_writer_function_name(s), s.displayname)
+    h_module.stmt(array_function_name)
+    h_module.stmt(lines_function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+    with _public_function(c_module, s, options, array_function_name, struct_array_writer_function_name, 'buf'):
+        C_STMT("autojson_buf_putc(buf, '[')")
+        with C_BLOCK('for (size_t i = 0; i < n; i++)'):
+            C_STMT("if (0 != i) autojson_buf_putc(buf, ',')")
+            C_STMT('{0}(&items[i], buf)'.format(struct_writer_function_name(s)))
+
+        C_STMT("autojson_buf_putc(buf, ']')")
+        C_STMT('return buf->error ? -1 : 0')
+
+    with _public_function(c_module, s, options, lines_function_name, struct_lines_writer_function_name, 'buf'):
+        with C_BLOCK('for (size_t i = 0; i < n; i++)'):
+            C_STMT('{0}(&items[i], buf)'.format(struct_writer_function_name(s)))
+            C_STMT(r"autojson_buf_putc(buf, '\n')")
+
+        C_STMT('return buf->error ? -1 : 0')
+
+def _generate_lines_parser(main_filename, s, c_module, h_module, options):
+    function_name = ('int {0}(const char *buf, size_t len, struct {1} *out, size_t cap, size_t *count{2}, '
+                     'struct autojson_error *err)').format(struct_lines_parser_function_name(s), s.displayname,
+                                                           _arena_parameter(options))
+    h_module.stmt(function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+    with _public_function(c_module, s, options, function_name, struct_lines_parser_function_name, 'len'):
+        # One lexer for the whole input, records only reset what they use
+        C_STMT('struct autojson_lexer lex')
+        C_STMT('autojson_lexer_init(&lex, buf, len)')
+        if options.alloc == 'arena':
+            C_STMT('lex.arena = arena')
+        C_STMT('*count = 0')
+        with C_BLOCK('while (autojson_lex_more(&lex))'):
+            C_STMT(r'if (*count == cap) { autojson_lex_fail(&lex, "too many records"); goto fail; }', suffix = '')
+            C_STMT('if (0 != {0}(&lex, &out[*count])) goto fail'.format(struct_lexer_parser_function_name(s)))
+            C_STMT('++*count')
+            C_STMT('if (0 != autojson_lex_line_end(&lex)) goto fail')
+
+        C_STMT('return 0')
+        C_STMT('fail:', suffix = '')
+        C_STMT('autojson_lex_error(&lex, err)')
+        C_STMT('return -1')
+
+
+# AUTOJSON_PUSH_SEEN_WORDS words of seen bits per frame
+_PUSH_MAX_FIELDS = 256
+
+def _push_record(f):
+    """The structure field f holds, or holds elements of, if any"""
+    ct = f.type.get_canonical()
+    if ct.kind == tk.RECORD:
+        return ct.get_declaration()
+    if _is_record_static_array(ct):
+        return _array_record_declaration(ct)
+    if _is_var_array(ct):
+        return ct.get_pointee().get_pointee().get_declaration()
+    if _count_field(f) and _counted_element(f).kind == tk.RECORD:
+        return _counted_element(f).get_declaration()
+    return None
+
+def _is_push_array(f):
+    ct = f.type.get_canonical()
+    return _is_record_static_array(ct) or _is_numeric_static_array(ct) or _is_var_array(ct) or bool(_count_field(f))
+
+def _push_parsable(s, visiting = None, too_wide = None):
+    """Borrowed strings would point into chunks the caller reuses, structures that have any get no push parser.
+
+    Neither do those with more fields than a frame has seen bits for, or
+    containing such a structure, whose name is then appended to too_wide.
+    """
+    visiting = set() if visiting is None else visiting
+    if s.spelling in visiting:
+        return True
+
+    visiting.add(s.spelling)
+    fields = _serialized_fields(s)
+    if len(fields) > _PUSH_MAX_FIELDS:
+        if too_wide is not None:
+            too_wide.append(s.spelling)
+        return False
+
+    for f in fields:
+        nested = _push_record(f)
+        if _is_borrowed(f) or (nested is not None and not _push_parsable(nested, visiting, too_wide)):
+            return False
+
+    return True
+
+def _generate_push_value(f, C_STMT, C_BLOCK):
+    """The VALUE state of field f: event begins its value"""
+    ct = f.type.get_canonical()
+    full_field_name = 'out->{0}'.format(f.spelling)
+    if ct.kind == tk.RECORD:
+        C_STMT('frame->state = AUTOJSON_PUSH_MEMBERS')
+        C_STMT('return autojson_push_enter(push, {0}, &{1}, event)'.format(
+            struct_push_handler_function_name(ct.get_declaration()), full_field_name))
+        return
+
+    if ct.kind in _numeric_kinds:
+        C_STMT('if (0 != autojson_push_integer(push, event, &value)) return -1')
+        C_STMT('{0} = value'.format(full_field_name))
+    elif _is_static_string(ct):
+        C_STMT('if (0 != autojson_push_string_copy(push, event, {0}, sizeof({0}))) return -1'.format(full_field_name))
+    elif _is_var_string(ct):
+        C_STMT('if (0 != autojson_push_string_dup(push, event, &{0})) return -1'.format(full_field_name))
+    elif _is_push_array(f):
+        C_STMT('if (0 != autojson_push_array_begin(push, event)) return -1')
+        if _is_var_array(ct):
+            C_STMT('if (NULL == ({0} = autojson_push_alloc(push, sizeof(*{0})))) return -1'.format(full_field_name))
+            C_STMT('{0}[0] = NULL'.format(full_field_name))
+        C_STMT('frame->count = frame->cap = 0')
+        C_STMT('frame->items = NULL')
+        C_STMT('frame->state = AUTOJSON_PUSH_ELEMENTS')
+        C_STMT('return 0')
+        return
+    else:
+        raise CantParseField(f.spelling)
+
+    C_STMT('frame->state = AUTOJSON_PUSH_MEMBERS')
+    C_STMT('return 0')
+
+def _generate_push_element(f, C_STMT, C_BLOCK):
+    """The ELEMENTS state of array field f: event begins an element or ends the array"""
+    ct = f.type.get_canonical()
+    full_field_name = 'out->{0}'.format(f.spelling)
+    nested = _push_record(f)
+    static = _is_record_static_array(ct) or _is_numeric_static_array(ct)
+    with C_BLOCK('if (AUTOJSON_PUSH_ARRAY_END == event)'):
+        if static:
+            C_STMT(r'if ({0} != frame->count) return autojson_push_fail(push, "too few elements")'.format(
+                ct.get_array_size()))
+        C_STMT('frame->state = AUTOJSON_PUSH_MEMBERS')
+        C_STMT('return 0')
+
+    if static:
+        C_STMT(r'if ({0} == frame->count) return autojson_push_fail(push, "too many elements")'.format(
+            ct.get_array_size()))
+        element = '{0}[frame->count]'.format(full_field_name)
+    elif _is_var_array(ct):
+        C_STMT('if (0 != autojson_push_grow_list(push, frame, (void ***) &{0}, sizeof(struct {1}))) return -1'.format(
+            full_field_name, nested.spelling))
+        C_STMT('struct {0} *items = frame->items'.format(nested.spelling))
+        C_STMT('memset(&items[frame->count], 0, sizeof(*items))')
+        element = 'items[frame->count]'
+    else:
+        count = 'out->{0}'.format(_count_field(f))
+        with C_BLOCK('if ({0} == frame->cap)'.format(count)):
+            C_STMT('void *grown = autojson_push_grow_array(push, {0}, &frame->cap, sizeof(*{0}))'.format(full_field_name))
+            C_STMT('if (NULL == grown) return -1')
+            C_STMT('{0} = grown'.format(full_field_name))
+        element = '{0}[{1}]'.format(full_field_name, count)
+        if nested is not None:
+            C_STMT('memset(&{0}, 0, sizeof({0}))'.format(element))
+
+    if nested is not None:
+        # Counted once the element's '}' is reached, see AUTOJSON_PUSH_CHILD_DONE
+        C_STMT('return autojson_push_enter(push, {0}, &{1}, event)'.format(struct_push_handler_function_name(nested),
+                                                                         element))
+    else:
+        C_STMT('if (0 != autojson_push_integer(push, event, &value)) return -1')
+        C_STMT('{0} = value'.format(element))
+        C_STMT('{0}++'.format('frame->count' if static else 'out->{0}'.format(_count_field(f))))
+        C_STMT('return 0')
+
+def _generate_push_handler(s, c_module, handler_function_name):
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+    fields = _serialized_fields(s)
+    array_fields = [f for f in fields if _is_push_array(f)]
+    arrays = [f for f in array_fields if _push_record(f) is not None]
+    dynamic = [f for f in arrays if _is_var_array(f.type.get_canonical()) or _count_field(f)]
+    with C_BLOCK(handler_function_name):
+        C_STMT('struct {0} *out = frame->out'.format(s.displayname))
+        if _needs_integer_value(fields):
+            C_STMT('long long value')
+
+        with C_BLOCK('if (AUTOJSON_PUSH_ABORT == event)'):
+            if dynamic:
+                # Elements are only reachable from out once they are complete
+                with C_BLOCK('if (AUTOJSON_PUSH_ELEMENTS == frame->state)'):
+                    with C_BLOCK('switch (frame->field)'):
+                        for f in dynamic:
+                            nested = _push_record(f)
+                            with _case(C_BLOCK, struct_field_enum_value(s, f), scope = True):
+                                if _is_var_array(f.type.get_canonical()):
+                                    C_STMT('struct {0} *items = frame->items'.format(nested.spelling))
+                                    C_STMT('if (frame->child) {0}(&items[frame->count])'.format(
+                                        struct_free_function_name(nested)))
+                                    C_STMT('if (0 == frame->count) autojson_push_release(push, items)')
+                                else:
+                                    C_STMT('if (frame->child) {0}(&out->{1}[out->{2}])'.format(
+                                        struct_free_function_name(nested), f.spelling, _count_field(f)))
+                                C_STMT('break')
+
+            with C_BLOCK('if (frame == push->frames)'):
+                C_STMT('{0}(out)'.format(struct_free_function_name(s)))
+                C_STMT('memset(out, 0, sizeof(*out))')
+            C_STMT('return 0')
+
+        with C_BLOCK('if (AUTOJSON_PUSH_CHILD_DONE == event)'):
+            if arrays:
+                with C_BLOCK('if (AUTOJSON_PUSH_ELEMENTS == frame->state)'):
+                    with C_BLOCK('switch (frame->field)'):
+                        for f in arrays:
+                            nested = _push_record(f)
+                            with _case(C_BLOCK, struct_field_enum_value(s, f), scope = True):
+                                if _is_var_array(f.type.get_canonical()):
+                                    C_STMT('struct {0} *items = frame->items'.format(nested.spelling))
+                                    C_STMT('out->{0}[frame->count] = &items[frame->count]'.format(f.spelling))
+                                    C_STMT('out->{0}[++frame->count] = NULL'.format(f.spelling))
+                                elif _count_field(f):
+                                    C_STMT('out->{0}++'.format(_count_field(f)))
+                                else:
+                                    C_STMT('frame->count++')
+                                C_STMT('break')
+            C_STMT('return 0')
+
+        with C_BLOCK('switch (frame->state)'):
+            with _case(C_BLOCK, 'AUTOJSON_PUSH_START'):
+                C_STMT(r'''if (AUTOJSON_PUSH_OBJECT_BEGIN != event) return autojson_push_fail(push, "'{' expected")''')
+                C_STMT('memset(out, 0, sizeof(*out))')
+                C_STMT('frame->state = AUTOJSON_PUSH_MEMBERS')
+                C_STMT('return 0')
+            with _case(C_BLOCK, 'AUTOJSON_PUSH_MEMBERS'):
+                C_STMT('if (AUTOJSON_PUSH_OBJECT_END == event) return autojson_push_object_end(push, frame, {0})'.format(
+                    struct_field_enum_value(s, None)))
+                C_STMT('return autojson_push_key(push, frame, {0}(push->key, push->key_len))'.format(
+                    struct_field_index_function_name(s)))
+            if fields:
+                with _case(C_BLOCK, 'AUTOJSON_PUSH_VALUE'):
+                    with C_BLOCK('switch (frame->field)'):
+                        for f in fields:
+                            with _case(C_BLOCK, struct_field_enum_value(s, f), scope = True):
+                                _generate_push_value(f, C_STMT, C_BLOCK)
+                    C_STMT('break')
+            if array_fields:
+                with _case(C_BLOCK, 'AUTOJSON_PUSH_ELEMENTS'):
+                    with C_BLOCK('switch (frame->field)'):
+                        for f in array_fields:
+                            with _case(C_BLOCK, struct_field_enum_value(s, f), scope = True):
+                                _generate_push_element(f, C_STMT, C_BLOCK)
+                    C_STMT('break')
+
+        C_STMT(r'return autojson_push_fail(push, "invalid value")')
+
+def _generate_push_parser(main_filename, s, c_module, h_module, options):
+    """<struct>_parser_init(), _feed() and _finish(), over the autojson_push tokenizer"""
+    too_wide = []
+    if not _push_parsable(s, too_wide = too_wide):
+        # Borrowing is a documented choice, a struct outgrowing the seen bits would only show as a link error
+        if too_wide and s.location.file.name == main_filename:
+            sys.stderr.write('autojson: warning: struct {0} gets no push parser: struct {1} has more than {2} '
+                             'fields\n'.format(s.spelling, too_wide[0], _PUSH_MAX_FIELDS))
+        return
+
+    parser = struct_push_parser_name(s)
+    handler_function_name = 'int {0}(struct autojson_push *push, struct autojson_push_frame *frame, int event)'.format(
+        struct_push_handler_function_name(s))
+    init_function_name = 'void {0}_init(struct {0} *ctx{1})'.format(parser, _arena_parameter(options))
+    feed_function_name = 'int {0}_feed(struct {0} *ctx, const char *chunk, size_t len)'.format(parser)
+    finish_function_name = 'int {0}_finish(struct {0} *ctx, struct {1} *out, struct autojson_error *err)'.format(
+        parser, s.displayname)
+    if s.location.file.name == main_filename:
+        with h_module.block('struct {0}'.format(parser), suffix = '};'):
+            h_module.stmt('struct autojson_push push')
+            h_module.stmt('struct {0} value'.format(s.displayname))
+
+    h_module.stmt(handler_function_name)
+    h_module.stmt(init_function_name)
+    h_module.stmt(feed_function_name)
+    h_module.stmt(finish_function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    C_STMT = c_module.stmt
+    C_BLOCK = c_module.block
+    _generate_push_handler(s, c_module, handler_function_name)
+
+    with C_BLOCK(init_function_name):
+        C_STMT('memset(&ctx->value, 0, sizeof(ctx->value))')
+        C_STMT('autojson_push_init(&ctx->push, {0}, &ctx->value, {1})'.format(
+            struct_push_handler_function_name(s), 'arena' if options.alloc == 'arena' else 'NULL'))
+
+    with C_BLOCK(feed_function_name):
+        C_STMT('return autojson_push_feed(&ctx->push, chunk, len)')
+
+    with C_BLOCK(finish_function_name):
+        # A failed parse has already released and zeroed ctx->value
+        C_STMT('int rc = autojson_push_finish(&ctx->push, err)')
+        C_STMT('*out = ctx->value')
+        C_STMT('return rc')
+
+
+def _generate_json_size(main_filename, s, c_module, h_module):
+    function_name = 'size_t {0}(const struct {1} *this)'.format(struct_json_size_function_name(s), s.displayname)
+    h_module.stmt(function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    with c_module.block(function_name):
+        recursively__generate_json_size(s, c_module)
+
+
+def _generate_msgpack_writer(main_filename, s, c_module, h_module, options):
+    function_name = 'int {0}(const struct {1} *this, struct autojson_buf *buf)'.format(
+        struct_msgpack_writer_function_name(s), s.displayname)
+    h_module.stmt(function_name)
+    if s.location.file.name != main_filename:
+        return
+
+    with _public_function(c_module, s, options, function_name, struct_msgpack_writer_function_name, 'buf'):
+        recursively__generate_msgpack_writer(s, _BufWriter(c_module))
+
+
 def _add_include(module, filename):
     module.stmt('#include {0}'.format(filename), suffix = '')
 
@@ -448,12 +2710,18 @@ def _add_base_includes(module):
     for include in includes:
         _add_include(module, include)
 
-def _init_h_module(input, h_file):
+def _init_h_module(input, h_file, options):
     m = Module()
     h_name = '__{0}_JSON_AUTO__'.format(os.path.basename(input).replace('.', '_').upper())
     m.stmt('#ifndef {0}'.format(h_name), suffix = '')
     m.stmt('#define {0}'.format(h_name), suffix = '')
     _add_base_includes(m)
+    if ('direct' in options.backends or 'msgpack' in options.backends or options.alloc == 'arena' or
+        options.instrument):
+        _add_include(m, _quote('autojson_runtime.h'))
+    if options.mode == 'tables':
+        _add_include(m, '<stddef.h>')
+        _add_include(m, _quote('autojson_tables.h'))
     _add_include(m, _quote(input))
 
 
@@ -468,33 +2736,333 @@ def _init_c_module(input, h_output):
     m.stmt('#include "{0}"'.format(input), suffix = '')
     m.stmt('#include "{0}"'.format(h_output), suffix = '')
     _add_base_includes(m)
+    # Set once the first _from_json_reuse parser has pulled in AUTOJSON_USABLE_SIZE()
+    m.reuse_parsers = False
 
     return m
 
-def _generate_code(input, c_module, h_module):
+_clang_args = ["-C"]
+
+def _generate_code(input, c_module, h_module, options, profile = None, py_module = None):
+    """Generates the bindings, and the --numpy-module into py_module if given.
+    Returns every file the input pulled in"""
+    profile = profile or _StartupProfile(False)
+    _load_clang()
     i = cindex.Index.create()
-    t = i.parse(input, args = ["-C"])
+    t = i.parse(input, args = _clang_args)
     main_filename = t.spelling
+    backends = options.backends
+    # --batch generates several headers in one process, where the same USR can name different structs
+    _field_kinds.clear()
+    _companion_fields.clear()
+    profile.step('parse')
+
+    dependencies = [main_filename] + [inclusion.include.name for inclusion in t.get_includes()]
+    structs = _get_jsonable_structs(t.cursor, input)
+    profile.step('walk')
+    for struct in structs.itervalues():
+        # Structs from other headers are only referenced, but their layout still shapes our code
+        if struct.location.file is not None:
+            dependencies.append(struct.location.file.name)
+
+        if options.mode == 'tables':
+            _generate_tables(main_filename, struct, c_module, h_module)
+            continue
 
-    for struct in _get_jsonable_structs(t.cursor, input).itervalues():
-        _generate_serializer(main_filename, struct, c_module, h_module)
-        _generate_parser(main_filename, struct, c_module, h_module)
+        _generate_stats(main_filename, struct, c_module, options)
+        _generate_field_index(main_filename, struct, c_module, h_module)
+        _generate_equal(main_filename, struct, c_module, h_module)
+        if 'jansson' in backends:
+            _generate_serializer(main_filename, struct, c_module, h_module, options)
+            _generate_parser(main_filename, struct, c_module, h_module, options)
+            _generate_reuse_parser(main_filename, struct, c_module, h_module, options)
+            _generate_projection_parser(main_filename, struct, c_module, h_module, options)
+            _generate_diff_serializer(main_filename, struct, c_module, h_module)
+            _generate_patch_parser(main_filename, struct, c_module, h_module, options)
+        if 'direct' in backends:
+            _generate_writer(main_filename, struct, c_module, h_module, options)
+            _generate_json_size(main_filename, struct, c_module, h_module)
+            _generate_stream_parser(main_filename, struct, c_module, h_module, options)
+            _generate_bulk_writers(main_filename, struct, c_module, h_module, options)
+            if options.parallel:
+                _generate_parallel_writer(main_filename, struct, c_module, h_module)
+            _generate_lines_parser(main_filename, struct, c_module, h_module, options)
+            _generate_push_parser(main_filename, struct, c_module, h_module, options)
+        if 'msgpack' in backends:
+            _generate_msgpack_writer(main_filename, struct, c_module, h_module, options)
+            _generate_msgpack_parser(main_filename, struct, c_module, h_module, options)
+        _generate_free(main_filename, struct, c_module, h_module, options)
+
+    if py_module is not None:
+        _generate_numpy_module(input, structs, py_module)
+    profile.step('emit')
+    return _unique(dependencies)
+
+def _unique(items):
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
+
+def _depfile_escape(filename):
+    return filename.replace(' ', '\\ ').replace('#', '\\#').replace('$', '$$')
+
+def _write_depfile(depfile, targets, dependencies):
+    """Make/Ninja dependency file listing every header the targets were generated from"""
+    lines = [' '.join(_depfile_escape(target) for target in targets) + ':']
+    lines += [' ' + _depfile_escape(dependency) for dependency in dependencies]
+    file(depfile, "wb").write(' \\\n'.join(lines) + '\n')
+
+def _file_digest(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+def _generator_version():
+    sources = [os.path.splitext(module.__file__)[0] + '.py' for module in (sys.modules[__name__], clike)]
+    return [_file_digest(source) for source in sources]
+
+def _cache_manifest_path(cache_dir, input, h_output, c_output, options, numpy_output = None):
+    """Where the cache entry for this exact invocation lives.
+
+    Everything that affects the generated code except the contents of
+    the input and of the files it includes goes into the name; those are
+    recorded in the entry itself, see _cache_restore(). --interface-only
+    runs share the entry of full runs, the header they write is the same.
+    """
+    options = options._replace(backends = sorted(options.backends))
+    key = json.dumps([_generator_version(), _clang_args, os.path.abspath(input),
+                      os.path.abspath(h_output), os.path.abspath(c_output),
+                      numpy_output and os.path.abspath(numpy_output), options._asdict()],
+                     sort_keys = True)
+    return os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + '.json')
+
+def _cache_blob_path(cache_dir, digest):
+    return os.path.join(cache_dir, digest + '.out')
+
+def _cache_restore(manifest_path, outputs):
+    """Brings outputs up to date from the cache, returns the dependencies or None on a miss"""
+    try:
+        with open(manifest_path, 'rb') as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    for filename, digest in manifest['dependencies']:
+        if _file_digest(filename) != digest:
+            return None
+
+    cache_dir = os.path.dirname(manifest_path)
+    stale = []
+    for output in outputs:
+        digest = manifest['outputs'][os.path.abspath(output)]
+        if _file_digest(output) != digest:
+            if not os.path.exists(_cache_blob_path(cache_dir, digest)):
+                return None
+            stale.append((output, digest))
+
+    for output, digest in stale:
+        _atomic_write(output, file(_cache_blob_path(cache_dir, digest), "rb").read())
+
+    return [filename for filename, _ in manifest['dependencies']]
+
+def _cache_store(manifest_path, dependencies, modules, written):
+    """Records a run. written maps the outputs that are already on disk to
+    their digests, the other modules are rendered straight into the cache."""
+    cache_dir = os.path.dirname(manifest_path)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+
+    outputs = {}
+    for output, module in modules.iteritems():
+        if output in written:
+            digest = written[output]
+            if not os.path.exists(_cache_blob_path(cache_dir, digest)):
+                with open(output, 'rb') as f:
+                    _atomic_write(_cache_blob_path(cache_dir, digest), f)
+        else:
+            fd, tmp_path = tempfile.mkstemp(dir = cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                digest = _write_module(module, f)
+            os.rename(tmp_path, _cache_blob_path(cache_dir, digest))
+
+        outputs[os.path.abspath(output)] = digest
+
+    manifest = {'dependencies': [(os.path.abspath(dependency), _file_digest(dependency))
+                                 for dependency in dependencies],
+                'outputs': outputs}
+    _atomic_write(manifest_path, json.dumps(manifest, sort_keys = True))
+
+def _atomic_write(path, data):
+    """Writes data, a string or a file to copy, to path"""
+    # Concurrent generators may share the cache, never leave half a file
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path) or '.')
+    with os.fdopen(fd, 'wb') as f:
+        if isinstance(data, str):
+            f.write(data)
+        else:
+            shutil.copyfileobj(data, f)
+    os.rename(tmp_path, path)
+
+class _DigestFile(object):
+    """Passes writes on to f, hashing them on the way"""
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.f.write(data)
+
+def _write_module(module, f):
+    """Streams the rendered module into f, returns the digest of what was written"""
+    f = _DigestFile(f)
+    module.write(f)
+    return f.sha1.hexdigest()
+
+class _StartupProfile(object):
+    """Wall clock time of every step of a run, for --profile-startup"""
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.steps = [('imports', time.time() - _start_time)]
+        self.last = time.time()
+
+    def step(self, name):
+        now = time.time()
+        self.steps.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        if not self.enabled:
+            return
+
+        self.steps.append(('total', time.time() - _start_time))
+        for name, seconds in self.steps:
+            sys.stderr.write('autojson: {0:<10} {1:8.1f} ms\n'.format(name, seconds * 1000))
+        sys.stderr.write('autojson: libclang {0}loaded\n'.format('' if cindex is not None else 'not '))
+
+def _generate_files(input, h_output, c_output, interface_only, options, cache_dir, depfile = None,
+                    profile = None, numpy_output = None):
+    """Writes the bindings for one header, returns False when the cache had them"""
+    profile = profile or _StartupProfile(False)
+    targets = [h_output] if interface_only else [h_output, c_output]
+    if numpy_output:
+        targets.append(numpy_output)
+    if cache_dir:
+        manifest_path = _cache_manifest_path(cache_dir, input, h_output, c_output, options, numpy_output)
+        dependencies = _cache_restore(manifest_path, targets)
+        profile.step('cache')
+        if dependencies is not None:
+            if depfile:
+                _write_depfile(depfile, targets, dependencies)
+            return False
+
+    c_module = _init_c_module(input, h_output)
+    h_module, h_name = _init_h_module(input, h_output, options)
+    py_module = Module() if numpy_output else None
+    dependencies = _generate_code(input, c_module, h_module, options, profile, py_module)
+    _fini_h_module(h_module, h_name)
+    modules = {h_output: h_module, c_output: c_module}
+    if numpy_output:
+        modules[numpy_output] = py_module
+
+    # Rendered line by line, the text of a large header is never held in memory
+    written = {}
+    for output in targets:
+        with open(output, "wb") as f:
+            written[output] = _write_module(modules[output], f)
+
+    if depfile:
+        _write_depfile(depfile, targets, dependencies)
+
+    if cache_dir:
+        _cache_store(manifest_path, dependencies, modules, written)
+
+    profile.step('write')
+    return True
+
+def generator_options(f):
+    """The options shared by every command that generates bindings"""
+    decorators = [
+        click.option('--interface-only', default=False, is_flag=True),
+        click.option('--backend', 'backends', multiple=True, default=['jansson'],
+                     type=click.Choice(['jansson', 'direct', 'msgpack']),
+                     help='Bindings to generate, may be given more than once. '
+                     '"direct" writes and parses JSON text straight from and into '
+                     'the structures without building a json_t tree, "msgpack" '
+                     'does the same with MessagePack.'),
+        click.option('--key-dispatch', default=False, is_flag=True,
+                     help='Make the jansson _from_json walk each object once, mapping '
+                     'keys to fields with the generated <struct>_field_index(), '
+                     'instead of looking every field up through json_unpack_ex.'),
+        click.option('--alloc', default='malloc', type=click.Choice(['malloc', 'arena']),
+                     help='With "arena", parsers take a struct autojson_arena and '
+                     'place every string and array in it; _free does nothing and '
+                     'the arena is released as a whole.'),
+        click.option('--instrument', default=False, is_flag=True,
+                     help='Count the calls, failures, bytes and allocations of '
+                     'every generated entry point, per structure. The counters are '
+                     'only compiled in with -DAUTOJSON_STATS, see '
+                     'autojson_stats_foreach().'),
+        click.option('--parallel', default=False, is_flag=True,
+                     help='With the direct backend, also generate '
+                     '<struct>_write_json_parallel(), which writes long lists on '
+                     'the threads of a struct autojson_pool.'),
+        click.option('--mode', default='unrolled', type=click.Choice(['unrolled', 'tables']),
+                     help='With "tables", emit a constant descriptor of every '
+                     'structure\'s fields instead of unrolled code, and implement '
+                     '_to_json, _from_json, _equal and _free with the shared engine '
+                     'in autojson_tables.c. Only the jansson backend supports it.'),
+        click.option('--cache-dir', envvar='AUTOJSON_CACHE_DIR', type=click.Path(file_okay=False),
+                     help='Remember the inputs of every run here and skip parsing '
+                     'and writing altogether when neither the header, the files it '
+                     'includes, the options nor cautojson itself changed.'),
+    ]
+    for decorator in reversed(decorators):
+        f = decorator(f)
+
+    return f
+
+def check_options(options):
+    """Rejects combinations of generator options that can't be honored"""
+    if options.mode == 'tables':
+        unsupported = [name for name, used in [('--backend direct', 'direct' in options.backends),
+                                               ('--backend msgpack', 'msgpack' in options.backends),
+                                               ('--key-dispatch', options.key_dispatch),
+                                               ('--alloc arena', options.alloc == 'arena'),
+                                               ('--instrument', options.instrument),
+                                               ('--parallel', options.parallel)] if used]
+        if unsupported:
+            raise click.UsageError('--mode=tables does not support {0}'.format(', '.join(unsupported)))
 
 @click.command()
 @click.argument('input', type=click.Path())
 @click.argument('h_output')
 @click.argument('c_output')
-@click.option('--interface-only', default=False, is_flag=True)
-def generate_code(interface_only, input, h_output, c_output):
-    c_module = _init_c_module(input, h_output)
-    h_module, h_name = _init_h_module(input, h_output)
-    _generate_code(input, c_module, h_module)
-
-    _fini_h_module(h_module, h_name)
-    if not interface_only:
-        file(c_output, "wb").write(c_module.render())
-
-    file(h_output, "wb").write(h_module.render())
+@click.option('--depfile', type=click.Path(dir_okay=False),
+              help='Also write a Make/Ninja dependency file naming the outputs '
+              'and every header they were generated from.')
+@click.option('--numpy-module', type=click.Path(dir_okay=False),
+              help='Also write a Python module with a numpy.dtype of every '
+              'JSONABLE structure without pointer members, and a '
+              '<struct>_to_json_lines(buf) that formats raw arrays of them '
+              'column by column. It needs autojson_numpy.py.')
+@click.option('--profile-startup', default=False, is_flag=True,
+              help='Report how long importing, consulting the cache, parsing, '
+              'finding the JSONABLE structs, generating and writing took on stderr.')
+@generator_options
+def generate_code(interface_only, input, h_output, c_output, depfile, numpy_module, profile_startup,
+                  backends, key_dispatch, alloc, instrument, parallel, mode, cache_dir):
+    profile = _StartupProfile(profile_startup)
+    options = GeneratorOptions(backends = backends, key_dispatch = key_dispatch, alloc = alloc,
+                               instrument = instrument, parallel = parallel, mode = mode)
+    check_options(options)
+    _generate_files(input, h_output, c_output, interface_only, options, cache_dir, depfile, profile, numpy_module)
+    profile.report()
 
 if __name__ == '__main__':
     generate_code()
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+
+##############################################################################
+#
+# Copyright 2014, Yotam Rubin <yotam@wizery.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+"""Generates the bindings of many headers from a single process.
+
+Starting the interpreter and loading libclang costs more than generating
+the code for a typical header, so instead of running autojson.py once per
+header this parses every header in a pool of worker processes that are
+started once.
+"""
+
+import sys
+import os
+import traceback
+import multiprocessing
+import click
+import autojson
+from autojson import GeneratorOptions
+
+def _output_names(input, output_dir):
+    base = os.path.splitext(os.path.basename(input))[0]
+    if output_dir is None:
+        output_dir = os.path.dirname(input)
+
+    return (os.path.join(output_dir, base + '_auto.h'),
+            os.path.join(output_dir, base + '_auto.c'))
+
+def _read_manifest(manifest, output_dir):
+    """One header per line, optionally followed by its H_OUTPUT and C_OUTPUT"""
+    jobs = []
+    for line_number, line in enumerate(manifest, 1):
+        words = line.split('#', 1)[0].split()
+        if not words:
+            continue
+
+        if len(words) == 1:
+            jobs.append((words[0],) + _output_names(words[0], output_dir))
+        elif len(words) == 3:
+            jobs.append(tuple(words))
+        else:
+            raise click.BadParameter('line {0}: expected INPUT [H_OUTPUT C_OUTPUT]'.format(line_number),
+                                     param_hint = '--manifest')
+
+    return jobs
+
+def _generate_job(job):
+    """Runs in the worker processes, returns (input, generated, error)"""
+    input, h_output, c_output, interface_only, options, cache_dir, depfile = job
+    try:
+        return input, autojson._generate_files(input, h_output, c_output, interface_only, options,
+                                               cache_dir, depfile), None
+    except Exception:
+        return input, False, traceback.format_exc()
+
+@click.command()
+@click.argument('inputs', nargs=-1, type=click.Path())
+@click.option('--manifest', type=click.File('rb'),
+              help='File listing the headers to generate, one per line, each '
+              'optionally followed by its H_OUTPUT and C_OUTPUT.')
+@click.option('-o', '--output-dir', type=click.Path(file_okay=False),
+              help='Where to write <header>_auto.h and <header>_auto.c, '
+              'next to each header by default.')
+@click.option('-j', '--jobs', type=click.IntRange(1, None), default=None,
+              help='Worker processes, one per CPU by default.')
+@click.option('--depfiles', default=False, is_flag=True,
+              help='Write a Make/Ninja dependency file next to every H_OUTPUT, '
+              'with its extension replaced by .d.')
+@click.option('-v', '--verbose', default=False, is_flag=True)
+@autojson.generator_options
+def generate_batch(inputs, manifest, output_dir, jobs, depfiles, verbose,
+                   interface_only, backends, key_dispatch, alloc, instrument, parallel, mode, cache_dir):
+    options = GeneratorOptions(backends = backends, key_dispatch = key_dispatch, alloc = alloc,
+                               instrument = instrument, parallel = parallel, mode = mode)
+    autojson.check_options(options)
+    triples = [(input,) + _output_names(input, output_dir) for input in inputs]
+    if manifest is not None:
+        triples += _read_manifest(manifest, output_dir)
+
+    outputs = [output for _, h_output, c_output in triples for output in (h_output, c_output)]
+    if len(set(outputs)) != len(outputs):
+        raise click.UsageError('several headers would be written to the same output')
+
+    if output_dir is not None and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    work = [triple + (interface_only, options, cache_dir,
+                      os.path.splitext(triple[1])[0] + '.d' if depfiles else None)
+            for triple in triples]
+    jobs = min(jobs or multiprocessing.cpu_count(), len(work))
+    if jobs <= 1:
+        results = map(_generate_job, work)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_generate_job, work)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    failed = 0
+    for input, generated, error in results:
+        if error is not None:
+            failed += 1
+            click.echo('{0}: generation failed\n{1}'.format(input, error), err = True)
+        elif verbose:
+            click.echo('{0}: {1}'.format(input, 'generated' if generated else 'up to date'))
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    generate_batch()
@@ -0,0 +1,110 @@
+##############################################################################
+#
+# Copyright 2014, Yotam Rubin <yotam@wizery.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+"""Support code for the modules autojson.py generates with --numpy-module.
+
+Those modules describe every fixed layout JSONABLE structure with a
+numpy.dtype; records_to_json_lines() turns a buffer of such records into
+the same bytes <struct>_write_json_lines() writes in C. It works a column
+at a time, formatting every record's value of a field with one numpy
+operation, and never runs Python code per record.
+"""
+
+import struct
+import numpy as np
+
+# Ordered like autojson_buf_put_stringn(): backslashes first, so the escapes aren't escaped again
+_ESCAPES = ([(b'\\', b'\\\\'), (b'"', b'\\"'), (b'\b', b'\\b'), (b'\f', b'\\f'), (b'\n', b'\\n'),
+             (b'\r', b'\\r'), (b'\t', b'\\t')] +
+            [(struct.pack('B', c), '\\u{0:04X}'.format(c).encode('ascii'))
+             for c in range(1, 0x20) if c not in (0x08, 0x09, 0x0a, 0x0c, 0x0d)])
+
+def _escape(strings):
+    """The JSON string bodies of a column of char[N] values"""
+    # Most char[N] members hold much less than N bytes, work on no more than the longest value
+    width = max(1, int(np.char.str_len(strings).max())) if len(strings) else 1
+    strings = strings.astype(np.dtype((np.bytes_, width)))
+    raw = strings.view(np.uint8).reshape(len(strings), width)
+
+    # Like the C writers, stop at the first NUL
+    nul = raw == 0
+    if nul.any():
+        raw[np.logical_or.accumulate(nul, axis = 1)] = 0
+    special = ((raw < 0x20) & (raw != 0)) | (raw == ord('"')) | (raw == ord('\\'))
+    rows = special.any(axis = 1)
+    if not rows.any():
+        return strings
+
+    # Only the few values that need escaping go through the (slower) replacements
+    escaped = strings[rows]
+    for character, sequence in _ESCAPES:
+        escaped = np.char.replace(escaped, character, sequence)
+
+    strings = strings.astype(np.dtype((np.bytes_, max(width, escaped.dtype.itemsize))))
+    strings[rows] = escaped
+    return strings
+
+def _pieces(column, dtype):
+    """The JSON text of a column, as constant bytes and per record byte string arrays"""
+    if dtype.names is not None:
+        yield b'{'
+        for i, name in enumerate(dtype.names):
+            yield (b',"' if i else b'"') + name.encode('ascii') + b'":'
+            for piece in _pieces(column[name], dtype.fields[name][0]):
+                yield piece
+        yield b'}'
+    elif dtype.subdtype is not None:
+        base, shape = dtype.subdtype
+        yield b'['
+        for i in range(shape[0]):
+            if i:
+                yield b','
+            for piece in _pieces(column[:, i], base):
+                yield piece
+        yield b']'
+    elif dtype.kind == 'S':
+        yield b'"'
+        yield _escape(column)
+        yield b'"'
+    else:
+        yield column.astype('S20')
+
+def _chunk_to_json_lines(records):
+    columns = [np.zeros(len(records), dtype = 'S1')]
+    for piece in _pieces(records, records.dtype):
+        if isinstance(piece, bytes) and isinstance(columns[-1], bytes):
+            columns[-1] += piece
+        else:
+            columns.append(piece)
+    columns.append(b'\n')
+
+    # Joined pairwise, every byte is copied log(columns) times instead of once per column
+    while len(columns) > 1:
+        columns = [np.char.add(columns[i], columns[i + 1]) if i + 1 < len(columns) else columns[i]
+                   for i in range(0, len(columns), 2)]
+
+    return b''.join(columns[0].tolist())
+
+def records_to_json_lines(buf, dtype, chunk = 65536):
+    """Every record of dtype in buf (bytes, a memoryview, an mmap or an array) as newline terminated JSON.
+
+    Records are formatted chunk at a time, which bounds the memory the
+    intermediate columns take whatever the size of buf.
+    """
+    records = np.frombuffer(buf, dtype = dtype)
+    return b''.join(_chunk_to_json_lines(records[start:start + chunk])
+                    for start in range(0, len(records), chunk))
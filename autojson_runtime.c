@@ -0,0 +1,2131 @@
+#include "autojson_runtime.h"
+#include <stdio.h>
+#include <stdlib.h>
+#include <errno.h>
+#include <time.h>
+#include <pthread.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+#define AUTOJSON_BUF_MIN_CAPACITY 256
+
+void autojson_buf_init(struct autojson_buf *buf)
+{
+    buf->data = NULL;
+    buf->len = 0;
+    buf->cap = 0;
+    buf->owned = 1;
+    buf->error = 0;
+}
+
+void autojson_buf_init_static(struct autojson_buf *buf, char *storage, size_t cap)
+{
+    buf->data = storage;
+    buf->len = 0;
+    buf->cap = cap;
+    buf->owned = 0;
+    buf->error = 0;
+}
+
+void autojson_buf_fini(struct autojson_buf *buf)
+{
+    if (buf->owned) {
+        free(buf->data);
+    }
+
+    autojson_buf_init(buf);
+}
+
+int autojson_buf_grow(struct autojson_buf *buf, size_t extra)
+{
+    if (buf->error) {
+        return -1;
+    }
+
+    size_t cap = buf->cap ? buf->cap : AUTOJSON_BUF_MIN_CAPACITY;
+    while (cap - buf->len < extra) {
+        if (cap > ((size_t) -1) / 2) {
+            buf->error = 1;
+            return -1;
+        }
+
+        cap *= 2;
+    }
+
+    char *data;
+    if (buf->owned) {
+        data = (char *) realloc(buf->data, cap);
+    } else {
+        data = (char *) malloc(cap);
+        if (NULL != data && buf->len) {
+            memcpy(data, buf->data, buf->len);
+        }
+    }
+
+    if (NULL == data) {
+        buf->error = 1;
+        return -1;
+    }
+
+    buf->data = data;
+    buf->cap = cap;
+    buf->owned = 1;
+    return 0;
+}
+
+void autojson_buf_put_integer(struct autojson_buf *buf, long long value)
+{
+    char digits[24];
+    char *p = digits + sizeof(digits);
+    unsigned long long magnitude = value < 0 ? 0ULL - (unsigned long long) value : (unsigned long long) value;
+
+    do {
+        *--p = '0' + (magnitude % 10);
+        magnitude /= 10;
+    } while (magnitude);
+
+    if (value < 0) {
+        *--p = '-';
+    }
+
+    autojson_buf_put(buf, p, digits + sizeof(digits) - p);
+}
+
+/* Escapes exactly the characters jansson's json_dumps() escapes */
+void autojson_buf_put_stringn(struct autojson_buf *buf, const char *s, size_t len)
+{
+    static const char hex[] = "0123456789ABCDEF";
+    const char *end = s + len;
+    const char *run = s;
+
+    autojson_buf_putc(buf, '"');
+    for (; s < end; s++) {
+        unsigned char c = *s;
+        if (c >= 0x20 && c != '"' && c != '\\') {
+            continue;
+        }
+
+        autojson_buf_put(buf, run, s - run);
+        run = s + 1;
+        switch (c) {
+        case '"': autojson_buf_put(buf, "\\\"", 2); break;
+        case '\\': autojson_buf_put(buf, "\\\\", 2); break;
+        case '\b': autojson_buf_put(buf, "\\b", 2); break;
+        case '\f': autojson_buf_put(buf, "\\f", 2); break;
+        case '\n': autojson_buf_put(buf, "\\n", 2); break;
+        case '\r': autojson_buf_put(buf, "\\r", 2); break;
+        case '\t': autojson_buf_put(buf, "\\t", 2); break;
+        default: {
+            char escape[6] = {'\\', 'u', '0', '0', hex[c >> 4], hex[c & 0xf]};
+            autojson_buf_put(buf, escape, sizeof(escape));
+        }
+        }
+    }
+
+    autojson_buf_put(buf, run, s - run);
+    autojson_buf_putc(buf, '"');
+}
+
+size_t autojson_integer_json_size(long long value)
+{
+    unsigned long long magnitude = value < 0 ? 0ULL - (unsigned long long) value : (unsigned long long) value;
+    size_t size = value < 0 ? 2 : 1;
+
+    while (magnitude >= 10) {
+        magnitude /= 10;
+        size++;
+    }
+
+    return size;
+}
+
+size_t autojson_string_json_size(const char *s, size_t len)
+{
+    const char *end = s + len;
+    size_t size = len + 2;
+
+    for (; s < end; s++) {
+        unsigned char c = *s;
+        if (c >= 0x20 && c != '"' && c != '\\') {
+            continue;
+        }
+
+        switch (c) {
+        case '"': case '\\': case '\b': case '\f': case '\n': case '\r': case '\t':
+            size += 1;
+            break;
+        default:
+            size += 5;
+        }
+    }
+
+    return size;
+}
+
+#define AUTOJSON_MAX_DEPTH 2048
+
+void autojson_lexer_init(struct autojson_lexer *lex, const char *buf, size_t len)
+{
+    lex->start = buf;
+    lex->p = buf;
+    lex->end = buf + len;
+    lex->error = NULL;
+    lex->error_position = 0;
+    lex->arena = NULL;
+}
+
+void *autojson_lex_alloc(struct autojson_lexer *lex, size_t size)
+{
+    void *p = AUTOJSON_STATS_ALLOC(lex->arena ? autojson_arena_alloc(lex->arena, size) : malloc(size));
+    if (NULL == p) {
+        autojson_lex_fail(lex, "out of memory");
+    }
+
+    return p;
+}
+
+void autojson_lex_release(struct autojson_lexer *lex, void *p)
+{
+    if (NULL == lex->arena) {
+        free(p);
+    }
+}
+
+/* Doubles the capacity of items, returns NULL on failure */
+static void *grow_array(struct autojson_arena *arena, void *items, size_t *cap, size_t elem_size)
+{
+    size_t new_cap = *cap ? *cap * 2 : 4;
+    void *grown = NULL;
+
+    if (new_cap <= ((size_t) -1) / elem_size) {
+        if (NULL == arena) {
+            grown = AUTOJSON_STATS_ALLOC(realloc(items, new_cap * elem_size));
+        } else if (NULL != (grown = AUTOJSON_STATS_ALLOC(autojson_arena_alloc(arena, new_cap * elem_size))) &&
+                   *cap) {
+            /* The old copy stays in the arena until it is reset */
+            memcpy(grown, items, *cap * elem_size);
+        }
+    }
+
+    if (NULL != grown) {
+        *cap = new_cap;
+    }
+
+    return grown;
+}
+
+void *autojson_lex_grow_array(struct autojson_lexer *lex, void *items, size_t *cap, size_t elem_size)
+{
+    void *grown = grow_array(lex->arena, items, cap, elem_size);
+    if (NULL == grown) {
+        autojson_lex_fail(lex, "out of memory");
+    }
+
+    return grown;
+}
+
+int autojson_lex_fail(struct autojson_lexer *lex, const char *text)
+{
+    if (NULL == lex->error) {
+        lex->error = text;
+        lex->error_position = lex->p - lex->start;
+    }
+
+    return -1;
+}
+
+void autojson_lex_error(const struct autojson_lexer *lex, struct autojson_error *err)
+{
+    if (NULL == err) {
+        return;
+    }
+
+    err->position = lex->error_position;
+    err->line = 1;
+    for (const char *p = lex->start; p < lex->start + lex->error_position; p++) {
+        err->line += '\n' == *p;
+    }
+
+    err->text = lex->error ? lex->error : "invalid value";
+}
+
+static int skip_whitespace(struct autojson_lexer *lex)
+{
+    while (lex->p < lex->end) {
+        switch (*lex->p) {
+        case ' ': case '\t': case '\n': case '\r':
+            lex->p++;
+            continue;
+        }
+
+        return *lex->p;
+    }
+
+    return -1;
+}
+
+static int expect(struct autojson_lexer *lex, char c, const char *text)
+{
+    if (c != skip_whitespace(lex)) {
+        return autojson_lex_fail(lex, text);
+    }
+
+    lex->p++;
+    return 0;
+}
+
+int autojson_lex_end(struct autojson_lexer *lex)
+{
+    if (-1 != skip_whitespace(lex)) {
+        return autojson_lex_fail(lex, "end of input expected");
+    }
+
+    return 0;
+}
+
+/* Whether anything but whitespace is left, for newline delimited input */
+int autojson_lex_more(struct autojson_lexer *lex)
+{
+    return -1 != skip_whitespace(lex);
+}
+
+/* Consumes the rest of the current line, which must be blank */
+int autojson_lex_line_end(struct autojson_lexer *lex)
+{
+    for (; lex->p < lex->end; lex->p++) {
+        switch (*lex->p) {
+        case ' ': case '\t': case '\r':
+            continue;
+        case '\n':
+            lex->p++;
+            return 0;
+        }
+
+        return autojson_lex_fail(lex, "newline expected");
+    }
+
+    return 0;
+}
+
+/*
+ * Finds the extent of the string starting at lex->p and leaves lex->p
+ * after its closing quote. *escaped is set when the raw bytes contain
+ * escape sequences and must go through unescape() before use.
+ */
+static int lex_raw_string(struct autojson_lexer *lex, const char **s, size_t *len, int *escaped)
+{
+    if ('"' != skip_whitespace(lex)) {
+        return autojson_lex_fail(lex, "string expected");
+    }
+
+    const char *p = ++lex->p;
+    *escaped = 0;
+    for (; p < lex->end; p++) {
+        unsigned char c = *p;
+        if ('"' == c) {
+            *s = lex->p;
+            *len = p - lex->p;
+            lex->p = p + 1;
+            return 0;
+        }
+
+        if (c < 0x20) {
+            lex->p = p;
+            return autojson_lex_fail(lex, "control character in string");
+        }
+
+        if ('\\' == c) {
+            *escaped = 1;
+            if (++p == lex->end) {
+                break;
+            }
+        }
+    }
+
+    lex->p = p;
+    return autojson_lex_fail(lex, "unterminated string");
+}
+
+static int hex_value(const char *p)
+{
+    int value = 0;
+    for (int i = 0; i < 4; i++) {
+        char c = p[i];
+        value <<= 4;
+        if (c >= '0' && c <= '9') {
+            value |= c - '0';
+        } else if (c >= 'a' && c <= 'f') {
+            value |= c - 'a' + 10;
+        } else if (c >= 'A' && c <= 'F') {
+            value |= c - 'A' + 10;
+        } else {
+            return -1;
+        }
+    }
+
+    return value;
+}
+
+/*
+ * Decodes the escaped string s[0, len) into dst, which must hold at least
+ * len bytes: no escape sequence decodes into more bytes than it spans.
+ * Returns the decoded length or -1 after failing the lexer.
+ */
+static long unescape(struct autojson_lexer *lex, const char *s, size_t len, char *dst)
+{
+    const char *end = s + len;
+    char *out = dst;
+
+    while (s < end) {
+        if ('\\' != *s) {
+            *out++ = *s++;
+            continue;
+        }
+
+        s++;
+        switch (*s++) {
+        case '"': *out++ = '"'; continue;
+        case '\\': *out++ = '\\'; continue;
+        case '/': *out++ = '/'; continue;
+        case 'b': *out++ = '\b'; continue;
+        case 'f': *out++ = '\f'; continue;
+        case 'n': *out++ = '\n'; continue;
+        case 'r': *out++ = '\r'; continue;
+        case 't': *out++ = '\t'; continue;
+        case 'u': break;
+        default: return autojson_lex_fail(lex, "invalid escape");
+        }
+
+        long codepoint = end - s >= 4 ? hex_value(s) : -1;
+        s += 4;
+        if (codepoint >= 0xD800 && codepoint <= 0xDBFF) {
+            long low = end - s >= 6 && '\\' == s[0] && 'u' == s[1] ? hex_value(s + 2) : -1;
+            if (low < 0xDC00 || low > 0xDFFF) {
+                return autojson_lex_fail(lex, "invalid unicode surrogate pair");
+            }
+
+            codepoint = 0x10000 + ((codepoint - 0xD800) << 10) + (low - 0xDC00);
+            s += 6;
+        } else if (codepoint >= 0xDC00 && codepoint <= 0xDFFF) {
+            return autojson_lex_fail(lex, "invalid unicode surrogate pair");
+        }
+
+        if (codepoint <= 0) {
+            return autojson_lex_fail(lex, codepoint ? "invalid \\u escape" : "\\u0000 is not allowed");
+        } else if (codepoint < 0x80) {
+            *out++ = codepoint;
+        } else if (codepoint < 0x800) {
+            *out++ = 0xC0 | (codepoint >> 6);
+            *out++ = 0x80 | (codepoint & 0x3F);
+        } else if (codepoint < 0x10000) {
+            *out++ = 0xE0 | (codepoint >> 12);
+            *out++ = 0x80 | ((codepoint >> 6) & 0x3F);
+            *out++ = 0x80 | (codepoint & 0x3F);
+        } else {
+            *out++ = 0xF0 | (codepoint >> 18);
+            *out++ = 0x80 | ((codepoint >> 12) & 0x3F);
+            *out++ = 0x80 | ((codepoint >> 6) & 0x3F);
+            *out++ = 0x80 | (codepoint & 0x3F);
+        }
+    }
+
+    return out - dst;
+}
+
+int autojson_lex_object_begin(struct autojson_lexer *lex)
+{
+    return expect(lex, '{', "'{' expected");
+}
+
+int autojson_lex_object_next(struct autojson_lexer *lex, int *member, const char **key, size_t *key_len)
+{
+    int c = skip_whitespace(lex);
+    if ('}' == c) {
+        lex->p++;
+        return 0;
+    }
+
+    if (*member && 0 != expect(lex, ',', "',' or '}' expected")) {
+        return -1;
+    }
+
+    int escaped;
+    if (0 != lex_raw_string(lex, key, key_len, &escaped)) {
+        return -1;
+    }
+
+    if (escaped) {
+        /* Field names never need escaping; longer keys can't match anyway */
+        if (*key_len > sizeof(lex->key)) {
+            *key_len = 0;
+        } else {
+            long len = unescape(lex, *key, *key_len, lex->key);
+            if (len < 0) {
+                return -1;
+            }
+
+            *key = lex->key;
+            *key_len = len;
+        }
+    }
+
+    if (0 != expect(lex, ':', "':' expected")) {
+        return -1;
+    }
+
+    *member = 1;
+    return 1;
+}
+
+int autojson_lex_array_begin(struct autojson_lexer *lex)
+{
+    return expect(lex, '[', "'[' expected");
+}
+
+int autojson_lex_array_next(struct autojson_lexer *lex, int *element)
+{
+    int c = skip_whitespace(lex);
+    if (']' == c) {
+        lex->p++;
+        return 0;
+    }
+
+    if (*element && 0 != expect(lex, ',', "',' or ']' expected")) {
+        return -1;
+    }
+
+    *element = 1;
+    return 1;
+}
+
+int autojson_lex_integer(struct autojson_lexer *lex, long long *value)
+{
+    int c = skip_whitespace(lex);
+    const char *p = lex->p;
+    int negative = '-' == c;
+    unsigned long long magnitude = 0;
+
+    if (negative) {
+        p++;
+    }
+
+    if (p == lex->end || *p < '0' || *p > '9') {
+        return autojson_lex_fail(lex, "integer expected");
+    }
+
+    if ('0' == *p) {
+        p++;
+    } else {
+        for (; p < lex->end && *p >= '0' && *p <= '9'; p++) {
+            unsigned digit = *p - '0';
+            if (magnitude > (9223372036854775808ULL - digit) / 10) {
+                return autojson_lex_fail(lex, "integer out of range");
+            }
+
+            magnitude = magnitude * 10 + digit;
+        }
+    }
+
+    if (p < lex->end && ('.' == *p || 'e' == *p || 'E' == *p)) {
+        return autojson_lex_fail(lex, "integer expected");
+    }
+
+    if (!negative && magnitude > 9223372036854775807ULL) {
+        return autojson_lex_fail(lex, "integer out of range");
+    }
+
+    *value = negative ? (long long) (0ULL - magnitude) : (long long) magnitude;
+    lex->p = p;
+    return 0;
+}
+
+int autojson_lex_string_copy(struct autojson_lexer *lex, char *dst, size_t size)
+{
+    const char *s;
+    size_t len;
+    int escaped;
+    if (0 != lex_raw_string(lex, &s, &len, &escaped)) {
+        return -1;
+    }
+
+    if (!escaped) {
+        len = len < size ? len : size - 1;
+        memcpy(dst, s, len);
+        dst[len] = '\0';
+        return 0;
+    }
+
+    char *decoded = (char *) malloc(len);
+    if (NULL == decoded) {
+        return autojson_lex_fail(lex, "out of memory");
+    }
+
+    long decoded_len = unescape(lex, s, len, decoded);
+    if (decoded_len >= 0) {
+        len = (size_t) decoded_len < size ? (size_t) decoded_len : size - 1;
+        memcpy(dst, decoded, len);
+        dst[len] = '\0';
+    }
+
+    free(decoded);
+    return decoded_len < 0 ? -1 : 0;
+}
+
+int autojson_lex_string_dup(struct autojson_lexer *lex, char **dst)
+{
+    const char *s;
+    size_t len;
+    int escaped;
+    if (0 != lex_raw_string(lex, &s, &len, &escaped)) {
+        return -1;
+    }
+
+    char *copy = (char *) autojson_lex_alloc(lex, len + 1);
+    if (NULL == copy) {
+        return -1;
+    }
+
+    if (escaped) {
+        long decoded_len = unescape(lex, s, len, copy);
+        if (decoded_len < 0) {
+            autojson_lex_release(lex, copy);
+            return -1;
+        }
+
+        len = decoded_len;
+    } else {
+        memcpy(copy, s, len);
+    }
+
+    copy[len] = '\0';
+    *dst = copy;
+    return 0;
+}
+
+int autojson_lex_string_borrow(struct autojson_lexer *lex, const char **dst, size_t *dst_len)
+{
+    const char *s;
+    size_t len;
+    int escaped;
+    if (0 != lex_raw_string(lex, &s, &len, &escaped)) {
+        return -1;
+    }
+
+    if (escaped) {
+        /* The input holds the escaped form, decode into the arena if there is one */
+        if (NULL == lex->arena) {
+            lex->p = s - 1;
+            return autojson_lex_fail(lex, "escaped string can't be borrowed");
+        }
+
+        char *decoded = (char *) autojson_lex_alloc(lex, len + 1);
+        if (NULL == decoded) {
+            return -1;
+        }
+
+        long decoded_len = unescape(lex, s, len, decoded);
+        if (decoded_len < 0) {
+            return -1;
+        }
+
+        decoded[decoded_len] = '\0';
+        s = decoded;
+        len = decoded_len;
+    }
+
+    *dst = s;
+    *dst_len = len;
+    return 0;
+}
+
+static int lex_literal(struct autojson_lexer *lex, const char *literal, size_t len)
+{
+    if ((size_t) (lex->end - lex->p) < len || 0 != memcmp(lex->p, literal, len)) {
+        return autojson_lex_fail(lex, "invalid token");
+    }
+
+    lex->p += len;
+    return 0;
+}
+
+static int lex_number(struct autojson_lexer *lex)
+{
+    const char *p = lex->p;
+    const char *digits;
+
+    if (p < lex->end && '-' == *p) {
+        p++;
+    }
+
+    for (digits = p; p < lex->end && *p >= '0' && *p <= '9'; p++);
+    if (p == digits || ('0' == *digits && p - digits > 1)) {
+        return autojson_lex_fail(lex, "invalid number");
+    }
+
+    if (p < lex->end && '.' == *p) {
+        for (digits = ++p; p < lex->end && *p >= '0' && *p <= '9'; p++);
+        if (p == digits) {
+            return autojson_lex_fail(lex, "invalid number");
+        }
+    }
+
+    if (p < lex->end && ('e' == *p || 'E' == *p)) {
+        p++;
+        if (p < lex->end && ('+' == *p || '-' == *p)) {
+            p++;
+        }
+
+        for (digits = p; p < lex->end && *p >= '0' && *p <= '9'; p++);
+        if (p == digits) {
+            return autojson_lex_fail(lex, "invalid number");
+        }
+    }
+
+    lex->p = p;
+    return 0;
+}
+
+static int lex_skip(struct autojson_lexer *lex, int depth)
+{
+    const char *s;
+    size_t len;
+    int escaped;
+    int more;
+    int c = skip_whitespace(lex);
+
+    if (depth > AUTOJSON_MAX_DEPTH) {
+        return autojson_lex_fail(lex, "maximum nesting depth exceeded");
+    }
+
+    switch (c) {
+    case '"':
+        return lex_raw_string(lex, &s, &len, &escaped);
+    case '{': {
+        int member = 0;
+        lex->p++;
+        while (0 < (more = autojson_lex_object_next(lex, &member, &s, &len))) {
+            if (0 != lex_skip(lex, depth + 1)) {
+                return -1;
+            }
+        }
+
+        return more;
+    }
+    case '[': {
+        int element = 0;
+        lex->p++;
+        while (0 < (more = autojson_lex_array_next(lex, &element))) {
+            if (0 != lex_skip(lex, depth + 1)) {
+                return -1;
+            }
+        }
+
+        return more;
+    }
+    case 't':
+        return lex_literal(lex, "true", 4);
+    case 'f':
+        return lex_literal(lex, "false", 5);
+    case 'n':
+        return lex_literal(lex, "null", 4);
+    case -1:
+        return autojson_lex_fail(lex, "unexpected end of input");
+    default:
+        return lex_number(lex);
+    }
+}
+
+int autojson_lex_skip(struct autojson_lexer *lex)
+{
+    return lex_skip(lex, 0);
+}
+
+/* What the push tokenizer accepts next */
+enum push_expect {
+    PUSH_EXPECT_VALUE,
+    PUSH_EXPECT_VALUE_OR_END,
+    PUSH_EXPECT_KEY,
+    PUSH_EXPECT_KEY_OR_END,
+    PUSH_EXPECT_COLON,
+    PUSH_EXPECT_COMMA_OR_END,
+    PUSH_EXPECT_NOTHING,
+};
+
+void autojson_push_init(struct autojson_push *push, autojson_push_handler handler, void *out,
+                        struct autojson_arena *arena)
+{
+    memset(push, 0, offsetof(struct autojson_push, frames));
+    autojson_buf_init(&push->partial);
+    push->expect = PUSH_EXPECT_VALUE;
+    push->line = 1;
+    push->arena = arena;
+    memset(&push->frames[0], 0, sizeof(push->frames[0]));
+    push->frames[0].handler = handler;
+    push->frames[0].out = out;
+    push->frame_count = 1;
+}
+
+int autojson_push_fail(struct autojson_push *push, const char *text)
+{
+    if (NULL == push->error) {
+        push->error = text;
+        push->error_position = push->position;
+        push->error_line = push->line;
+    }
+
+    return -1;
+}
+
+/* Lets every handler release what it allocated, innermost first */
+static void push_abort(struct autojson_push *push)
+{
+    /* The root frame is left at its '}', trailing garbage still fails the value it parsed */
+    if (0 == push->frame_count) {
+        push->frame_count = 1;
+    }
+
+    while (push->frame_count > 0) {
+        struct autojson_push_frame *frame = &push->frames[--push->frame_count];
+        frame->handler(push, frame, AUTOJSON_PUSH_ABORT);
+    }
+
+    autojson_buf_fini(&push->partial);
+}
+
+static int push_in_object(const struct autojson_push *push)
+{
+    return push->objects[(push->depth - 1) / 8] & (1 << ((push->depth - 1) % 8));
+}
+
+/* Fails with what the grammar expected instead of the current token */
+static int push_unexpected(struct autojson_push *push)
+{
+    switch (push->expect) {
+    case PUSH_EXPECT_KEY:
+    case PUSH_EXPECT_KEY_OR_END:
+        return autojson_push_fail(push, "string expected");
+    case PUSH_EXPECT_COLON:
+        return autojson_push_fail(push, "':' expected");
+    case PUSH_EXPECT_COMMA_OR_END:
+        return autojson_push_fail(push, push_in_object(push) ? "',' or '}' expected" : "',' or ']' expected");
+    case PUSH_EXPECT_NOTHING:
+        return autojson_push_fail(push, "end of input expected");
+    default:
+        return autojson_push_fail(push, "value expected");
+    }
+}
+
+/* Hands event to the innermost frame, unless it is part of a value being skipped */
+static int push_deliver(struct autojson_push *push, int event)
+{
+    if (push->skip || 0 == push->frame_count) {
+        return 0;
+    }
+
+    struct autojson_push_frame *frame = &push->frames[push->frame_count - 1];
+    return frame->handler(push, frame, event);
+}
+
+static void push_value_done(struct autojson_push *push)
+{
+    push->expect = push->depth ? PUSH_EXPECT_COMMA_OR_END : PUSH_EXPECT_NOTHING;
+    if (push->skip == push->depth + 1) {
+        push->skip = 0;
+    }
+}
+
+static void push_lexer(const struct autojson_push *push, struct autojson_lexer *lex)
+{
+    autojson_lexer_init(lex, push->raw, push->raw_len);
+    lex->arena = push->arena;
+}
+
+/* Fails with the error of a lexer that decoded the current token */
+static int push_lex_failed(struct autojson_push *push, const struct autojson_lexer *lex)
+{
+    push->position = push->raw_position + lex->error_position;
+    return autojson_push_fail(push, lex->error);
+}
+
+static int push_structural(struct autojson_push *push, char c)
+{
+    int rc;
+
+    switch (c) {
+    case '{':
+    case '[':
+        if (PUSH_EXPECT_VALUE != push->expect && PUSH_EXPECT_VALUE_OR_END != push->expect) {
+            return push_unexpected(push);
+        }
+
+        if (AUTOJSON_PUSH_MAX_DEPTH == push->depth) {
+            return autojson_push_fail(push, "maximum nesting depth exceeded");
+        }
+
+        if ('{' == c) {
+            push->objects[push->depth / 8] |= 1 << (push->depth % 8);
+        } else {
+            push->objects[push->depth / 8] &= ~(1 << (push->depth % 8));
+        }
+
+        push->depth++;
+        push->expect = '{' == c ? PUSH_EXPECT_KEY_OR_END : PUSH_EXPECT_VALUE_OR_END;
+        return push_deliver(push, '{' == c ? AUTOJSON_PUSH_OBJECT_BEGIN : AUTOJSON_PUSH_ARRAY_BEGIN);
+    case '}':
+    case ']':
+        if ((PUSH_EXPECT_COMMA_OR_END != push->expect &&
+             ('}' == c ? PUSH_EXPECT_KEY_OR_END : PUSH_EXPECT_VALUE_OR_END) != push->expect) ||
+            (push_in_object(push) ? '}' : ']') != c) {
+            return push_unexpected(push);
+        }
+
+        push->depth--;
+        rc = push_deliver(push, '}' == c ? AUTOJSON_PUSH_OBJECT_END : AUTOJSON_PUSH_ARRAY_END);
+        push_value_done(push);
+        return rc;
+    case ':':
+        if (PUSH_EXPECT_COLON != push->expect) {
+            return push_unexpected(push);
+        }
+
+        push->expect = PUSH_EXPECT_VALUE;
+        return 0;
+    case ',':
+        if (PUSH_EXPECT_COMMA_OR_END != push->expect) {
+            return push_unexpected(push);
+        }
+
+        push->expect = push_in_object(push) ? PUSH_EXPECT_KEY : PUSH_EXPECT_VALUE;
+        return 0;
+    default:
+        return autojson_push_fail(push, "invalid token");
+    }
+}
+
+/* Points push->key at the decoded key of the current token */
+static int push_decode_key(struct autojson_push *push)
+{
+    struct autojson_lexer lex;
+
+    push->key = push->raw + 1;
+    push->key_len = push->raw_len - 2;
+    if (NULL == memchr(push->key, '\\', push->key_len)) {
+        return 0;
+    }
+
+    if (push->key_len > sizeof(push->key_buffer)) {
+        /* Longer than any member name, leave it unknown */
+        push->key_len = 0;
+        return 0;
+    }
+
+    push_lexer(push, &lex);
+    long len = unescape(&lex, push->key, push->key_len, push->key_buffer);
+    if (len < 0) {
+        return push_lex_failed(push, &lex);
+    }
+
+    push->key = push->key_buffer;
+    push->key_len = len;
+    return 0;
+}
+
+/* A complete string, number or literal token is at push->raw */
+static int push_token(struct autojson_push *push)
+{
+    struct autojson_lexer lex;
+    int event;
+    int rc;
+
+    if ('"' == push->raw[0]) {
+        if (PUSH_EXPECT_KEY == push->expect || PUSH_EXPECT_KEY_OR_END == push->expect) {
+            push->expect = PUSH_EXPECT_COLON;
+            if (push->skip) {
+                return 0;
+            }
+
+            return 0 == push_decode_key(push) ? push_deliver(push, AUTOJSON_PUSH_KEY) : -1;
+        }
+
+        event = AUTOJSON_PUSH_STRING;
+    } else {
+        push_lexer(push, &lex);
+        switch (push->raw[0]) {
+        case 't':
+            rc = lex_literal(&lex, "true", 4);
+            break;
+        case 'f':
+            rc = lex_literal(&lex, "false", 5);
+            break;
+        case 'n':
+            rc = lex_literal(&lex, "null", 4);
+            break;
+        default:
+            rc = lex_number(&lex);
+            break;
+        }
+
+        if (0 == rc && lex.p != lex.end) {
+            rc = autojson_lex_fail(&lex, "invalid token");
+        }
+
+        if (0 != rc) {
+            return push_lex_failed(push, &lex);
+        }
+
+        event = '-' == push->raw[0] || (push->raw[0] >= '0' && push->raw[0] <= '9') ?
+            AUTOJSON_PUSH_NUMBER : AUTOJSON_PUSH_LITERAL;
+    }
+
+    if (PUSH_EXPECT_VALUE != push->expect && PUSH_EXPECT_VALUE_OR_END != push->expect) {
+        return push_unexpected(push);
+    }
+
+    rc = push_deliver(push, event);
+    push_value_done(push);
+    return rc;
+}
+
+static int push_bare_char(char c)
+{
+    return '-' == c || '+' == c || '.' == c || (c >= '0' && c <= '9') || (c >= 'a' && c <= 'z') ||
+        (c >= 'A' && c <= 'Z');
+}
+
+/*
+ * Scans the rest of the current token, returns where it ends or NULL if
+ * the chunk ends first. Fails (and returns NULL) on control characters
+ * inside strings.
+ */
+static const char *push_scan(struct autojson_push *push, const char *chunk, const char *p, const char *end)
+{
+    if ('"' != push->token) {
+        for (; p < end; p++) {
+            if (!push_bare_char(*p)) {
+                return p;
+            }
+        }
+
+        return NULL;
+    }
+
+    for (; p < end; p++) {
+        unsigned char c = *p;
+        if (push->escape) {
+            push->escape = 0;
+        } else if ('"' == c) {
+            return p + 1;
+        } else if ('\\' == c) {
+            push->escape = 1;
+        } else if (c < 0x20) {
+            push->position = push->offset + (p - chunk);
+            autojson_push_fail(push, "control character in string");
+            return NULL;
+        }
+    }
+
+    return NULL;
+}
+
+int autojson_push_feed(struct autojson_push *push, const char *chunk, size_t len)
+{
+    const char *p = chunk;
+    const char *end = chunk + len;
+
+    if (NULL != push->error) {
+        return -1;
+    }
+
+    while (p < end) {
+        const char *start = p;
+
+        if (!push->token) {
+            char c = *p;
+            push->position = push->offset + (p - chunk);
+            if (' ' == c || '\t' == c || '\r' == c || '\n' == c) {
+                push->line += '\n' == c;
+                p++;
+                continue;
+            }
+
+            if ('"' != c && !push_bare_char(c)) {
+                if (0 != push_structural(push, c)) {
+                    break;
+                }
+
+                p++;
+                continue;
+            }
+
+            push->token = c;
+            push->escape = 0;
+            push->raw_position = push->position;
+            p++;
+        }
+
+        const char *token_end = push_scan(push, chunk, p, end);
+        if (NULL == token_end) {
+            if (NULL != push->error) {
+                break;
+            }
+
+            /* Split by the end of the chunk: keep what there is of the token for the next one */
+            autojson_buf_put(&push->partial, start, end - start);
+            if (push->partial.error) {
+                autojson_push_fail(push, "out of memory");
+            }
+
+            break;
+        }
+
+        if (0 == push->partial.len) {
+            push->raw = start;
+            push->raw_len = token_end - start;
+        } else {
+            autojson_buf_put(&push->partial, start, token_end - start);
+            if (push->partial.error) {
+                autojson_push_fail(push, "out of memory");
+                break;
+            }
+
+            push->raw = push->partial.data;
+            push->raw_len = push->partial.len;
+        }
+
+        push->token = 0;
+        push->position = push->raw_position;
+        int rc = push_token(push);
+        push->partial.len = 0;
+        if (0 != rc) {
+            break;
+        }
+
+        p = token_end;
+    }
+
+    push->offset += len;
+    if (NULL != push->error) {
+        push_abort(push);
+        return -1;
+    }
+
+    return 0;
+}
+
+int autojson_push_finish(struct autojson_push *push, struct autojson_error *err)
+{
+    if (NULL == push->error && (push->token || PUSH_EXPECT_NOTHING != push->expect)) {
+        push->position = push->offset;
+        autojson_push_fail(push, "unexpected end of input");
+        push_abort(push);
+    }
+
+    autojson_buf_fini(&push->partial);
+    if (NULL == push->error) {
+        return 0;
+    }
+
+    if (NULL != err) {
+        err->position = push->error_position;
+        err->line = push->error_line;
+        err->text = push->error;
+    }
+
+    return -1;
+}
+
+int autojson_push_enter(struct autojson_push *push, autojson_push_handler handler, void *out, int event)
+{
+    if (AUTOJSON_PUSH_MAX_FRAMES == push->frame_count) {
+        return autojson_push_fail(push, "maximum nesting depth exceeded");
+    }
+
+    push->frames[push->frame_count - 1].child = 1;
+    struct autojson_push_frame *frame = &push->frames[push->frame_count++];
+    memset(frame, 0, sizeof(*frame));
+    frame->handler = handler;
+    frame->out = out;
+    return handler(push, frame, event);
+}
+
+int autojson_push_leave(struct autojson_push *push)
+{
+    if (0 == --push->frame_count) {
+        return 0;
+    }
+
+    struct autojson_push_frame *parent = &push->frames[push->frame_count - 1];
+    parent->child = 0;
+    return parent->handler(push, parent, AUTOJSON_PUSH_CHILD_DONE);
+}
+
+/* field is the index of the member the key names, or negative for unknown keys whose value is skipped */
+int autojson_push_key(struct autojson_push *push, struct autojson_push_frame *frame, int field)
+{
+    if (field < 0) {
+        push->skip = push->depth + 1;
+        return 0;
+    }
+
+    uint64_t bit = 1ULL << (field % 64);
+    if (frame->seen[field / 64] & bit) {
+        return autojson_push_fail(push, "duplicate key");
+    }
+
+    frame->seen[field / 64] |= bit;
+    frame->field = field;
+    frame->state = AUTOJSON_PUSH_VALUE;
+    return 0;
+}
+
+/* The structure of frame ended, fails unless all of its fields were seen */
+int autojson_push_object_end(struct autojson_push *push, struct autojson_push_frame *frame, int fields)
+{
+    for (int word = 0; word * 64 < fields; word++) {
+        int bits = fields - word * 64;
+        uint64_t all = bits >= 64 ? ~0ULL : (1ULL << bits) - 1;
+        if (all != frame->seen[word]) {
+            return autojson_push_fail(push, "missing key");
+        }
+    }
+
+    return autojson_push_leave(push);
+}
+
+int autojson_push_integer(struct autojson_push *push, int event, long long *value)
+{
+    struct autojson_lexer lex;
+
+    if (AUTOJSON_PUSH_NUMBER != event) {
+        return autojson_push_fail(push, "integer expected");
+    }
+
+    push_lexer(push, &lex);
+    return 0 == autojson_lex_integer(&lex, value) ? 0 : push_lex_failed(push, &lex);
+}
+
+int autojson_push_string_copy(struct autojson_push *push, int event, char *dst, size_t size)
+{
+    struct autojson_lexer lex;
+
+    if (AUTOJSON_PUSH_STRING != event) {
+        return autojson_push_fail(push, "string expected");
+    }
+
+    push_lexer(push, &lex);
+    return 0 == autojson_lex_string_copy(&lex, dst, size) ? 0 : push_lex_failed(push, &lex);
+}
+
+int autojson_push_string_dup(struct autojson_push *push, int event, char **dst)
+{
+    struct autojson_lexer lex;
+
+    if (AUTOJSON_PUSH_STRING != event) {
+        return autojson_push_fail(push, "string expected");
+    }
+
+    push_lexer(push, &lex);
+    return 0 == autojson_lex_string_dup(&lex, dst) ? 0 : push_lex_failed(push, &lex);
+}
+
+int autojson_push_array_begin(struct autojson_push *push, int event)
+{
+    if (AUTOJSON_PUSH_ARRAY_BEGIN != event) {
+        return autojson_push_fail(push, "'[' expected");
+    }
+
+    return 0;
+}
+
+void *autojson_push_alloc(struct autojson_push *push, size_t size)
+{
+    void *p = AUTOJSON_STATS_ALLOC(push->arena ? autojson_arena_alloc(push->arena, size) : malloc(size));
+    if (NULL == p) {
+        autojson_push_fail(push, "out of memory");
+    }
+
+    return p;
+}
+
+void autojson_push_release(struct autojson_push *push, void *p)
+{
+    if (NULL == push->arena) {
+        free(p);
+    }
+}
+
+void *autojson_push_grow_array(struct autojson_push *push, void *items, size_t *cap, size_t elem_size)
+{
+    void *grown = grow_array(push->arena, items, cap, elem_size);
+    if (NULL == grown) {
+        autojson_push_fail(push, "out of memory");
+    }
+
+    return grown;
+}
+
+/* Resizes p from old_size to size bytes, in the arena if there is one */
+static void *push_resize(struct autojson_push *push, void *p, size_t old_size, size_t size)
+{
+    void *resized;
+
+    if (NULL == push->arena) {
+        resized = AUTOJSON_STATS_ALLOC(realloc(p, size));
+    } else if (NULL != (resized = AUTOJSON_STATS_ALLOC(autojson_arena_alloc(push->arena, size))) && old_size) {
+        memcpy(resized, p, old_size);
+    }
+
+    if (NULL == resized) {
+        autojson_push_fail(push, "out of memory");
+    }
+
+    return resized;
+}
+
+/*
+ * Makes room for another element of a struct X ** member. The elements
+ * live in frame->items, *list points at each of them and stays NULL
+ * terminated.
+ */
+int autojson_push_grow_list(struct autojson_push *push, struct autojson_push_frame *frame, void ***list,
+                            size_t elem_size)
+{
+    size_t cap = frame->cap ? frame->cap * 2 : 4;
+    void **grown_list;
+    char *items;
+
+    if (frame->count < frame->cap) {
+        return 0;
+    }
+
+    if (cap >= ((size_t) -1) / elem_size) {
+        return autojson_push_fail(push, "out of memory");
+    }
+
+    /* The list grows first: should the elements fail to, it is merely longer than needed */
+    grown_list = (void **) push_resize(push, *list, (frame->count + 1) * sizeof(void *),
+                                       (cap + 1) * sizeof(void *));
+    if (NULL == grown_list) {
+        return -1;
+    }
+
+    *list = grown_list;
+    items = (char *) push_resize(push, frame->items, frame->count * elem_size, cap * elem_size);
+    if (NULL == items) {
+        return -1;
+    }
+
+    frame->items = items;
+    frame->cap = cap;
+    for (size_t i = 0; i < frame->count; i++) {
+        grown_list[i] = items + i * elem_size;
+    }
+
+    grown_list[frame->count] = NULL;
+    return 0;
+}
+
+static void put_big_endian(struct autojson_buf *buf, unsigned char tag, unsigned long long value, int bytes)
+{
+    char encoded[9];
+    encoded[0] = tag;
+    for (int i = bytes; i > 0; i--) {
+        encoded[i] = value & 0xff;
+        value >>= 8;
+    }
+
+    autojson_buf_put(buf, encoded, bytes + 1);
+}
+
+struct autojson_pool {
+    pthread_mutex_t call_lock;
+    pthread_mutex_t lock;
+    pthread_cond_t work;
+    pthread_cond_t done;
+    pthread_t *threads;
+    int thread_count;
+    int stop;
+    size_t threshold;
+
+    /* The call in progress, guarded by lock */
+    const void *const *items;
+    size_t count;
+    size_t chunk_size;
+    size_t chunks;
+    size_t next_chunk;
+    size_t finished_chunks;
+    autojson_write_fn write;
+    struct autojson_buf *bufs;
+};
+
+/* Chunks per thread, so a slow chunk doesn't hold up the others */
+#define AUTOJSON_POOL_CHUNKS_PER_THREAD 4
+
+static void write_items(struct autojson_buf *buf, const void *const *items, size_t count,
+                        autojson_write_fn write)
+{
+    for (size_t i = 0; i < count; i++) {
+        if (0 != i) {
+            autojson_buf_putc(buf, ',');
+        }
+
+        write(items[i], buf);
+    }
+}
+
+/* Writes chunks of the current call until there are none left, called with lock held */
+static void pool_write_chunks(struct autojson_pool *pool)
+{
+    while (NULL != pool->items && pool->next_chunk < pool->chunks) {
+        size_t chunk = pool->next_chunk++;
+        size_t start = chunk * pool->chunk_size;
+        size_t count = pool->count - start < pool->chunk_size ? pool->count - start : pool->chunk_size;
+
+        pthread_mutex_unlock(&pool->lock);
+        write_items(&pool->bufs[chunk], pool->items + start, count, pool->write);
+        pthread_mutex_lock(&pool->lock);
+        if (++pool->finished_chunks == pool->chunks) {
+            pthread_cond_signal(&pool->done);
+        }
+    }
+}
+
+static void *pool_thread(void *arg)
+{
+    struct autojson_pool *pool = (struct autojson_pool *) arg;
+
+    pthread_mutex_lock(&pool->lock);
+    while (!pool->stop) {
+        pool_write_chunks(pool);
+        pthread_cond_wait(&pool->work, &pool->lock);
+    }
+
+    pthread_mutex_unlock(&pool->lock);
+    return NULL;
+}
+
+struct autojson_pool *autojson_pool_create(int threads, size_t threshold)
+{
+    struct autojson_pool *pool = (struct autojson_pool *) calloc(1, sizeof(*pool));
+    if (NULL == pool) {
+        return NULL;
+    }
+
+    pool->threads = (pthread_t *) calloc(threads > 0 ? threads : 1, sizeof(*pool->threads));
+    if (NULL == pool->threads) {
+        free(pool);
+        return NULL;
+    }
+
+    pool->threshold = threshold;
+    pthread_mutex_init(&pool->call_lock, NULL);
+    pthread_mutex_init(&pool->lock, NULL);
+    pthread_cond_init(&pool->work, NULL);
+    pthread_cond_init(&pool->done, NULL);
+    for (; pool->thread_count < threads; pool->thread_count++) {
+        if (0 != pthread_create(&pool->threads[pool->thread_count], NULL, pool_thread, pool)) {
+            autojson_pool_destroy(pool);
+            return NULL;
+        }
+    }
+
+    return pool;
+}
+
+void autojson_pool_destroy(struct autojson_pool *pool)
+{
+    if (NULL == pool) {
+        return;
+    }
+
+    pthread_mutex_lock(&pool->lock);
+    pool->stop = 1;
+    pthread_cond_broadcast(&pool->work);
+    pthread_mutex_unlock(&pool->lock);
+    for (int i = 0; i < pool->thread_count; i++) {
+        pthread_join(pool->threads[i], NULL);
+    }
+
+    pthread_cond_destroy(&pool->done);
+    pthread_cond_destroy(&pool->work);
+    pthread_mutex_destroy(&pool->lock);
+    pthread_mutex_destroy(&pool->call_lock);
+    free(pool->threads);
+    free(pool);
+}
+
+void autojson_write_parallel(struct autojson_pool *pool, struct autojson_buf *buf,
+                             const void *const *items, autojson_write_fn write)
+{
+    size_t count = 0;
+    while (NULL != items && NULL != items[count]) {
+        count++;
+    }
+
+    if (NULL == pool || 0 == pool->thread_count || count < pool->threshold || count < 2) {
+        write_items(buf, items, count, write);
+        return;
+    }
+
+    size_t chunks = (pool->thread_count + 1) * AUTOJSON_POOL_CHUNKS_PER_THREAD;
+    if (chunks > count) {
+        chunks = count;
+    }
+
+    size_t chunk_size = (count + chunks - 1) / chunks;
+    chunks = (count + chunk_size - 1) / chunk_size;
+    struct autojson_buf *bufs = (struct autojson_buf *) malloc(chunks * sizeof(*bufs));
+    if (NULL == bufs) {
+        write_items(buf, items, count, write);
+        return;
+    }
+
+    for (size_t i = 0; i < chunks; i++) {
+        autojson_buf_init(&bufs[i]);
+    }
+
+    pthread_mutex_lock(&pool->call_lock);
+    pthread_mutex_lock(&pool->lock);
+    pool->items = items;
+    pool->count = count;
+    pool->chunk_size = chunk_size;
+    pool->chunks = chunks;
+    pool->next_chunk = 0;
+    pool->finished_chunks = 0;
+    pool->write = write;
+    pool->bufs = bufs;
+    pthread_cond_broadcast(&pool->work);
+    pool_write_chunks(pool);
+    while (pool->finished_chunks < chunks) {
+        pthread_cond_wait(&pool->done, &pool->lock);
+    }
+
+    pool->items = NULL;
+    pthread_mutex_unlock(&pool->lock);
+    pthread_mutex_unlock(&pool->call_lock);
+
+    size_t len = chunks - 1;
+    for (size_t i = 0; i < chunks; i++) {
+        len += bufs[i].len;
+    }
+
+    autojson_buf_reserve(buf, len);
+    for (size_t i = 0; i < chunks; i++) {
+        if (bufs[i].error) {
+            buf->error = 1;
+        }
+
+        if (0 != i) {
+            autojson_buf_putc(buf, ',');
+        }
+
+        autojson_buf_put(buf, bufs[i].data, bufs[i].len);
+        autojson_buf_fini(&bufs[i]);
+    }
+
+    free(bufs);
+}
+
+void autojson_buf_put_msgpack_integer(struct autojson_buf *buf, long long value)
+{
+    if (value >= 0) {
+        if (value < 0x80) {
+            autojson_buf_putc(buf, value);
+        } else if (value <= 0xff) {
+            put_big_endian(buf, 0xcc, value, 1);
+        } else if (value <= 0xffff) {
+            put_big_endian(buf, 0xcd, value, 2);
+        } else if (value <= 0xffffffffLL) {
+            put_big_endian(buf, 0xce, value, 4);
+        } else {
+            put_big_endian(buf, 0xcf, value, 8);
+        }
+    } else if (value >= -32) {
+        autojson_buf_putc(buf, value);
+    } else if (value >= -0x80) {
+        put_big_endian(buf, 0xd0, value, 1);
+    } else if (value >= -0x8000) {
+        put_big_endian(buf, 0xd1, value, 2);
+    } else if (value >= -0x80000000LL) {
+        put_big_endian(buf, 0xd2, value, 4);
+    } else {
+        put_big_endian(buf, 0xd3, value, 8);
+    }
+}
+
+void autojson_buf_put_msgpack_stringn(struct autojson_buf *buf, const char *s, size_t len)
+{
+    if (len < 32) {
+        autojson_buf_putc(buf, 0xa0 | len);
+    } else if (len <= 0xff) {
+        put_big_endian(buf, 0xd9, len, 1);
+    } else if (len <= 0xffff) {
+        put_big_endian(buf, 0xda, len, 2);
+    } else {
+        put_big_endian(buf, 0xdb, len, 4);
+    }
+
+    autojson_buf_put(buf, s, len);
+}
+
+void autojson_buf_put_msgpack_array(struct autojson_buf *buf, size_t count)
+{
+    if (count < 16) {
+        autojson_buf_putc(buf, 0x90 | count);
+    } else if (count <= 0xffff) {
+        put_big_endian(buf, 0xdc, count, 2);
+    } else {
+        put_big_endian(buf, 0xdd, count, 4);
+    }
+}
+
+/* Reads a bytes wide big endian number following the tag byte at lex->p */
+static int mp_big_endian(struct autojson_lexer *lex, int bytes, unsigned long long *value)
+{
+    if (lex->end - lex->p < 1 + bytes) {
+        return autojson_lex_fail(lex, "unexpected end of input");
+    }
+
+    const unsigned char *p = (const unsigned char *) lex->p + 1;
+    *value = 0;
+    for (int i = 0; i < bytes; i++) {
+        *value = (*value << 8) | p[i];
+    }
+
+    lex->p += 1 + bytes;
+    return 0;
+}
+
+static int mp_peek(struct autojson_lexer *lex)
+{
+    if (lex->p == lex->end) {
+        return autojson_lex_fail(lex, "unexpected end of input");
+    }
+
+    return (unsigned char) *lex->p;
+}
+
+int autojson_mp_end(struct autojson_lexer *lex)
+{
+    if (lex->p != lex->end) {
+        return autojson_lex_fail(lex, "end of input expected");
+    }
+
+    return 0;
+}
+
+/*
+ * Reads the header of a map or array. Every element takes at least
+ * min_size bytes, which bounds count by what is left of the input.
+ */
+static int mp_container(struct autojson_lexer *lex, size_t *count, int fix, int tag16, int tag32,
+                        size_t min_size, const char *text)
+{
+    unsigned long long value;
+    int c = mp_peek(lex);
+    if (c < 0) {
+        return -1;
+    }
+
+    if ((c & 0xf0) == fix) {
+        value = c & 0x0f;
+        lex->p++;
+    } else if (c == tag16 || c == tag32) {
+        if (0 != mp_big_endian(lex, c == tag16 ? 2 : 4, &value)) {
+            return -1;
+        }
+    } else {
+        return autojson_lex_fail(lex, text);
+    }
+
+    if (value > (unsigned long long) (lex->end - lex->p) / min_size) {
+        return autojson_lex_fail(lex, "unexpected end of input");
+    }
+
+    *count = value;
+    return 0;
+}
+
+int autojson_mp_map_begin(struct autojson_lexer *lex, size_t *count)
+{
+    return mp_container(lex, count, 0x80, 0xde, 0xdf, 2, "map expected");
+}
+
+int autojson_mp_array_begin(struct autojson_lexer *lex, size_t *count)
+{
+    return mp_container(lex, count, 0x90, 0xdc, 0xdd, 1, "array expected");
+}
+
+static int mp_raw_string(struct autojson_lexer *lex, const char **s, size_t *len)
+{
+    unsigned long long value;
+    int c = mp_peek(lex);
+    if (c < 0) {
+        return -1;
+    }
+
+    if ((c & 0xe0) == 0xa0) {
+        value = c & 0x1f;
+        lex->p++;
+    } else if (c >= 0xd9 && c <= 0xdb) {
+        if (0 != mp_big_endian(lex, 1 << (c - 0xd9), &value)) {
+            return -1;
+        }
+    } else {
+        return autojson_lex_fail(lex, "string expected");
+    }
+
+    if (value > (unsigned long long) (lex->end - lex->p)) {
+        return autojson_lex_fail(lex, "unexpected end of input");
+    }
+
+    *s = lex->p;
+    *len = value;
+    lex->p += value;
+    return 0;
+}
+
+int autojson_mp_key(struct autojson_lexer *lex, const char **key, size_t *key_len)
+{
+    return mp_raw_string(lex, key, key_len);
+}
+
+int autojson_mp_integer(struct autojson_lexer *lex, long long *value)
+{
+    unsigned long long raw;
+    int c = mp_peek(lex);
+    if (c < 0) {
+        return -1;
+    }
+
+    if (c < 0x80 || c >= 0xe0) {
+        *value = (signed char) c;
+        lex->p++;
+        return 0;
+    }
+
+    if (c >= 0xcc && c <= 0xcf) {
+        const char *start = lex->p;
+        if (0 != mp_big_endian(lex, 1 << (c - 0xcc), &raw)) {
+            return -1;
+        }
+
+        if (raw > 9223372036854775807ULL) {
+            lex->p = start;
+            return autojson_lex_fail(lex, "integer out of range");
+        }
+
+        *value = raw;
+        return 0;
+    }
+
+    if (c >= 0xd0 && c <= 0xd3) {
+        int bytes = 1 << (c - 0xd0);
+        if (0 != mp_big_endian(lex, bytes, &raw)) {
+            return -1;
+        }
+
+        /* Sign extend from the encoded width */
+        int shift = 64 - 8 * bytes;
+        *value = shift ? (long long) (raw << shift) >> shift : (long long) raw;
+        return 0;
+    }
+
+    return autojson_lex_fail(lex, "integer expected");
+}
+
+int autojson_mp_string_copy(struct autojson_lexer *lex, char *dst, size_t size)
+{
+    const char *s;
+    size_t len;
+    if (0 != mp_raw_string(lex, &s, &len)) {
+        return -1;
+    }
+
+    len = len < size ? len : size - 1;
+    memcpy(dst, s, len);
+    dst[len] = '\0';
+    return 0;
+}
+
+int autojson_mp_string_dup(struct autojson_lexer *lex, char **dst)
+{
+    const char *s;
+    size_t len;
+    if (0xc0 == mp_peek(lex)) {
+        lex->p++;
+        *dst = NULL;
+        return 0;
+    }
+
+    if (0 != mp_raw_string(lex, &s, &len)) {
+        return -1;
+    }
+
+    char *copy = (char *) autojson_lex_alloc(lex, len + 1);
+    if (NULL == copy) {
+        return -1;
+    }
+
+    memcpy(copy, s, len);
+    copy[len] = '\0';
+    *dst = copy;
+    return 0;
+}
+
+int autojson_mp_string_borrow(struct autojson_lexer *lex, const char **dst, size_t *dst_len)
+{
+    if (0xc0 == mp_peek(lex)) {
+        lex->p++;
+        *dst = NULL;
+        *dst_len = 0;
+        return 0;
+    }
+
+    return mp_raw_string(lex, dst, dst_len);
+}
+
+static int mp_skip_bytes(struct autojson_lexer *lex, unsigned long long len)
+{
+    if (len > (unsigned long long) (lex->end - lex->p)) {
+        return autojson_lex_fail(lex, "unexpected end of input");
+    }
+
+    lex->p += len;
+    return 0;
+}
+
+static int mp_skip(struct autojson_lexer *lex, int depth)
+{
+    unsigned long long len;
+    size_t count;
+    int c = mp_peek(lex);
+
+    if (depth > AUTOJSON_MAX_DEPTH) {
+        return autojson_lex_fail(lex, "maximum nesting depth exceeded");
+    }
+
+    if (c < 0) {
+        return -1;
+    }
+
+    if (c < 0x80 || c >= 0xe0 || 0xc0 == c || 0xc2 == c || 0xc3 == c) {
+        lex->p++;
+        return 0;
+    }
+
+    if ((c & 0xe0) == 0xa0 || (c >= 0xd9 && c <= 0xdb)) {
+        const char *s;
+        size_t s_len;
+        return mp_raw_string(lex, &s, &s_len);
+    }
+
+    if ((c & 0xf0) == 0x80 || 0xde == c || 0xdf == c || (c & 0xf0) == 0x90 || 0xdc == c || 0xdd == c) {
+        int map = (c & 0xf0) == 0x80 || 0xde == c || 0xdf == c;
+        if (0 != (map ? autojson_mp_map_begin(lex, &count) : autojson_mp_array_begin(lex, &count))) {
+            return -1;
+        }
+
+        for (size_t i = 0; i < count * (map ? 2 : 1); i++) {
+            if (0 != mp_skip(lex, depth + 1)) {
+                return -1;
+            }
+        }
+
+        return 0;
+    }
+
+    switch (c) {
+    case 0xc4: case 0xc5: case 0xc6:
+        /* bin 8/16/32 */
+        if (0 != mp_big_endian(lex, 1 << (c - 0xc4), &len)) {
+            return -1;
+        }
+
+        return mp_skip_bytes(lex, len);
+    case 0xc7: case 0xc8: case 0xc9:
+        /* ext 8/16/32, plus the type byte */
+        if (0 != mp_big_endian(lex, 1 << (c - 0xc7), &len)) {
+            return -1;
+        }
+
+        return mp_skip_bytes(lex, len + 1);
+    case 0xca: case 0xcb:
+        return mp_skip_bytes(lex, 0xca == c ? 5 : 9);
+    case 0xcc: case 0xcd: case 0xce: case 0xcf:
+        return mp_skip_bytes(lex, 1 + (1 << (c - 0xcc)));
+    case 0xd0: case 0xd1: case 0xd2: case 0xd3:
+        return mp_skip_bytes(lex, 1 + (1 << (c - 0xd0)));
+    case 0xd4: case 0xd5: case 0xd6: case 0xd7: case 0xd8:
+        /* fixext, tag and type byte */
+        return mp_skip_bytes(lex, 2 + (1 << (c - 0xd4)));
+    default:
+        return autojson_lex_fail(lex, "invalid msgpack type");
+    }
+}
+
+int autojson_mp_skip(struct autojson_lexer *lex)
+{
+    return mp_skip(lex, 0);
+}
+
+int autojson_input_from_fd(struct autojson_input *input, int fd)
+{
+    struct stat st;
+    input->data = NULL;
+    input->len = 0;
+    input->mapped = 0;
+
+    if (0 == fstat(fd, &st) && S_ISREG(st.st_mode)) {
+        if (0 == st.st_size) {
+            return 0;
+        }
+
+        void *data = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+        if (MAP_FAILED != data) {
+            input->data = (const char *) data;
+            input->len = st.st_size;
+            input->mapped = 1;
+            return 0;
+        }
+    }
+
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+    for (;;) {
+        if (0 != autojson_buf_reserve(&buf, 64 * 1024)) {
+            autojson_buf_fini(&buf);
+            errno = ENOMEM;
+            return -1;
+        }
+
+        ssize_t n = read(fd, buf.data + buf.len, buf.cap - buf.len);
+        if (n < 0 && EINTR == errno) {
+            continue;
+        }
+
+        if (n < 0) {
+            int saved = errno;
+            autojson_buf_fini(&buf);
+            errno = saved;
+            return -1;
+        }
+
+        if (0 == n) {
+            break;
+        }
+
+        buf.len += n;
+    }
+
+    input->data = buf.data;
+    input->len = buf.len;
+    return 0;
+}
+
+void autojson_input_fini(struct autojson_input *input)
+{
+    if (input->mapped) {
+        munmap((void *) input->data, input->len);
+    } else {
+        free((void *) input->data);
+    }
+
+    input->data = NULL;
+    input->len = 0;
+    input->mapped = 0;
+}
+
+struct autojson_arena_block {
+    struct autojson_arena_block *next;
+    size_t size;
+    char data[] __attribute__((aligned(AUTOJSON_ARENA_ALIGN)));
+};
+
+void autojson_arena_init(struct autojson_arena *arena, size_t block_size)
+{
+    arena->head = NULL;
+    arena->current = NULL;
+    arena->p = NULL;
+    arena->end = NULL;
+    arena->block_size = block_size ? block_size : AUTOJSON_ARENA_DEFAULT_BLOCK_SIZE;
+}
+
+void autojson_arena_reset(struct autojson_arena *arena)
+{
+    arena->current = arena->head;
+    arena->p = arena->head ? arena->head->data : NULL;
+    arena->end = arena->head ? arena->head->data + arena->head->size : NULL;
+}
+
+void autojson_arena_fini(struct autojson_arena *arena)
+{
+    struct autojson_arena_block *block = arena->head;
+    while (NULL != block) {
+        struct autojson_arena_block *next = block->next;
+        free(block);
+        block = next;
+    }
+
+    autojson_arena_init(arena, arena->block_size);
+}
+
+/* Moves on to the next block that fits size, allocating one if needed */
+void *autojson_arena_alloc_slow(struct autojson_arena *arena, size_t size)
+{
+    struct autojson_arena_block *block = arena->current ? arena->current->next : arena->head;
+    while (NULL != block && block->size < size) {
+        block = block->next;
+    }
+
+    if (NULL == block) {
+        size_t block_size = size > arena->block_size ? size : arena->block_size;
+        block = (struct autojson_arena_block *) malloc(sizeof(*block) + block_size);
+        if (NULL == block) {
+            return NULL;
+        }
+
+        block->size = block_size;
+        if (NULL == arena->current) {
+            block->next = arena->head;
+            arena->head = block;
+        } else {
+            block->next = arena->current->next;
+            arena->current->next = block;
+        }
+    }
+
+    arena->current = block;
+    arena->p = block->data + size;
+    arena->end = block->data + block->size;
+    return block->data;
+}
+
+char *autojson_arena_strndup(struct autojson_arena *arena, const char *s, size_t len)
+{
+    char *copy = (char *) autojson_arena_alloc(arena, len + 1);
+    if (NULL != copy) {
+        memcpy(copy, s, len);
+        copy[len] = '\0';
+    }
+
+    return copy;
+}
+
+char *autojson_arena_strdup(struct autojson_arena *arena, const char *s)
+{
+    return autojson_arena_strndup(arena, s, strlen(s));
+}
+
+#ifdef AUTOJSON_STATS
+__thread unsigned long long autojson_stats_allocations;
+#endif
+
+/* Structures register themselves on their first call */
+static struct autojson_stats *stats_head;
+
+static const char *const stats_op_names[AUTOJSON_STATS_OPS] = {
+    "to_json", "from_json", "write_json", "parse_json", "write_json_array",
+    "write_json_lines", "parse_json_lines", "to_msgpack", "from_msgpack",
+};
+
+#ifdef AUTOJSON_STATS_LATENCY
+static long long stats_now_ns(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1000000000LL + ts.tv_nsec;
+}
+#endif
+
+void autojson_stats_begin(struct autojson_stats_call *call)
+{
+#ifdef AUTOJSON_STATS
+    call->allocations = autojson_stats_allocations;
+#else
+    call->allocations = 0;
+#endif
+#ifdef AUTOJSON_STATS_LATENCY
+    call->start_ns = stats_now_ns();
+#else
+    call->start_ns = 0;
+#endif
+}
+
+void autojson_stats_end(struct autojson_stats *stats, enum autojson_stats_op op,
+                        const struct autojson_stats_call *call, int failed, size_t bytes)
+{
+    struct autojson_op_stats *op_stats = &stats->ops[op];
+
+    if (0 == __atomic_exchange_n(&stats->registered, 1, __ATOMIC_ACQ_REL)) {
+        stats->next = __atomic_load_n(&stats_head, __ATOMIC_ACQUIRE);
+        while (!__atomic_compare_exchange_n(&stats_head, &stats->next, stats, 1,
+                                            __ATOMIC_RELEASE, __ATOMIC_ACQUIRE)) {
+        }
+    }
+
+    __atomic_add_fetch(&op_stats->calls, 1, __ATOMIC_RELAXED);
+    __atomic_add_fetch(&op_stats->bytes, bytes, __ATOMIC_RELAXED);
+    if (failed) {
+        __atomic_add_fetch(&op_stats->errors, 1, __ATOMIC_RELAXED);
+    }
+
+    unsigned long long peak = __atomic_load_n(&op_stats->peak_bytes, __ATOMIC_RELAXED);
+    while (bytes > peak && !__atomic_compare_exchange_n(&op_stats->peak_bytes, &peak, bytes, 1,
+                                                        __ATOMIC_RELAXED, __ATOMIC_RELAXED)) {
+    }
+
+#ifdef AUTOJSON_STATS
+    __atomic_add_fetch(&op_stats->allocations, autojson_stats_allocations - call->allocations, __ATOMIC_RELAXED);
+#endif
+#ifdef AUTOJSON_STATS_LATENCY
+    long long elapsed = stats_now_ns() - call->start_ns;
+    int bucket = 0;
+    while (bucket < AUTOJSON_STATS_BUCKETS - 1 && elapsed >= (2LL << bucket)) {
+        bucket++;
+    }
+
+    __atomic_add_fetch(&op_stats->latency_ns[bucket], 1, __ATOMIC_RELAXED);
+#endif
+}
+
+void autojson_stats_foreach(autojson_stats_callback callback, void *ctx)
+{
+    for (struct autojson_stats *stats = __atomic_load_n(&stats_head, __ATOMIC_ACQUIRE);
+         NULL != stats; stats = stats->next) {
+        for (int op = 0; op < AUTOJSON_STATS_OPS; op++) {
+            if (0 != stats->ops[op].calls) {
+                callback(stats->structure, stats_op_names[op], &stats->ops[op], ctx);
+            }
+        }
+    }
+}
+
+void autojson_stats_reset(void)
+{
+    for (struct autojson_stats *stats = __atomic_load_n(&stats_head, __ATOMIC_ACQUIRE);
+         NULL != stats; stats = stats->next) {
+        memset(stats->ops, 0, sizeof(stats->ops));
+    }
+}
+
+void autojson_stats_print(const char *structure, const char *op,
+                          const struct autojson_op_stats *stats, void *ctx)
+{
+    FILE *file = (FILE *) ctx;
+    fprintf(file, "{\"structure\": \"%s\", \"op\": \"%s\", \"calls\": %llu, \"errors\": %llu, "
+            "\"bytes\": %llu, \"peak_bytes\": %llu, \"allocations\": %llu, \"latency_ns\": [",
+            structure, op, stats->calls, stats->errors, stats->bytes, stats->peak_bytes, stats->allocations);
+
+    /* Trailing empty buckets are left out */
+    int buckets = AUTOJSON_STATS_BUCKETS;
+    while (buckets > 0 && 0 == stats->latency_ns[buckets - 1]) {
+        buckets--;
+    }
+
+    for (int i = 0; i < buckets; i++) {
+        fprintf(file, "%s%llu", i ? ", " : "", stats->latency_ns[i]);
+    }
+
+    fprintf(file, "]}\n");
+}
@@ -0,0 +1,418 @@
+#ifndef __AUTOJSON_RUNTIME_H__
+#define __AUTOJSON_RUNTIME_H__
+
+#include <stddef.h>
+#include <stdint.h>
+#include <string.h>
+
+/*
+ * Support code for the bindings cautojson generates with the non-jansson
+ * backends. Link autojson_runtime.c together with the generated _auto.c
+ * files.
+ */
+
+/*
+ * A growable output buffer. The caller may hand over its own storage
+ * with autojson_buf_init_static(); it is only replaced by a heap
+ * allocation once it runs out of room. Writes never fail individually:
+ * an allocation failure latches buf->error and turns every following
+ * write into a no-op, so a whole object can be written and checked once.
+ */
+struct autojson_buf {
+    char *data;
+    size_t len;
+    size_t cap;
+    int owned;
+    int error;
+};
+
+#define AUTOJSON_BUF_INIT {NULL, 0, 0, 1, 0}
+
+void autojson_buf_init(struct autojson_buf *buf);
+void autojson_buf_init_static(struct autojson_buf *buf, char *storage, size_t cap);
+void autojson_buf_fini(struct autojson_buf *buf);
+int autojson_buf_grow(struct autojson_buf *buf, size_t extra);
+void autojson_buf_put_integer(struct autojson_buf *buf, long long value);
+void autojson_buf_put_stringn(struct autojson_buf *buf, const char *s, size_t len);
+
+/*
+ * The number of bytes autojson_buf_put_integer() and
+ * autojson_buf_put_stringn() write for these values, for the generated
+ * <struct>_json_size() functions.
+ */
+size_t autojson_integer_json_size(long long value);
+size_t autojson_string_json_size(const char *s, size_t len);
+
+static inline int autojson_buf_reserve(struct autojson_buf *buf, size_t extra)
+{
+    if (buf->cap - buf->len >= extra) {
+        return 0;
+    }
+
+    return autojson_buf_grow(buf, extra);
+}
+
+static inline void autojson_buf_put(struct autojson_buf *buf, const char *data, size_t len)
+{
+    if (0 != autojson_buf_reserve(buf, len)) {
+        return;
+    }
+
+    memcpy(buf->data + buf->len, data, len);
+    buf->len += len;
+}
+
+static inline void autojson_buf_putc(struct autojson_buf *buf, char c)
+{
+    if (0 != autojson_buf_reserve(buf, 1)) {
+        return;
+    }
+
+    buf->data[buf->len++] = c;
+}
+
+static inline void autojson_buf_put_string(struct autojson_buf *buf, const char *s)
+{
+    autojson_buf_put_stringn(buf, s, strlen(s));
+}
+
+/*
+ * A pool of threads for the generated <struct>_write_json_parallel()
+ * functions. Lists of at least threshold elements are split into chunks
+ * that are written on the pool's threads, and the calling one, and then
+ * joined in order; the output is the same as <struct>_write_json()'s.
+ * Shorter lists, and every list when pool is NULL, are written in place.
+ * A pool serves one call at a time.
+ */
+struct autojson_pool;
+
+typedef int (*autojson_write_fn)(const void *item, struct autojson_buf *buf);
+
+struct autojson_pool *autojson_pool_create(int threads, size_t threshold);
+void autojson_pool_destroy(struct autojson_pool *pool);
+void autojson_write_parallel(struct autojson_pool *pool, struct autojson_buf *buf,
+                             const void *const *items, autojson_write_fn write);
+
+/*
+ * MessagePack encoding, used by the generated <struct>_to_msgpack()
+ * functions. Integers take the shortest encoding that holds them and
+ * autojson_buf_put_msgpack_string() writes nil for NULL.
+ */
+void autojson_buf_put_msgpack_integer(struct autojson_buf *buf, long long value);
+void autojson_buf_put_msgpack_stringn(struct autojson_buf *buf, const char *s, size_t len);
+void autojson_buf_put_msgpack_array(struct autojson_buf *buf, size_t count);
+
+static inline void autojson_buf_put_msgpack_string(struct autojson_buf *buf, const char *s)
+{
+    if (NULL == s) {
+        autojson_buf_putc(buf, (char) 0xc0);
+        return;
+    }
+
+    autojson_buf_put_msgpack_stringn(buf, s, strlen(s));
+}
+
+/*
+ * A bump allocator for parsers generated with --alloc=arena. Memory is
+ * carved out of large blocks and only given back all at once by
+ * autojson_arena_reset(), which keeps the blocks for the next round, or
+ * autojson_arena_fini().
+ */
+struct autojson_arena_block;
+
+struct autojson_arena {
+    struct autojson_arena_block *head;
+    struct autojson_arena_block *current;
+    char *p;
+    char *end;
+    size_t block_size;
+};
+
+#define AUTOJSON_ARENA_ALIGN 16
+#define AUTOJSON_ARENA_DEFAULT_BLOCK_SIZE (64 * 1024)
+
+void autojson_arena_init(struct autojson_arena *arena, size_t block_size);
+void autojson_arena_reset(struct autojson_arena *arena);
+void autojson_arena_fini(struct autojson_arena *arena);
+void *autojson_arena_alloc_slow(struct autojson_arena *arena, size_t size);
+char *autojson_arena_strdup(struct autojson_arena *arena, const char *s);
+char *autojson_arena_strndup(struct autojson_arena *arena, const char *s, size_t len);
+
+static inline void *autojson_arena_alloc(struct autojson_arena *arena, size_t size)
+{
+    size = (size + AUTOJSON_ARENA_ALIGN - 1) & ~((size_t) AUTOJSON_ARENA_ALIGN - 1);
+    if ((size_t) (arena->end - arena->p) < size) {
+        return autojson_arena_alloc_slow(arena, size);
+    }
+
+    void *p = arena->p;
+    arena->p += size;
+    return p;
+}
+
+/*
+ * Where and why a <struct>_parse_json() call failed. position is the
+ * byte offset into the input at which the error was detected and line
+ * the 1-based line it is on.
+ */
+struct autojson_error {
+    size_t position;
+    size_t line;
+    const char *text;
+};
+
+/*
+ * A whole file descriptor in memory, for the <struct>_parse_json_lines()
+ * parsers: regular files are mapped, anything else (pipes, sockets) is
+ * read until EOF. Returns 0 on success and -1 with errno set.
+ */
+struct autojson_input {
+    const char *data;
+    size_t len;
+    int mapped;
+};
+
+int autojson_input_from_fd(struct autojson_input *input, int fd);
+void autojson_input_fini(struct autojson_input *input);
+
+#define AUTOJSON_KEY_MAX 64
+
+/*
+ * Pull tokenizer over a complete, in-memory JSON document, used by the
+ * generated <struct>_parse_json_lexer() functions. All functions return
+ * 0 (or a positive value for the *_next iterators) on success and -1 on
+ * failure, after recording the first error in the lexer.
+ *
+ * Strings and arrays are allocated from arena when it is set and with
+ * malloc() otherwise, see autojson_lex_alloc().
+ */
+struct autojson_lexer {
+    const char *start;
+    const char *p;
+    const char *end;
+    const char *error;
+    size_t error_position;
+    struct autojson_arena *arena;
+    char key[AUTOJSON_KEY_MAX];
+};
+
+void autojson_lexer_init(struct autojson_lexer *lex, const char *buf, size_t len);
+void *autojson_lex_alloc(struct autojson_lexer *lex, size_t size);
+void autojson_lex_release(struct autojson_lexer *lex, void *p);
+void *autojson_lex_grow_array(struct autojson_lexer *lex, void *items, size_t *cap, size_t elem_size);
+int autojson_lex_fail(struct autojson_lexer *lex, const char *text);
+void autojson_lex_error(const struct autojson_lexer *lex, struct autojson_error *err);
+int autojson_lex_end(struct autojson_lexer *lex);
+int autojson_lex_object_begin(struct autojson_lexer *lex);
+int autojson_lex_object_next(struct autojson_lexer *lex, int *member, const char **key, size_t *key_len);
+int autojson_lex_array_begin(struct autojson_lexer *lex);
+int autojson_lex_array_next(struct autojson_lexer *lex, int *element);
+int autojson_lex_integer(struct autojson_lexer *lex, long long *value);
+int autojson_lex_string_copy(struct autojson_lexer *lex, char *dst, size_t size);
+int autojson_lex_string_dup(struct autojson_lexer *lex, char **dst);
+int autojson_lex_string_borrow(struct autojson_lexer *lex, const char **dst, size_t *len);
+int autojson_lex_skip(struct autojson_lexer *lex);
+int autojson_lex_more(struct autojson_lexer *lex);
+int autojson_lex_line_end(struct autojson_lexer *lex);
+
+/*
+ * The same lexer reads MessagePack for the generated
+ * <struct>_from_msgpack_reader() functions. Maps and arrays report their
+ * element count up front; keys point into the input and are not copied.
+ * autojson_mp_string_dup() stores NULL for nil.
+ *
+ * The *_string_borrow() functions store a pointer into the input and the
+ * string's length instead of a NUL-terminated copy. JSON strings with
+ * escapes are decoded into the arena, and fail without one.
+ */
+int autojson_mp_end(struct autojson_lexer *lex);
+int autojson_mp_map_begin(struct autojson_lexer *lex, size_t *count);
+int autojson_mp_array_begin(struct autojson_lexer *lex, size_t *count);
+int autojson_mp_key(struct autojson_lexer *lex, const char **key, size_t *key_len);
+int autojson_mp_integer(struct autojson_lexer *lex, long long *value);
+int autojson_mp_string_copy(struct autojson_lexer *lex, char *dst, size_t size);
+int autojson_mp_string_dup(struct autojson_lexer *lex, char **dst);
+int autojson_mp_string_borrow(struct autojson_lexer *lex, const char **dst, size_t *len);
+int autojson_mp_skip(struct autojson_lexer *lex);
+
+/*
+ * Push parser behind the generated <struct>_parser_init(), _feed() and
+ * _finish() functions, for input that arrives in chunks. The tokenizer
+ * keeps its state between autojson_push_feed() calls, and holds on to
+ * the bytes of a string or number that a chunk boundary splits and
+ * nothing else. Each token goes to the handler of the innermost
+ * structure being parsed.
+ *
+ * Each handler is a generated <struct>_push_event(). It runs from a
+ * frame that records how far the structure has been parsed, enters a
+ * new frame for every nested structure, and leaves it when the
+ * structure's '}' is reached. Handlers get AUTOJSON_PUSH_CHILD_DONE
+ * once the frame they entered is left. Once parsing fails they get
+ * AUTOJSON_PUSH_ABORT, innermost first, and release whatever they
+ * allocated.
+ */
+#define AUTOJSON_PUSH_MAX_FRAMES 64
+#define AUTOJSON_PUSH_MAX_DEPTH 2048
+#define AUTOJSON_PUSH_SEEN_WORDS 4
+
+enum autojson_push_event {
+    AUTOJSON_PUSH_OBJECT_BEGIN,
+    AUTOJSON_PUSH_OBJECT_END,
+    AUTOJSON_PUSH_ARRAY_BEGIN,
+    AUTOJSON_PUSH_ARRAY_END,
+    AUTOJSON_PUSH_KEY,
+    AUTOJSON_PUSH_STRING,
+    AUTOJSON_PUSH_NUMBER,
+    AUTOJSON_PUSH_LITERAL,
+    AUTOJSON_PUSH_CHILD_DONE,
+    AUTOJSON_PUSH_ABORT,
+};
+
+/* Where a frame's structure is: before its '{', between members, before a value or inside an array */
+enum autojson_push_state {
+    AUTOJSON_PUSH_START,
+    AUTOJSON_PUSH_MEMBERS,
+    AUTOJSON_PUSH_VALUE,
+    AUTOJSON_PUSH_ELEMENTS,
+};
+
+struct autojson_push;
+struct autojson_push_frame;
+
+typedef int (*autojson_push_handler)(struct autojson_push *push, struct autojson_push_frame *frame, int event);
+
+struct autojson_push_frame {
+    autojson_push_handler handler;
+    void *out;
+    int state;
+    /* The member being parsed, and whether a nested structure of it is */
+    int field;
+    int child;
+    /* Elements of the current array, and the list items of a struct X ** member */
+    size_t count;
+    size_t cap;
+    void *items;
+    uint64_t seen[AUTOJSON_PUSH_SEEN_WORDS];
+};
+
+struct autojson_push {
+    int expect;
+    int token;
+    int escape;
+    size_t depth;
+    size_t skip;
+    unsigned char objects[AUTOJSON_PUSH_MAX_DEPTH / 8];
+    struct autojson_buf partial;
+    /* The current string, number or literal token, quotes included */
+    const char *raw;
+    size_t raw_len;
+    size_t raw_position;
+    const char *key;
+    size_t key_len;
+    char key_buffer[AUTOJSON_KEY_MAX];
+    size_t offset;
+    size_t position;
+    size_t line;
+    const char *error;
+    size_t error_position;
+    size_t error_line;
+    struct autojson_arena *arena;
+    int frame_count;
+    struct autojson_push_frame frames[AUTOJSON_PUSH_MAX_FRAMES];
+};
+
+void autojson_push_init(struct autojson_push *push, autojson_push_handler handler, void *out,
+                        struct autojson_arena *arena);
+int autojson_push_feed(struct autojson_push *push, const char *chunk, size_t len);
+int autojson_push_finish(struct autojson_push *push, struct autojson_error *err);
+
+/* For the generated handlers */
+int autojson_push_fail(struct autojson_push *push, const char *text);
+int autojson_push_enter(struct autojson_push *push, autojson_push_handler handler, void *out, int event);
+int autojson_push_leave(struct autojson_push *push);
+int autojson_push_key(struct autojson_push *push, struct autojson_push_frame *frame, int field);
+int autojson_push_object_end(struct autojson_push *push, struct autojson_push_frame *frame, int fields);
+int autojson_push_integer(struct autojson_push *push, int event, long long *value);
+int autojson_push_string_copy(struct autojson_push *push, int event, char *dst, size_t size);
+int autojson_push_string_dup(struct autojson_push *push, int event, char **dst);
+int autojson_push_array_begin(struct autojson_push *push, int event);
+void *autojson_push_alloc(struct autojson_push *push, size_t size);
+void autojson_push_release(struct autojson_push *push, void *p);
+void *autojson_push_grow_array(struct autojson_push *push, void *items, size_t *cap, size_t elem_size);
+int autojson_push_grow_list(struct autojson_push *push, struct autojson_push_frame *frame, void ***list,
+                            size_t elem_size);
+
+/*
+ * Per-structure counters kept by bindings generated with --instrument.
+ * They are only compiled in when the generated code and this runtime
+ * are built with -DAUTOJSON_STATS, and latency histograms only with
+ * -DAUTOJSON_STATS_LATENCY as well; otherwise the generated functions
+ * are exactly the uninstrumented ones.
+ *
+ * Every public entry point counts its calls, including those made for
+ * nested structures, the calls that failed, the bytes it consumed or
+ * appended and the allocations made on its behalf. latency_ns[i] counts
+ * the calls that took [2^i, 2^(i+1)) nanoseconds. Counters are updated
+ * atomically but read without synchronization.
+ */
+enum autojson_stats_op {
+    AUTOJSON_STATS_TO_JSON,
+    AUTOJSON_STATS_FROM_JSON,
+    AUTOJSON_STATS_WRITE_JSON,
+    AUTOJSON_STATS_PARSE_JSON,
+    AUTOJSON_STATS_WRITE_JSON_ARRAY,
+    AUTOJSON_STATS_WRITE_JSON_LINES,
+    AUTOJSON_STATS_PARSE_JSON_LINES,
+    AUTOJSON_STATS_TO_MSGPACK,
+    AUTOJSON_STATS_FROM_MSGPACK,
+    AUTOJSON_STATS_OPS
+};
+
+#define AUTOJSON_STATS_BUCKETS 32
+
+struct autojson_op_stats {
+    unsigned long long calls;
+    unsigned long long errors;
+    unsigned long long bytes;
+    unsigned long long peak_bytes;
+    unsigned long long allocations;
+    unsigned long long latency_ns[AUTOJSON_STATS_BUCKETS];
+};
+
+struct autojson_stats {
+    const char *structure;
+    struct autojson_stats *next;
+    int registered;
+    struct autojson_op_stats ops[AUTOJSON_STATS_OPS];
+};
+
+struct autojson_stats_call {
+    unsigned long long allocations;
+    long long start_ns;
+};
+
+typedef void (*autojson_stats_callback)(const char *structure, const char *op,
+                                        const struct autojson_op_stats *stats, void *ctx);
+
+void autojson_stats_begin(struct autojson_stats_call *call);
+void autojson_stats_end(struct autojson_stats *stats, enum autojson_stats_op op,
+                        const struct autojson_stats_call *call, int failed, size_t bytes);
+
+/*
+ * Calls callback for every function of every structure that was called
+ * since the last reset. autojson_stats_print() is a callback that
+ * writes one JSON object per line to the FILE * in ctx.
+ */
+void autojson_stats_foreach(autojson_stats_callback callback, void *ctx);
+void autojson_stats_reset(void);
+void autojson_stats_print(const char *structure, const char *op,
+                          const struct autojson_op_stats *stats, void *ctx);
+
+#ifdef AUTOJSON_STATS
+extern __thread unsigned long long autojson_stats_allocations;
+#define AUTOJSON_STATS_ALLOC(p) (autojson_stats_allocations++, (p))
+#else
+#define AUTOJSON_STATS_ALLOC(p) (p)
+#endif
+
+#endif /* __AUTOJSON_RUNTIME_H__ */
@@ -0,0 +1,392 @@
+#include "autojson_tables.h"
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+static long long get_integer(const char *p, size_t size)
+{
+    switch (size) {
+    case sizeof(signed char):
+        return *(const signed char *) p;
+    case sizeof(short):
+        return *(const short *) p;
+    case sizeof(int):
+        return *(const int *) p;
+    default:
+        return *(const long long *) p;
+    }
+}
+
+static void set_integer(char *p, size_t size, long long value)
+{
+    switch (size) {
+    case sizeof(signed char):
+        *(signed char *) p = value;
+        break;
+    case sizeof(short):
+        *(short *) p = value;
+        break;
+    case sizeof(int):
+        *(int *) p = value;
+        break;
+    default:
+        *(long long *) p = value;
+        break;
+    }
+}
+
+static size_t element_size(const struct autojson_field *f)
+{
+    return NULL == f->record ? f->size : f->record->size;
+}
+
+static size_t counted_length(const struct autojson_field *f, const char *base)
+{
+    return NULL == *(char *const *) (base + f->offset) ? 0 : *(const size_t *) (base + f->length_offset);
+}
+
+static json_t *field_to_json(const struct autojson_field *f, const char *base)
+{
+    const char *p = base + f->offset;
+    json_t *array;
+
+    switch (f->kind) {
+    case AUTOJSON_FIELD_INTEGER:
+        return json_integer(get_integer(p, f->size));
+    case AUTOJSON_FIELD_INTEGER_ARRAY:
+        array = json_array();
+        for (size_t i = 0; i < f->count; i++) {
+            json_array_append_new(array, json_integer(get_integer(p + i * f->size, f->size)));
+        }
+        return array;
+    case AUTOJSON_FIELD_STATIC_STRING:
+        return json_string(p);
+    case AUTOJSON_FIELD_STRING:
+        return json_string(*(char *const *) p);
+    case AUTOJSON_FIELD_BORROWED_STRING:
+        if (AUTOJSON_NO_LENGTH == f->length_offset || NULL == *(const char *const *) p) {
+            return json_string(*(const char *const *) p);
+        }
+        return json_stringn(*(const char *const *) p, *(const size_t *) (base + f->length_offset));
+    case AUTOJSON_FIELD_RECORD:
+        return autojson_table_to_json(f->record, p);
+    case AUTOJSON_FIELD_RECORD_ARRAY:
+        array = json_array();
+        for (size_t i = 0; i < f->count; i++) {
+            json_array_append_new(array, autojson_table_to_json(f->record, p + i * f->record->size));
+        }
+        return array;
+    case AUTOJSON_FIELD_VAR_ARRAY:
+        array = json_array();
+        for (void *const *items = *(void *const *const *) p; NULL != items && NULL != *items; items++) {
+            json_array_append_new(array, autojson_table_to_json(f->record, *items));
+        }
+        return array;
+    case AUTOJSON_FIELD_COUNTED_ARRAY:
+        array = json_array();
+        for (size_t i = 0; i < counted_length(f, base); i++) {
+            const char *item = *(char *const *) p + i * element_size(f);
+            json_array_append_new(array, NULL == f->record ? json_integer(get_integer(item, f->size))
+                                                           : autojson_table_to_json(f->record, item));
+        }
+        return array;
+    }
+
+    return NULL;
+}
+
+json_t *autojson_table_to_json(const struct autojson_struct *desc, const void *this)
+{
+    json_t *obj = json_object();
+    for (size_t i = 0; i < desc->field_count; i++) {
+        /* NULL strings are left out, like the unrolled serializers do. Names are C identifiers, valid UTF-8 */
+        json_object_set_new_nocheck(obj, desc->fields[i].name, field_to_json(&desc->fields[i], this));
+    }
+
+    return obj;
+}
+
+static int var_array_from_json(const struct autojson_field *f, json_t *value, void ***out, const char **error)
+{
+    size_t count = json_array_size(value);
+    char *items = count ? calloc(count, f->record->size) : NULL;
+    void **pointers = malloc(sizeof(*pointers) * (count + 1));
+    if ((count && NULL == items) || NULL == pointers) {
+        free(items);
+        free(pointers);
+        *error = "out of memory";
+        return -1;
+    }
+
+    /* The zeroed elements are all in place up front, so _free can always release the list */
+    for (size_t i = 0; i < count; i++) {
+        pointers[i] = items + i * f->record->size;
+    }
+
+    pointers[count] = NULL;
+    *out = pointers;
+    for (size_t i = 0; i < count; i++) {
+        if (0 != autojson_table_from_json(f->record, json_array_get(value, i), pointers[i])) {
+            return -1;
+        }
+    }
+
+    return 0;
+}
+
+static int counted_array_from_json(const struct autojson_field *f, json_t *value, char *base, const char **error)
+{
+    size_t count = json_array_size(value);
+    char *items = count ? calloc(count, element_size(f)) : NULL;
+    if (count && NULL == items) {
+        *error = "out of memory";
+        return -1;
+    }
+
+    /* Like var arrays, every zeroed element is counted up front so _free can always release them */
+    *(char **) (base + f->offset) = items;
+    *(size_t *) (base + f->length_offset) = count;
+    for (size_t i = 0; i < count; i++) {
+        json_t *element = json_array_get(value, i);
+        if (NULL != f->record) {
+            if (0 != autojson_table_from_json(f->record, element, items + i * f->record->size)) {
+                return -1;
+            }
+        } else if (json_is_integer(element)) {
+            set_integer(items + i * f->size, f->size, json_integer_value(element));
+        } else {
+            return -1;
+        }
+    }
+
+    return 0;
+}
+
+static int field_from_json(const struct autojson_field *f, json_t *value, char *base, const char **error)
+{
+    char *p = base + f->offset;
+
+    switch (f->kind) {
+    case AUTOJSON_FIELD_INTEGER:
+        if (!json_is_integer(value)) {
+            return -1;
+        }
+        set_integer(p, f->size, json_integer_value(value));
+        return 0;
+    case AUTOJSON_FIELD_INTEGER_ARRAY:
+        if (!json_is_array(value) || f->count != json_array_size(value)) {
+            return -1;
+        }
+        for (size_t i = 0; i < f->count; i++) {
+            json_t *element = json_array_get(value, i);
+            if (!json_is_integer(element)) {
+                return -1;
+            }
+            set_integer(p + i * f->size, f->size, json_integer_value(element));
+        }
+        return 0;
+    case AUTOJSON_FIELD_STATIC_STRING:
+        if (!json_is_string(value)) {
+            return -1;
+        }
+        strncpy(p, json_string_value(value), f->size - 1);
+        return 0;
+    case AUTOJSON_FIELD_STRING:
+        if (!json_is_string(value)) {
+            return -1;
+        }
+        if (NULL == (*(char **) p = strdup(json_string_value(value)))) {
+            *error = "out of memory";
+            return -1;
+        }
+        return 0;
+    case AUTOJSON_FIELD_BORROWED_STRING:
+        if (!json_is_string(value)) {
+            return -1;
+        }
+        *(const char **) p = json_string_value(value);
+        if (AUTOJSON_NO_LENGTH != f->length_offset) {
+            *(size_t *) (base + f->length_offset) = json_string_length(value);
+        }
+        return 0;
+    case AUTOJSON_FIELD_RECORD:
+        return autojson_table_from_json(f->record, value, p);
+    case AUTOJSON_FIELD_RECORD_ARRAY:
+        if (!json_is_array(value) || f->count != json_array_size(value)) {
+            return -1;
+        }
+        for (size_t i = 0; i < f->count; i++) {
+            if (0 != autojson_table_from_json(f->record, json_array_get(value, i), p + i * f->record->size)) {
+                return -1;
+            }
+        }
+        return 0;
+    case AUTOJSON_FIELD_VAR_ARRAY:
+        if (!json_is_array(value)) {
+            return -1;
+        }
+        return var_array_from_json(f, value, (void ***) p, error);
+    case AUTOJSON_FIELD_COUNTED_ARRAY:
+        if (!json_is_array(value)) {
+            return -1;
+        }
+        return counted_array_from_json(f, value, base, error);
+    }
+
+    return -1;
+}
+
+int autojson_table_from_json(const struct autojson_struct *desc, json_t *json, void *out)
+{
+    const struct autojson_field *f = NULL;
+    const char *error = "object expected";
+
+    memset(out, 0, desc->size);
+    if (!json_is_object(json)) {
+        goto fail;
+    }
+
+    for (f = desc->fields; f < desc->fields + desc->field_count; f++) {
+        json_t *value = json_object_get(json, f->name);
+        error = NULL == value ? "missing key" : "invalid value";
+        if (NULL == value || 0 != field_from_json(f, value, out, &error)) {
+            goto fail;
+        }
+    }
+
+    return 0;
+fail:
+    fprintf(stderr, "%s_from_json error: %s%s%s\n", desc->name,
+            NULL == f ? "" : f->name, NULL == f ? "" : ": ", error);
+    autojson_table_free(desc, out);
+    memset(out, 0, desc->size);
+    return -1;
+}
+
+static size_t string_length(const struct autojson_field *f, const char *base, const char *s)
+{
+    if (AUTOJSON_FIELD_BORROWED_STRING == f->kind && AUTOJSON_NO_LENGTH != f->length_offset) {
+        return *(const size_t *) (base + f->length_offset);
+    }
+
+    return strlen(s) + 1;
+}
+
+static int field_equal(const struct autojson_field *f, const char *a_base, const char *b_base)
+{
+    const char *a = a_base + f->offset;
+    const char *b = b_base + f->offset;
+
+    switch (f->kind) {
+    case AUTOJSON_FIELD_INTEGER:
+        return get_integer(a, f->size) == get_integer(b, f->size);
+    case AUTOJSON_FIELD_INTEGER_ARRAY:
+        return 0 == memcmp(a, b, f->size * f->count);
+    case AUTOJSON_FIELD_STATIC_STRING:
+        return 0 == strncmp(a, b, f->size);
+    case AUTOJSON_FIELD_STRING:
+    case AUTOJSON_FIELD_BORROWED_STRING: {
+        const char *x = *(const char *const *) a, *y = *(const char *const *) b;
+        if (NULL == x || NULL == y) {
+            return x == y;
+        }
+
+        size_t length = string_length(f, a_base, x);
+        return length == string_length(f, b_base, y) && 0 == memcmp(x, y, length);
+    }
+    case AUTOJSON_FIELD_RECORD:
+        return autojson_table_equal(f->record, a, b);
+    case AUTOJSON_FIELD_RECORD_ARRAY:
+        for (size_t i = 0; i < f->count; i++) {
+            if (!autojson_table_equal(f->record, a + i * f->record->size, b + i * f->record->size)) {
+                return 0;
+            }
+        }
+        return 1;
+    case AUTOJSON_FIELD_VAR_ARRAY: {
+        /* NULL lists serialize as empty ones */
+        void *const *x = *(void *const *const *) a, *const *y = *(void *const *const *) b;
+        for (size_t i = 0; ; i++) {
+            const void *p = NULL == x ? NULL : x[i];
+            const void *q = NULL == y ? NULL : y[i];
+            if (NULL == p || NULL == q) {
+                return p == q;
+            }
+            if (!autojson_table_equal(f->record, p, q)) {
+                return 0;
+            }
+        }
+    }
+    case AUTOJSON_FIELD_COUNTED_ARRAY: {
+        size_t count = counted_length(f, a_base);
+        const char *x = *(const char *const *) a, *y = *(const char *const *) b;
+        if (count != counted_length(f, b_base)) {
+            return 0;
+        }
+        if (NULL == f->record) {
+            return 0 == count || 0 == memcmp(x, y, count * f->size);
+        }
+        for (size_t i = 0; i < count; i++) {
+            if (!autojson_table_equal(f->record, x + i * f->record->size, y + i * f->record->size)) {
+                return 0;
+            }
+        }
+        return 1;
+    }
+    }
+
+    return 0;
+}
+
+int autojson_table_equal(const struct autojson_struct *desc, const void *a, const void *b)
+{
+    for (size_t i = 0; i < desc->field_count; i++) {
+        if (!field_equal(&desc->fields[i], a, b)) {
+            return 0;
+        }
+    }
+
+    return 1;
+}
+
+void autojson_table_free(const struct autojson_struct *desc, void *this)
+{
+    for (const struct autojson_field *f = desc->fields; f < desc->fields + desc->field_count; f++) {
+        char *p = (char *) this + f->offset;
+        switch (f->kind) {
+        case AUTOJSON_FIELD_STRING:
+            free(*(char **) p);
+            break;
+        case AUTOJSON_FIELD_RECORD:
+            autojson_table_free(f->record, p);
+            break;
+        case AUTOJSON_FIELD_RECORD_ARRAY:
+            for (size_t i = 0; i < f->count; i++) {
+                autojson_table_free(f->record, p + i * f->record->size);
+            }
+            break;
+        case AUTOJSON_FIELD_VAR_ARRAY: {
+            void **items = *(void ***) p;
+            if (NULL == items) {
+                break;
+            }
+            for (size_t i = 0; NULL != items[i]; i++) {
+                autojson_table_free(f->record, items[i]);
+            }
+            free(*items);
+            free(items);
+            break;
+        }
+        case AUTOJSON_FIELD_COUNTED_ARRAY: {
+            char *items = *(char **) p;
+            for (size_t i = 0; NULL != f->record && i < counted_length(f, this); i++) {
+                autojson_table_free(f->record, items + i * f->record->size);
+            }
+            free(items);
+            break;
+        }
+        default:
+            break;
+        }
+    }
+}
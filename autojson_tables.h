@@ -0,0 +1,60 @@
+#ifndef __AUTOJSON_TABLES_H__
+#define __AUTOJSON_TABLES_H__
+
+#include <stddef.h>
+#include <jansson.h>
+
+/*
+ * Support code for the bindings cautojson generates with --mode=tables.
+ * Instead of a serializer, parser and destructor per structure those
+ * bindings only describe every structure's fields, and the functions
+ * below do the work for any of them. Link autojson_tables.c together
+ * with the generated _auto.c files.
+ */
+enum autojson_field_kind {
+    AUTOJSON_FIELD_INTEGER,         /* int, long, long long or enum of size bytes */
+    AUTOJSON_FIELD_INTEGER_ARRAY,   /* count integers of size bytes each */
+    AUTOJSON_FIELD_STATIC_STRING,   /* char[size] */
+    AUTOJSON_FIELD_STRING,          /* char *, owned */
+    AUTOJSON_FIELD_BORROWED_STRING, /* char *, pointing into the parsed json_t */
+    AUTOJSON_FIELD_RECORD,          /* struct record */
+    AUTOJSON_FIELD_RECORD_ARRAY,    /* struct record[count] */
+    AUTOJSON_FIELD_VAR_ARRAY,       /* NULL terminated struct record ** */
+    AUTOJSON_FIELD_COUNTED_ARRAY,   /* struct record * or integers of size bytes, with a size_t count */
+};
+
+#define AUTOJSON_NO_LENGTH ((size_t) -1)
+
+struct autojson_struct;
+
+struct autojson_field {
+    const char *name;
+    size_t offset;
+    enum autojson_field_kind kind;
+    size_t size;
+    size_t count;
+    /* Where a borrowed string's size_t length or a counted array's size_t count goes, or AUTOJSON_NO_LENGTH */
+    size_t length_offset;
+    const struct autojson_struct *record;
+};
+
+struct autojson_struct {
+    const char *name;
+    size_t size;
+    size_t field_count;
+    const struct autojson_field *fields;
+};
+
+#define AUTOJSON_MEMBER_SIZE(type, member) sizeof(((type *) 0)->member)
+
+/*
+ * The same contracts as the unrolled <struct>_to_json(), _from_json(),
+ * _equal() and _free(): the parser fails on missing keys and values of
+ * the wrong type and leaves nothing allocated when it does.
+ */
+json_t *autojson_table_to_json(const struct autojson_struct *desc, const void *this);
+int autojson_table_from_json(const struct autojson_struct *desc, json_t *json, void *out);
+int autojson_table_equal(const struct autojson_struct *desc, const void *a, const void *b);
+void autojson_table_free(const struct autojson_struct *desc, void *this);
+
+#endif /* __AUTOJSON_TABLES_H__ */
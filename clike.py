@@ -32,6 +32,9 @@ class Stmt(object):
     def render(self):
         return [self.text + self.suffix]
 
+    def lines(self, indent = ""):
+        yield indent + self.text + self.suffix
+
 EmptyStmt = Stmt("", suffix = "")
 
 class Doc(object):
@@ -50,6 +53,10 @@ class Doc(object):
             lines.append("//")
         return lines 
 
+    def lines(self, indent = ""):
+        for line in self.render():
+            yield indent + line
+
 
 class Block(object):
     def __init__(self, text, *args, **kwargs):
@@ -84,14 +91,34 @@ class Block(object):
         self.stack.pop(-1)
 
     def render(self):
-        lines = self.title.render()
+        return list(self.lines())
+
+    def _head(self, indent):
+        for line in self.title.lines(indent):
+            yield line
         if self.prefix:
-            lines.append(self.prefix)
-        for child in self.children:
-            lines.extend("\t" + l for l in child.render())
-        if self.suffix:
-            lines.append(self.suffix)
-        return lines
+            yield indent + self.prefix
+
+    def lines(self, indent = ""):
+        """Yields the rendered lines one by one, walking nested blocks
+        with an explicit stack instead of joining their lines at every level"""
+        for line in self._head(indent):
+            yield line
+        stack = [(self, indent, iter(self.children))]
+        while stack:
+            block, block_indent, children = stack[-1]
+            for child in children:
+                if isinstance(child, Block):
+                    for line in child._head(block_indent + "\t"):
+                        yield line
+                    stack.append((child, block_indent + "\t", iter(child.children)))
+                    break
+                for line in child.lines(block_indent + "\t"):
+                    yield line
+            else:
+                stack.pop()
+                if block.suffix:
+                    yield block_indent + block.suffix
 
 
 class Module(Block):
@@ -101,11 +128,18 @@ class Module(Block):
         return self
     def __exit__(self, t, v, tb):
         pass
-    def render(self):
-        lines = []
+    def lines(self, indent = ""):
         for child in self.children:
-            lines.extend(child.render())
-        return "\n".join(lines)
+            for line in child.lines(indent):
+                yield line
+    def render(self):
+        return "\n".join(self.lines())
+    def write(self, f):
+        """Same as f.write(self.render()), without holding the text in memory"""
+        separator = ""
+        for line in self.lines():
+            f.write(separator + line)
+            separator = "\n"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,293 @@
+#include "bench_header_auto.h"
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+
+/*
+ * Throughput and allocation benchmark for the generated bindings.
+ *
+ * Every benchmark serializes, parses and frees one representative
+ * structure through the jansson and the direct backends, and serializes
+ * it with the parallel direct writer, and prints one JSON object per
+ * measurement, e.g.
+ *
+ * {"benchmark": "item_list", "op": "parse", "backend": "direct", "iterations": 512,
+ *  "bytes": 872014, "ns_per_op": 2412838.1, "mb_per_s": 361.41, "mallocs_per_op": 3.00, "frees_per_op": 2.00}
+ *
+ * bytes is the size of the compact JSON document and mb_per_s is relative
+ * to it for all operations. trusted_document is document with its strings
+ * annotated ///< trusted, which jansson takes without checking them.
+ * Usage: bench [benchmark-name]
+ */
+
+#define MIN_TIME_NS (200 * 1000 * 1000.0)
+#define PARSE_BATCH 16
+
+/* Count allocations by replacing glibc's malloc family, which also sees jansson's */
+extern void *__libc_malloc(size_t size);
+extern void *__libc_calloc(size_t n, size_t size);
+extern void *__libc_realloc(void *p, size_t size);
+extern void __libc_free(void *p);
+
+static size_t malloc_count;
+static size_t free_count;
+
+void *malloc(size_t size) { malloc_count++; return __libc_malloc(size); }
+void *calloc(size_t n, size_t size) { malloc_count++; return __libc_calloc(n, size); }
+void *realloc(void *p, size_t size) { malloc_count++; return __libc_realloc(p, size); }
+void free(void *p) { if (NULL != p) free_count++; __libc_free(p); }
+
+struct scenario {
+    const char *name;
+    const void *object;
+    size_t object_size;
+    json_t *(*to_json)(const void *object);
+    int (*write_json)(const void *object, struct autojson_buf *buf);
+    int (*write_json_parallel)(const void *object, struct autojson_buf *buf, struct autojson_pool *pool);
+    int (*from_json)(json_t *json, void *out);
+    int (*parse_json)(const char *buf, size_t len, void *out);
+    void (*free)(void *object);
+    struct autojson_buf text;
+};
+
+#define SCENARIO(type, object)                                                      \
+    static json_t *type##_to_json_thunk(const void *p) { return type##_to_json(p); } \
+    static int type##_write_json_thunk(const void *p, struct autojson_buf *buf)      \
+    { return type##_write_json(p, buf); }                                            \
+    static int type##_write_json_parallel_thunk(const void *p, struct autojson_buf *buf, \
+                                                struct autojson_pool *pool)          \
+    { return type##_write_json_parallel(p, buf, pool); }                             \
+    static int type##_from_json_thunk(json_t *json, void *out)                       \
+    { return type##_from_json(json, out); }                                          \
+    static int type##_parse_json_thunk(const char *buf, size_t len, void *out)       \
+    { return type##_parse_json(buf, len, out, NULL); }                               \
+    static void type##_free_thunk(void *p) { type##_free(p); }                       \
+    static struct scenario type##_scenario = {#type, &object, sizeof(struct type),   \
+                                              type##_to_json_thunk,                  \
+                                              type##_write_json_thunk,               \
+                                              type##_write_json_parallel_thunk,      \
+                                              type##_from_json_thunk,                \
+                                              type##_parse_json_thunk,               \
+                                              type##_free_thunk,                     \
+                                              AUTOJSON_BUF_INIT}
+
+static double now_ns(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1e9 + ts.tv_nsec;
+}
+
+static void report(const struct scenario *s, const char *op, const char *backend,
+                   unsigned long iterations, double elapsed_ns, size_t mallocs, size_t frees)
+{
+    double ns_per_op = elapsed_ns / iterations;
+    printf("{\"benchmark\": \"%s\", \"op\": \"%s\", \"backend\": \"%s\", \"iterations\": %lu, "
+           "\"bytes\": %zu, \"ns_per_op\": %.1f, \"mb_per_s\": %.2f, "
+           "\"mallocs_per_op\": %.2f, \"frees_per_op\": %.2f}\n",
+           s->name, op, backend, iterations, s->text.len, ns_per_op,
+           s->text.len / ns_per_op * 1e9 / (1024 * 1024),
+           (double) mallocs / iterations, (double) frees / iterations);
+    fflush(stdout);
+}
+
+static void serialize_jansson(struct scenario *s, struct autojson_buf *buf)
+{
+    json_t *json = s->to_json(s->object);
+    char *text = json_dumps(json, JSON_COMPACT);
+    free(text);
+    json_decref(json);
+}
+
+static void serialize_direct(struct scenario *s, struct autojson_buf *buf)
+{
+    buf->len = 0;
+    s->write_json(s->object, buf);
+}
+
+static struct autojson_pool *pool;
+
+static void serialize_parallel(struct scenario *s, struct autojson_buf *buf)
+{
+    buf->len = 0;
+    s->write_json_parallel(s->object, buf, pool);
+}
+
+static void measure_serialize(struct scenario *s, const char *backend,
+                              void (*serialize)(struct scenario *, struct autojson_buf *))
+{
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+    unsigned long iterations;
+    unsigned long total = 0;
+    double elapsed = 0;
+    size_t mallocs = 0, frees = 0;
+
+    serialize(s, &buf);
+    for (iterations = 1; elapsed < MIN_TIME_NS; iterations *= 2) {
+        size_t mallocs_before = malloc_count, frees_before = free_count;
+        double start = now_ns();
+        for (unsigned long i = 0; i < iterations; i++) {
+            serialize(s, &buf);
+        }
+
+        elapsed += now_ns() - start;
+        mallocs += malloc_count - mallocs_before;
+        frees += free_count - frees_before;
+        total += iterations;
+    }
+
+    report(s, "serialize", backend, total, elapsed, mallocs, frees);
+    autojson_buf_fini(&buf);
+}
+
+static int parse_jansson(struct scenario *s, void *out)
+{
+    json_t *json = json_loadb(s->text.data, s->text.len, 0, NULL);
+    int rc = s->from_json(json, out);
+    json_decref(json);
+    return rc;
+}
+
+static int parse_direct(struct scenario *s, void *out)
+{
+    return s->parse_json(s->text.data, s->text.len, out);
+}
+
+/* Parses and frees in batches so each phase can be timed on its own */
+static void measure_parse(struct scenario *s, const char *backend, int (*parse)(struct scenario *, void *))
+{
+    char *objects = malloc(s->object_size * PARSE_BATCH);
+    unsigned long total = 0;
+    double parse_elapsed = 0, free_elapsed = 0;
+    size_t parse_mallocs = 0, parse_frees = 0, free_mallocs = 0, free_frees = 0;
+
+    while (parse_elapsed < MIN_TIME_NS) {
+        size_t mallocs_before = malloc_count, frees_before = free_count;
+        double start = now_ns();
+        for (int i = 0; i < PARSE_BATCH; i++) {
+            if (0 != parse(s, objects + i * s->object_size)) {
+                fprintf(stderr, "%s: %s parse failed\n", s->name, backend);
+                exit(1);
+            }
+        }
+
+        parse_elapsed += now_ns() - start;
+        parse_mallocs += malloc_count - mallocs_before;
+        parse_frees += free_count - frees_before;
+
+        mallocs_before = malloc_count;
+        frees_before = free_count;
+        start = now_ns();
+        for (int i = 0; i < PARSE_BATCH; i++) {
+            s->free(objects + i * s->object_size);
+        }
+
+        free_elapsed += now_ns() - start;
+        free_mallocs += malloc_count - mallocs_before;
+        free_frees += free_count - frees_before;
+        total += PARSE_BATCH;
+    }
+
+    report(s, "parse", backend, total, parse_elapsed, parse_mallocs, parse_frees);
+    report(s, "free", backend, total, free_elapsed, free_mallocs, free_frees);
+    free(objects);
+}
+
+static void run(struct scenario *s)
+{
+    if (0 != s->write_json(s->object, &s->text)) {
+        fprintf(stderr, "%s: write_json failed\n", s->name);
+        exit(1);
+    }
+
+    measure_serialize(s, "jansson", serialize_jansson);
+    measure_serialize(s, "direct", serialize_direct);
+    measure_serialize(s, "direct_parallel", serialize_parallel);
+    measure_parse(s, "jansson", parse_jansson);
+    measure_parse(s, "direct", parse_direct);
+    autojson_buf_fini(&s->text);
+}
+
+static struct wide wide_object;
+static struct level0 level0_object;
+static struct item_list item_list_object;
+static struct document document_object;
+static struct trusted_document trusted_document_object;
+
+SCENARIO(wide, wide_object);
+SCENARIO(level0, level0_object);
+SCENARIO(item_list, item_list_object);
+SCENARIO(document, document_object);
+SCENARIO(trusted_document, trusted_document_object);
+
+#define ITEM_COUNT 10000
+#define BODY_LENGTH (256 * 1024)
+
+static void init_objects(void)
+{
+    /* Arbitrary integers everywhere, then make the strings valid */
+    srand(1);
+    for (size_t i = 0; i < sizeof(wide_object); i++) {
+        ((unsigned char *) &wide_object)[i] = rand();
+    }
+
+    strcpy(wide_object.s15, "fifteen");
+    strcpy(wide_object.s31, "thirty one");
+    strcpy(wide_object.s47, "forty seven");
+    strcpy(wide_object.s63, "sixty three");
+
+#define LEVEL(l, d) (l).depth = d; strcpy((l).tag, "level " #d)
+    LEVEL(level0_object, 0);
+    LEVEL(level0_object.next, 1);
+    LEVEL(level0_object.next.next, 2);
+    LEVEL(level0_object.next.next.next, 3);
+    LEVEL(level0_object.next.next.next.next, 4);
+    LEVEL(level0_object.next.next.next.next.next, 5);
+    LEVEL(level0_object.next.next.next.next.next.next, 6);
+    LEVEL(level0_object.next.next.next.next.next.next.next, 7);
+    LEVEL(level0_object.next.next.next.next.next.next.next.next, 8);
+    level0_object.next.next.next.next.next.next.next.next.value = 1LL << 40;
+
+    struct item *items = calloc(ITEM_COUNT, sizeof(*items));
+    item_list_object.items = calloc(ITEM_COUNT + 1, sizeof(*item_list_object.items));
+    for (int i = 0; i < ITEM_COUNT; i++) {
+        items[i].id = i;
+        items[i].timestamp = 1400000000000LL + i * 1000;
+        items[i].kind = i % 3;
+        snprintf(items[i].name, sizeof(items[i].name), "item number %d", i);
+        item_list_object.items[i] = &items[i];
+    }
+
+    /* Mostly plain text with the occasional character that needs escaping */
+    char *body = malloc(BODY_LENGTH + 1);
+    for (int i = 0; i < BODY_LENGTH; i++) {
+        body[i] = i % 97 == 96 ? '\n' : i % 211 == 210 ? '"' : 'a' + i % 26;
+    }
+
+    body[BODY_LENGTH] = '\0';
+    strcpy(document_object.title, "a long document");
+    document_object.body = body;
+    document_object.footer = "\ttab separated\tfooter";
+    strcpy(trusted_document_object.title, document_object.title);
+    trusted_document_object.body = document_object.body;
+    trusted_document_object.footer = document_object.footer;
+}
+
+int main(int argc, char **argv)
+{
+    struct scenario *scenarios[] = {&wide_scenario, &level0_scenario,
+                                    &item_list_scenario, &document_scenario, &trusted_document_scenario};
+
+    init_objects();
+    pool = autojson_pool_create(sysconf(_SC_NPROCESSORS_ONLN) - 1, 1024);
+    for (size_t i = 0; i < sizeof(scenarios) / sizeof(scenarios[0]); i++) {
+        if (argc < 2 || 0 == strcmp(argv[1], scenarios[i]->name)) {
+            run(scenarios[i]);
+        }
+    }
+
+    autojson_pool_destroy(pool);
+    return 0;
+}
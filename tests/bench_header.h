@@ -0,0 +1,174 @@
+#pragma once
+
+#include "../autojson.h"
+
+/*
+ * Representative structures for tests/bench.c: a wide record of scalars,
+ * a deeply nested record, a large NULL terminated list and long strings.
+ */
+
+enum bench_kind {
+    BENCH_KIND_A,
+    BENCH_KIND_B,
+    BENCH_KIND_C,
+};
+
+struct wide {
+    int i00;
+    long long l01;
+    int i02;
+    enum bench_kind k03;
+    int i04;
+    long long l05;
+    int i06;
+    int i07;
+    int i08;
+    long long l09;
+    int i10;
+    enum bench_kind k11;
+    int i12;
+    long long l13;
+    int i14;
+    char s15[32];
+    int i16;
+    long long l17;
+    int i18;
+    enum bench_kind k19;
+    int i20;
+    long long l21;
+    int i22;
+    int i23;
+    int i24;
+    long long l25;
+    int i26;
+    enum bench_kind k27;
+    int i28;
+    long long l29;
+    int i30;
+    char s31[32];
+    int i32;
+    long long l33;
+    int i34;
+    enum bench_kind k35;
+    int i36;
+    long long l37;
+    int i38;
+    int i39;
+    int i40;
+    long long l41;
+    int i42;
+    enum bench_kind k43;
+    int i44;
+    long long l45;
+    int i46;
+    char s47[32];
+    int i48;
+    long long l49;
+    int i50;
+    enum bench_kind k51;
+    int i52;
+    long long l53;
+    int i54;
+    int i55;
+    int i56;
+    long long l57;
+    int i58;
+    enum bench_kind k59;
+    int i60;
+    long long l61;
+    int i62;
+    char s63[32];
+    JSONABLE;
+};
+
+struct level8 {
+    int depth;
+    char tag[16];
+    long long value;
+    JSONABLE;
+};
+
+struct level7 {
+    int depth;
+    char tag[16];
+    struct level8 next;
+    JSONABLE;
+};
+
+struct level6 {
+    int depth;
+    char tag[16];
+    struct level7 next;
+    JSONABLE;
+};
+
+struct level5 {
+    int depth;
+    char tag[16];
+    struct level6 next;
+    JSONABLE;
+};
+
+struct level4 {
+    int depth;
+    char tag[16];
+    struct level5 next;
+    JSONABLE;
+};
+
+struct level3 {
+    int depth;
+    char tag[16];
+    struct level4 next;
+    JSONABLE;
+};
+
+struct level2 {
+    int depth;
+    char tag[16];
+    struct level3 next;
+    JSONABLE;
+};
+
+struct level1 {
+    int depth;
+    char tag[16];
+    struct level2 next;
+    JSONABLE;
+};
+
+struct level0 {
+    int depth;
+    char tag[16];
+    struct level1 next;
+    JSONABLE;
+};
+
+struct item {
+    int id;
+    long long timestamp;
+    enum bench_kind kind;
+    char name[32];
+    JSONABLE;
+};
+
+struct item_list {
+    int generation;
+    struct item **items;
+    JSONABLE;
+};
+
+struct document {
+    char title[128];
+    char *body;
+    char *footer;
+    JSONABLE;
+};
+
+/// trusted
+struct trusted_document {
+    char title[128];
+    char *body;
+    char *footer;
+    JSONABLE;
+};
@@ -1,10 +1,14 @@
-#include "test_header_auto.h"
+#ifndef TEST_AUTO_HEADER
+#define TEST_AUTO_HEADER "test_header_auto.h"
+#endif
+#include TEST_AUTO_HEADER
 #include "CUnit/Basic.h"
 #include "CUnit/Console.h"
 #include "CUnit/Automated.h"
 #include "CUnit/CUCurses.h"
 #include <assert.h>
 #include <string.h>
+#include <unistd.h>
 
 #define ADD_TEST(name, func) assert(NULL != CU_add_test(suite, name, func))
 
@@ -36,6 +40,7 @@ void scalars(void)
     CU_ASSERT(ENUM_VAL_2 == s_from_json.e);
     CU_ASSERT(LONG_NUM == s_from_json.l);
     CU_ASSERT(strcmp(s.string, s_from_json.string) == 0);
+    json_decref(json);
 }
 
 void generate_scalars(struct scalars *s, unsigned int count, struct scalars *base)
@@ -57,6 +62,35 @@ void generate_scalars(struct scalars *s, unsigned int count, struct scalars *bas
         s++;
     }
 }
+
+#define NESTED_COUNT (3)
+#define BASE_INTEGER 100
+
+/* A nested_var_list of two lists of two scalars and a NULL list. It points into itself, so it can't be copied */
+struct nested_fixture {
+    struct scalars ss[2 * NESTED_COUNT];
+    struct scalars base;
+    struct scalars *scalar_ptrs[NESTED_COUNT][3];
+    struct var_list vars[NESTED_COUNT];
+    struct var_list *var_list_ptrs[NESTED_COUNT + 1];
+    struct nested_var_list nested;
+};
+
+void build_nested_fixture(struct nested_fixture *f)
+{
+    memset(f, 0, sizeof(*f));
+    generate_scalars(f->ss, ARRAY_LENGTH(f->ss), &f->base);
+    for (int i = 0; i < NESTED_COUNT; i++) {
+        f->scalar_ptrs[i][0] = &f->ss[2 * i];
+        f->scalar_ptrs[i][1] = &f->ss[2 * i + 1];
+        f->vars[i].i = BASE_INTEGER + i;
+        f->vars[i].s = i < NESTED_COUNT - 1 ? f->scalar_ptrs[i] : NULL;
+        f->var_list_ptrs[i] = &f->vars[i];
+    }
+
+    f->nested.s = f->var_list_ptrs;
+    f->nested.a = BASE_INTEGER;
+}
 void var_lists(void)
 {
     struct scalars ss[3];
@@ -83,10 +117,10 @@ void var_lists(void)
     }
 
     CU_ASSERT(i == ARRAY_LENGTH(ss));
+    var_list_free(&v_from_json);
+    json_decref(json);
 }
 
-#define NESTED_COUNT (3)
-#define BASE_INTEGER 100
 void nested_var_list(void)
 {
     struct scalars base;
@@ -129,6 +163,15 @@ void nested_var_list(void)
 
     CU_ASSERT(i == ARRAY_LENGTH(var_list_ptrs) - 1);
     nested_var_list_free(&nested_from_json);
+    json_decref(json);
+
+    /* A bad element frees the elements parsed before it */
+    json = json_loads("{\"a\": 1, \"s\": [{\"i\": 1, \"s\": [{\"a\": 5, \"e\": 0, \"string\": \"x\", \"l\": 1}]},"
+                      " {\"i\": \"two\", \"s\": []}]}", 0, NULL);
+    CU_ASSERT(0 != nested_var_list_from_json(json, &nested_from_json));
+    CU_ASSERT(NULL == nested_from_json.s);
+    CU_ASSERT(0 == nested_from_json.a);
+    json_decref(json);
 }
 
 #define VAR_STRING "bla bla boy asfslkdafjasfdlkj asfdalkfdsj pwqerrwgf0"
@@ -144,6 +187,1057 @@ void var_string(void)
     CU_ASSERT(s.a == s_from_json.a);
     CU_ASSERT(strcmp(s.s, s_from_json.s) == 0);
     var_string_free(&s_from_json);
+    json_decref(json);
+}
+
+static void assert_matches_jansson(json_t *json, const struct autojson_buf *buf)
+{
+    char *expected = json_dumps(json, JSON_COMPACT);
+    CU_ASSERT(0 == buf->error);
+    CU_ASSERT(strlen(expected) == buf->len);
+    CU_ASSERT(0 == memcmp(expected, buf->data, buf->len));
+    free(expected);
+    json_decref(json);
+}
+
+void direct_writer(void)
+{
+    struct scalars s = {.a = -500,
+                        .e = ENUM_VAL_2,
+                        .l = -LONG_NUM,
+                        .string = {"quote \" backslash \\ tab \t control \x01"}};
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+    CU_ASSERT(0 == scalars_write_json(&s, &buf));
+    assert_matches_jansson(scalars_to_json(&s), &buf);
+    autojson_buf_fini(&buf);
+
+    struct nested_fixture fixture;
+    build_nested_fixture(&fixture);
+
+    /* Start from a small caller-owned buffer so the writer has to grow it */
+    char storage[16];
+    autojson_buf_init_static(&buf, storage, sizeof(storage));
+    CU_ASSERT(0 == nested_var_list_write_json(&fixture.nested, &buf));
+    CU_ASSERT(storage != buf.data);
+    assert_matches_jansson(nested_var_list_to_json(&fixture.nested), &buf);
+    autojson_buf_fini(&buf);
+
+    struct var_string v = {.a = 300, .s = NULL};
+    CU_ASSERT(0 == var_string_write_json(&v, &buf));
+    assert_matches_jansson(var_string_to_json(&v), &buf);
+    autojson_buf_fini(&buf);
+}
+
+void stream_parser(void)
+{
+    const char *doc = "{\"s\": [{\"i\": 7, \"unknown\": [{\"x\": null}, 1.5e3, true],"
+                      "          \"s\": [{\"a\": -1, \"e\": 1, \"l\": 17592186044416, \"string\": \"tab\\t\\u00e9\"}]},"
+                      "        {\"s\": [], \"i\": 8}],"
+                      " \"a\": 100}";
+    struct nested_var_list nested;
+    struct autojson_error err;
+
+    CU_ASSERT(0 == nested_var_list_parse_json(doc, strlen(doc), &nested, &err));
+    CU_ASSERT(100 == nested.a);
+    CU_ASSERT(7 == nested.s[0]->i);
+    CU_ASSERT(-1 == nested.s[0]->s[0]->a);
+    CU_ASSERT(ENUM_VAL_2 == nested.s[0]->s[0]->e);
+    CU_ASSERT(LONG_NUM == nested.s[0]->s[0]->l);
+    CU_ASSERT(0 == strcmp("tab\t\xc3\xa9", nested.s[0]->s[0]->string));
+    CU_ASSERT(NULL == nested.s[0]->s[1]);
+    CU_ASSERT(8 == nested.s[1]->i);
+    CU_ASSERT(NULL == nested.s[1]->s[0]);
+    CU_ASSERT(NULL == nested.s[2]);
+
+    /* Round trip through the direct writer */
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+    struct nested_var_list reparsed;
+    CU_ASSERT(0 == nested_var_list_write_json(&nested, &buf));
+    CU_ASSERT(0 == nested_var_list_parse_json(buf.data, buf.len, &reparsed, NULL));
+    CU_ASSERT(0 == strcmp(nested.s[0]->s[0]->string, reparsed.s[0]->s[0]->string));
+    autojson_buf_fini(&buf);
+    nested_var_list_free(&reparsed);
+    nested_var_list_free(&nested);
+
+    const char *missing = "{\"a\": 1}";
+    CU_ASSERT(0 != var_string_parse_json(missing, strlen(missing), &(struct var_string){0}, &err));
+    CU_ASSERT(0 == strcmp("missing key", err.text));
+
+    const char *bad = "{\"i\": 1, \"s\": [{\"a\": 1, \"e\": x}]}";
+    CU_ASSERT(0 != var_list_parse_json(bad, strlen(bad), &(struct var_list){0}, &err));
+    CU_ASSERT(strchr(bad, 'x') - bad == err.position);
+}
+
+void msgpack(void)
+{
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+    struct var_string v = {.a = 300, .s = "hi"};
+    const char expected[] = "\x82\xa1" "a" "\xcd\x01\x2c" "\xa1" "s" "\xa2" "hi";
+    CU_ASSERT(0 == var_string_to_msgpack(&v, &buf));
+    CU_ASSERT(sizeof(expected) - 1 == buf.len);
+    CU_ASSERT(0 == memcmp(expected, buf.data, buf.len));
+
+    /* NULL strings are nil and come back as NULL */
+    struct var_string parsed;
+    v.s = NULL;
+    buf.len = 0;
+    CU_ASSERT(0 == var_string_to_msgpack(&v, &buf));
+    CU_ASSERT('\xc0' == buf.data[buf.len - 1]);
+    CU_ASSERT(0 == var_string_from_msgpack(buf.data, buf.len, &parsed, NULL));
+    CU_ASSERT(300 == parsed.a);
+    CU_ASSERT(NULL == parsed.s);
+    autojson_buf_fini(&buf);
+
+    struct nested_fixture fixture;
+    build_nested_fixture(&fixture);
+    fixture.ss[0].a = -100000;
+    fixture.ss[1].l = -LONG_NUM;
+    fixture.vars[1].i = -1;
+    struct nested_var_list reparsed;
+    struct autojson_buf original_json = AUTOJSON_BUF_INIT, reparsed_json = AUTOJSON_BUF_INIT;
+
+    /* Round trip, compared through the direct JSON writer */
+    CU_ASSERT(0 == nested_var_list_to_msgpack(&fixture.nested, &buf));
+    CU_ASSERT(0 == nested_var_list_from_msgpack(buf.data, buf.len, &reparsed, NULL));
+    CU_ASSERT(0 == nested_var_list_write_json(&fixture.nested, &original_json));
+    CU_ASSERT(0 == nested_var_list_write_json(&reparsed, &reparsed_json));
+    CU_ASSERT(original_json.len == reparsed_json.len);
+    CU_ASSERT(0 == memcmp(original_json.data, reparsed_json.data, original_json.len));
+    nested_var_list_free(&reparsed);
+
+    /* Any truncation is an error, never a crash or a leak */
+    struct autojson_error err;
+    for (size_t len = 0; len < buf.len; len++) {
+        CU_ASSERT(0 != nested_var_list_from_msgpack(buf.data, len, &reparsed, &err));
+    }
+    CU_ASSERT(0 == strcmp("unexpected end of input", err.text));
+    autojson_buf_fini(&buf);
+    autojson_buf_fini(&original_json);
+    autojson_buf_fini(&reparsed_json);
+
+    /* Unknown keys are skipped whatever they hold */
+    const char unknown[] = "\x83\xa1" "a" "\x05"
+                           "\xa1" "x" "\x92\xcb\x40\x09\x21\xfb\x54\x44\x2d\x18\x81\xa1" "y" "\xc4\x02\x00\x01"
+                           "\xa1" "s" "\xd9\x03" "abc";
+    CU_ASSERT(0 == var_string_from_msgpack(unknown, sizeof(unknown) - 1, &parsed, &err));
+    CU_ASSERT(5 == parsed.a);
+    CU_ASSERT(0 == strcmp("abc", parsed.s));
+    var_string_free(&parsed);
+
+    const char too_large[] = "\x82\xa1" "a" "\xcf\x80\x00\x00\x00\x00\x00\x00\x00" "\xa1" "s" "\xc0";
+    CU_ASSERT(0 != var_string_from_msgpack(too_large, sizeof(too_large) - 1, &parsed, &err));
+    CU_ASSERT(0 == strcmp("integer out of range", err.text));
+    CU_ASSERT(3 == err.position);
+}
+
+void json_size(void)
+{
+    struct scalars s = {.a = -500,
+                        .e = ENUM_VAL_2,
+                        .l = -LONG_NUM,
+                        .string = {"quote \" backslash \\ tab \t control \x01\x1f"}};
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+    CU_ASSERT(0 == scalars_write_json(&s, &buf));
+    CU_ASSERT(buf.len == scalars_json_size(&s));
+    autojson_buf_fini(&buf);
+
+    s.a = 0;
+    s.l = -9223372036854775807LL - 1;
+    CU_ASSERT(0 == scalars_write_json(&s, &buf));
+    CU_ASSERT(buf.len == scalars_json_size(&s));
+    autojson_buf_fini(&buf);
+
+    struct nested_fixture fixture;
+    build_nested_fixture(&fixture);
+
+    /* Reserving the exact size up front means the buffer never grows */
+    size_t size = nested_var_list_json_size(&fixture.nested);
+    CU_ASSERT(0 == autojson_buf_reserve(&buf, size));
+    char *data = buf.data;
+    CU_ASSERT(0 == nested_var_list_write_json(&fixture.nested, &buf));
+    CU_ASSERT(size == buf.len);
+    CU_ASSERT(data == buf.data);
+    autojson_buf_fini(&buf);
+
+    struct var_string v = {.a = 300, .s = NULL};
+    CU_ASSERT(0 == var_string_write_json(&v, &buf));
+    CU_ASSERT(buf.len == var_string_json_size(&v));
+    autojson_buf_fini(&buf);
+
+    v.s = "\xc3\xa9 \n\x02";
+    CU_ASSERT(0 == var_string_write_json(&v, &buf));
+    CU_ASSERT(buf.len == var_string_json_size(&v));
+    autojson_buf_fini(&buf);
+}
+
+void json_lines(void)
+{
+    struct scalars records[3];
+    struct scalars base;
+    generate_scalars(records, ARRAY_LENGTH(records), &base);
+
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+    json_t *array = json_array();
+    for (size_t i = 0; i < ARRAY_LENGTH(records); i++) {
+        json_array_append_new(array, scalars_to_json(&records[i]));
+    }
+    CU_ASSERT(0 == scalars_write_json_array(records, ARRAY_LENGTH(records), &buf));
+    assert_matches_jansson(array, &buf);
+    autojson_buf_fini(&buf);
+
+    /* Lines written by the bulk writer parse back into an array */
+    struct scalars parsed[4];
+    size_t count;
+    struct autojson_error err;
+    CU_ASSERT(0 == scalars_write_json_lines(records, ARRAY_LENGTH(records), &buf));
+    CU_ASSERT('\n' == buf.data[buf.len - 1]);
+    CU_ASSERT(0 == scalars_parse_json_lines(buf.data, buf.len, parsed, ARRAY_LENGTH(parsed), &count, &err));
+    CU_ASSERT(ARRAY_LENGTH(records) == count);
+    for (size_t i = 0; i < count; i++) {
+        CU_ASSERT(records[i].a == parsed[i].a);
+        CU_ASSERT(records[i].l == parsed[i].l);
+        CU_ASSERT(0 == strcmp(records[i].string, parsed[i].string));
+        scalars_free(&parsed[i]);
+    }
+
+    /* Records that do not fit are an error, the ones that did stay parsed */
+    CU_ASSERT(0 != scalars_parse_json_lines(buf.data, buf.len, parsed, 2, &count, &err));
+    CU_ASSERT(2 == count);
+    CU_ASSERT(3 == err.line);
+    CU_ASSERT(0 == strcmp("too many records", err.text));
+    scalars_free(&parsed[0]);
+    scalars_free(&parsed[1]);
+    autojson_buf_fini(&buf);
+
+    const char *lines = "{\"a\": 1, \"s\": \"one\"}\r\n"
+                        "\n"
+                        "  {\"a\": 2, \"s\": \"two\"}  \n"
+                        "{\"a\": 3, \"s\": \"three\"} {\"a\": 4, \"s\": \"four\"}\n";
+    struct var_string strings[4];
+    CU_ASSERT(0 != var_string_parse_json_lines(lines, strlen(lines), strings, ARRAY_LENGTH(strings), &count, &err));
+    CU_ASSERT(3 == count);
+    CU_ASSERT(4 == err.line);
+    CU_ASSERT(0 == strcmp("newline expected", err.text));
+    CU_ASSERT(0 == strcmp("two", strings[1].s));
+    for (size_t i = 0; i < count; i++) {
+        var_string_free(&strings[i]);
+    }
+
+    const char *bad = "{\"a\": 1, \"s\": \"one\"}\n{\"a\": \"x\", \"s\": \"two\"}\n";
+    CU_ASSERT(0 != var_string_parse_json_lines(bad, strlen(bad), strings, ARRAY_LENGTH(strings), &count, &err));
+    CU_ASSERT(1 == count);
+    CU_ASSERT(2 == err.line);
+    var_string_free(&strings[0]);
+
+    /* Files are mapped, pipes are read */
+    struct autojson_input input;
+    FILE *f = tmpfile();
+    fputs(lines, f);
+    fflush(f);
+    CU_ASSERT(0 == autojson_input_from_fd(&input, fileno(f)));
+    CU_ASSERT(input.mapped);
+    CU_ASSERT(strlen(lines) == input.len);
+    CU_ASSERT(0 == memcmp(lines, input.data, input.len));
+    autojson_input_fini(&input);
+    fclose(f);
+
+    int fds[2];
+    CU_ASSERT(0 == pipe(fds));
+    CU_ASSERT(strlen(lines) == write(fds[1], lines, strlen(lines)));
+    close(fds[1]);
+    CU_ASSERT(0 == autojson_input_from_fd(&input, fds[0]));
+    CU_ASSERT(!input.mapped);
+    CU_ASSERT(strlen(lines) == input.len);
+    CU_ASSERT(0 == memcmp(lines, input.data, input.len));
+    autojson_input_fini(&input);
+    close(fds[0]);
+}
+
+static void check_samples(const struct samples *expected, const struct samples *actual)
+{
+    CU_ASSERT(0 == memcmp(expected->values, actual->values, sizeof(expected->values)));
+    CU_ASSERT(0 == memcmp(expected->totals, actual->totals, sizeof(expected->totals)));
+    CU_ASSERT(0 == memcmp(expected->kinds, actual->kinds, sizeof(expected->kinds)));
+    for (int i = 0; i < 2; i++) {
+        CU_ASSERT(expected->pair[i].a == actual->pair[i].a);
+        CU_ASSERT(0 == strcmp(expected->pair[i].s, actual->pair[i].s));
+    }
+}
+
+void fixed_arrays(void)
+{
+    struct samples s = {.values = {1, -2, 300000, 0},
+                        .totals = {LONG_NUM, -LONG_NUM},
+                        .kinds = {ENUM_VAL_2, ENUM_VAL_1, ENUM_VAL_2},
+                        .pair = {{.a = 1, .s = "first"}, {.a = 2, .s = "second"}}};
+    struct samples parsed;
+    json_t *json = samples_to_json(&s);
+    CU_ASSERT(4 == json_array_size(json_object_get(json, "values")));
+    CU_ASSERT(0 == samples_from_json(json, &parsed));
+    check_samples(&s, &parsed);
+    samples_free(&parsed);
+
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+    struct autojson_error err;
+    CU_ASSERT(0 == samples_write_json(&s, &buf));
+    CU_ASSERT(buf.len == samples_json_size(&s));
+    CU_ASSERT(0 == samples_parse_json(buf.data, buf.len, &parsed, &err));
+    check_samples(&s, &parsed);
+    samples_free(&parsed);
+    assert_matches_jansson(json, &buf);
+    autojson_buf_fini(&buf);
+
+    CU_ASSERT(0 == samples_to_msgpack(&s, &buf));
+    CU_ASSERT(0 == samples_from_msgpack(buf.data, buf.len, &parsed, &err));
+    check_samples(&s, &parsed);
+    samples_free(&parsed);
+    autojson_buf_fini(&buf);
+
+    /* Arrays hold exactly as many elements as the field */
+    const char *too_few = "{\"values\": [1, 2, 3], \"totals\": [1, 2], \"kinds\": [0, 0, 0],"
+                          " \"pair\": [{\"a\": 1, \"s\": \"x\"}, {\"a\": 2, \"s\": \"y\"}]}";
+    CU_ASSERT(0 != samples_parse_json(too_few, strlen(too_few), &parsed, &err));
+    CU_ASSERT(0 == strcmp("too few elements", err.text));
+    json = json_loads(too_few, 0, NULL);
+    CU_ASSERT(0 != samples_from_json(json, &parsed));
+    json_decref(json);
+
+    const char *too_many = "{\"pair\": [{\"a\": 1, \"s\": \"x\"}, {\"a\": 2, \"s\": \"y\"}, {\"a\": 3, \"s\": \"z\"}],"
+                           " \"values\": [1, 2, 3, 4], \"totals\": [1, 2], \"kinds\": [0, 0, 0]}";
+    CU_ASSERT(0 != samples_parse_json(too_many, strlen(too_many), &parsed, &err));
+    CU_ASSERT(0 == strcmp("too many elements", err.text));
+
+    /* A broken element releases the ones before it */
+    const char *broken = "{\"values\": [1, 2, 3, 4], \"totals\": [1, 2], \"kinds\": [0, 0, 0],"
+                         " \"pair\": [{\"a\": 1, \"s\": \"x\"}, {\"a\": 2}]}";
+    CU_ASSERT(0 != samples_parse_json(broken, strlen(broken), &parsed, &err));
+    CU_ASSERT(0 == strcmp("missing key", err.text));
+    json = json_loads(broken, 0, NULL);
+    CU_ASSERT(0 != samples_from_json(json, &parsed));
+    json_decref(json);
+}
+
+#define PARALLEL_COUNT 1000
+
+void parallel_writer(void)
+{
+    struct scalars ss[PARALLEL_COUNT];
+    struct scalars base;
+    struct scalars *scalar_ptrs[PARALLEL_COUNT + 1];
+    struct var_list lists[PARALLEL_COUNT];
+    struct var_list *list_ptrs[PARALLEL_COUNT + 1];
+    generate_scalars(ss, ARRAY_LENGTH(ss), &base);
+    for (int i = 0; i < PARALLEL_COUNT; i++) {
+        scalar_ptrs[i] = &ss[i];
+        lists[i].i = i;
+        lists[i].s = &scalar_ptrs[i % 7 * 100];
+        list_ptrs[i] = &lists[i];
+    }
+    scalar_ptrs[PARALLEL_COUNT] = NULL;
+    list_ptrs[PARALLEL_COUNT] = NULL;
+
+    struct nested_var_list nested = {.s = list_ptrs, .a = BASE_INTEGER};
+    struct autojson_buf serial = AUTOJSON_BUF_INIT, parallel = AUTOJSON_BUF_INIT;
+    struct autojson_pool *pool = autojson_pool_create(3, 16);
+    CU_ASSERT_FATAL(NULL != pool);
+
+    /* Above and below the threshold, with and without a pool, the output is the same */
+    size_t counts[] = {PARALLEL_COUNT, 17, 16, 15, 1, 0};
+    for (int i = 0; i < ARRAY_LENGTH(counts); i++) {
+        list_ptrs[counts[i]] = NULL;
+        serial.len = 0;
+        parallel.len = 0;
+        CU_ASSERT(0 == nested_var_list_write_json(&nested, &serial));
+        CU_ASSERT(0 == nested_var_list_write_json_parallel(&nested, &parallel, pool));
+        CU_ASSERT(serial.len == parallel.len);
+        CU_ASSERT(0 == memcmp(serial.data, parallel.data, serial.len));
+        parallel.len = 0;
+        CU_ASSERT(0 == nested_var_list_write_json_parallel(&nested, &parallel, NULL));
+        CU_ASSERT(serial.len == parallel.len);
+    }
+
+    nested.s = NULL;
+    parallel.len = 0;
+    CU_ASSERT(0 == nested_var_list_write_json_parallel(&nested, &parallel, pool));
+    CU_ASSERT(0 == strncmp("{\"s\":[],", parallel.data, 8));
+
+    autojson_pool_destroy(pool);
+    autojson_buf_fini(&serial);
+    autojson_buf_fini(&parallel);
+}
+
+void diff_and_patch(void)
+{
+    struct scalars old_scalars[2] = {{.a = 1, .e = ENUM_VAL_1, .string = "one", .l = 10},
+                                     {.a = 2, .e = ENUM_VAL_1, .string = "two", .l = 20}};
+    struct scalars new_scalars[2];
+    struct scalars *old_ptrs[] = {&old_scalars[0], &old_scalars[1], NULL};
+    struct scalars *new_ptrs[] = {&new_scalars[0], &new_scalars[1], NULL};
+    struct samples old = {.values = {1, 2, 3, 4}, .totals = {5, 6},
+                          .pair = {{.a = 1, .s = "first"}, {.a = 2, .s = "second"}}};
+    struct samples new = old;
+    memcpy(new_scalars, old_scalars, sizeof(old_scalars));
+
+    /* Unchanged structures diff to an empty object */
+    json_t *diff = samples_diff_to_json(&old, &new);
+    CU_ASSERT(0 == json_object_size(diff));
+    CU_ASSERT(samples_equal(&old, &new));
+    json_decref(diff);
+
+    new.totals[1] = -6;
+    new.pair[1].s = "changed";
+    CU_ASSERT(!samples_equal(&old, &new));
+    diff = samples_diff_to_json(&old, &new);
+    CU_ASSERT(2 == json_object_size(diff));
+    CU_ASSERT(-6 == json_integer_value(json_array_get(json_object_get(diff, "totals"), 1)));
+    CU_ASSERT(0 == strcmp("changed", json_string_value(json_object_get(
+        json_array_get(json_object_get(diff, "pair"), 1), "s"))));
+    json_decref(diff);
+
+    /* Lists are sent whole when any element changed */
+    struct var_list old_list = {.i = 1, .s = old_ptrs}, new_list = {.i = 1, .s = new_ptrs};
+    new_scalars[1].l = 21;
+    diff = var_list_diff_to_json(&old_list, &new_list);
+    CU_ASSERT(1 == json_object_size(diff));
+    CU_ASSERT(2 == json_array_size(json_object_get(diff, "s")));
+    json_decref(diff);
+    new_ptrs[1] = NULL;
+    CU_ASSERT(!var_list_equal(&old_list, &new_list));
+    old_list.s = NULL;
+    new_ptrs[0] = NULL;
+    CU_ASSERT(var_list_equal(&old_list, &new_list));
+
+    /* A patch replaces only the keys it holds */
+    struct var_string v = {.a = 1, .s = strdup("kept")};
+    json_t *patch = json_loads("{\"a\": 2}", 0, NULL);
+    CU_ASSERT(0 == var_string_patch_from_json(patch, &v));
+    CU_ASSERT(2 == v.a);
+    CU_ASSERT(0 == strcmp("kept", v.s));
+    json_decref(patch);
+
+    patch = json_loads("{\"s\": \"replaced\", \"unknown\": []}", 0, NULL);
+    CU_ASSERT(0 == var_string_patch_from_json(patch, &v));
+    CU_ASSERT(0 == strcmp("replaced", v.s));
+    json_decref(patch);
+
+    /* Nothing is replaced when any key fails */
+    patch = json_loads("{\"s\": \"lost\", \"a\": \"not a number\"}", 0, NULL);
+    CU_ASSERT(0 != var_string_patch_from_json(patch, &v));
+    CU_ASSERT(2 == v.a);
+    CU_ASSERT(0 == strcmp("replaced", v.s));
+    json_decref(patch);
+
+    /* Nested structures are patched last, and a failing one leaves the rest */
+    struct envelope e = {.id = 1, .body = {.a = 2, .s = NULL}, .history = NULL};
+    patch = json_loads("{\"body\": {\"a\": 9}, \"history\": \"not a list\"}", 0, NULL);
+    CU_ASSERT(0 != envelope_patch_from_json(patch, &e));
+    CU_ASSERT(2 == e.body.a);
+    json_decref(patch);
+    patch = json_loads("{\"id\": 5, \"body\": {\"a\": \"not a number\"}}", 0, NULL);
+    CU_ASSERT(0 != envelope_patch_from_json(patch, &e));
+    CU_ASSERT(1 == e.id);
+    CU_ASSERT(2 == e.body.a);
+    json_decref(patch);
+    envelope_free(&e);
+
+    /* Diffs apply as patches, null strings included */
+    struct var_string w = {.a = 3, .s = NULL};
+    diff = var_string_diff_to_json(&v, &w);
+    CU_ASSERT(json_is_null(json_object_get(diff, "s")));
+    CU_ASSERT(0 == var_string_patch_from_json(diff, &v));
+    CU_ASSERT(var_string_equal(&v, &w));
+    json_decref(diff);
+    var_string_free(&v);
+
+    struct samples patched;
+    json_t *json = samples_to_json(&old);
+    CU_ASSERT(0 == samples_from_json(json, &patched));
+    json_decref(json);
+    diff = samples_diff_to_json(&old, &new);
+    CU_ASSERT(0 == samples_patch_from_json(diff, &patched));
+    CU_ASSERT(samples_equal(&new, &patched));
+    json_decref(diff);
+    samples_free(&patched);
+}
+
+void borrowed_strings(void)
+{
+    /* Only the first name_len bytes are written */
+    struct borrowed b = {.name = "borrowed name", .name_len = 8, .id = 7};
+    struct borrowed parsed;
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+    struct autojson_error err;
+    json_t *json = borrowed_to_json(&b);
+    CU_ASSERT(0 == borrowed_write_json(&b, &buf));
+    CU_ASSERT(buf.len == borrowed_json_size(&b));
+    CU_ASSERT(0 == memcmp("{\"name\":\"borrowed\",", buf.data, 19));
+
+    /* Parsed strings point into the input */
+    CU_ASSERT(0 == borrowed_parse_json(buf.data, buf.len, &parsed, &err));
+    CU_ASSERT(8 == parsed.name_len);
+    CU_ASSERT(buf.data + 9 == parsed.name);
+    CU_ASSERT(7 == parsed.id);
+    borrowed_free(&parsed);
+
+    CU_ASSERT(0 == borrowed_from_json(json, &parsed));
+    CU_ASSERT(json_string_value(json_object_get(json, "name")) == parsed.name);
+    CU_ASSERT(8 == parsed.name_len);
+    assert_matches_jansson(json, &buf);
+
+    buf.len = 0;
+    CU_ASSERT(0 == borrowed_to_msgpack(&b, &buf));
+    CU_ASSERT(0 == borrowed_from_msgpack(buf.data, buf.len, &parsed, &err));
+    CU_ASSERT(8 == parsed.name_len);
+    CU_ASSERT(0 == memcmp("borrowed", parsed.name, 8));
+    CU_ASSERT(parsed.name > buf.data && parsed.name < buf.data + buf.len);
+    autojson_buf_fini(&buf);
+
+    /* The input only holds the escaped form */
+    const char *escaped = "{\"name\": \"tab\\there\", \"id\": 1}";
+    CU_ASSERT(0 != borrowed_parse_json(escaped, strlen(escaped), &parsed, &err));
+    CU_ASSERT(0 == strcmp("escaped string can't be borrowed", err.text));
+    CU_ASSERT(9 == err.position);
+
+    /* Borrowing is per field: the rest is still copied and freed */
+    const char *view = "{\"kept\": \"copy\", \"view\": \"in place\"}";
+    struct borrowed_view v;
+    CU_ASSERT(0 == borrowed_view_parse_json(view, strlen(view), &v, &err));
+    CU_ASSERT(0 == strcmp("copy", v.kept));
+    CU_ASSERT(view + 26 == v.view);
+    CU_ASSERT(8 == v.view_len);
+    borrowed_view_free(&v);
+}
+
+#ifdef AUTOJSON_STATS
+struct recorded_stats {
+    const char *structure;
+    const char *op;
+    struct autojson_op_stats stats;
+};
+
+static void record_stats(const char *structure, const char *op, const struct autojson_op_stats *stats, void *ctx)
+{
+    struct recorded_stats *recorded = ctx;
+    while (NULL != recorded->structure) {
+        recorded++;
+    }
+
+    recorded->structure = structure;
+    recorded->op = op;
+    recorded->stats = *stats;
+}
+
+static const struct autojson_op_stats *find_stats(const struct recorded_stats *recorded,
+                                                  const char *structure, const char *op)
+{
+    for (; NULL != recorded->structure; recorded++) {
+        if (0 == strcmp(structure, recorded->structure) && 0 == strcmp(op, recorded->op)) {
+            return &recorded->stats;
+        }
+    }
+
+    return NULL;
+}
+
+void stats(void)
+{
+    struct var_string v = {.a = 1, .s = "counted"}, parsed;
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+    struct recorded_stats recorded[AUTOJSON_STATS_OPS * 16] = {{NULL}};
+    const char *broken = "{\"a\": 1, \"s\": 2}";
+
+    autojson_stats_reset();
+    CU_ASSERT(0 == var_string_write_json(&v, &buf));
+    size_t first_len = buf.len;
+    CU_ASSERT(0 == var_string_write_json(&v, &buf));
+    CU_ASSERT(0 == var_string_parse_json(buf.data, first_len, &parsed, NULL));
+    var_string_free(&parsed);
+    CU_ASSERT(0 != var_string_parse_json(broken, strlen(broken), &parsed, NULL));
+
+    autojson_stats_foreach(record_stats, recorded);
+    const struct autojson_op_stats *written = find_stats(recorded, "var_string", "write_json");
+    const struct autojson_op_stats *parsed_stats = find_stats(recorded, "var_string", "parse_json");
+    CU_ASSERT_FATAL(NULL != written && NULL != parsed_stats);
+    CU_ASSERT(NULL == find_stats(recorded, "var_string", "to_msgpack"));
+    CU_ASSERT(2 == written->calls);
+    CU_ASSERT(0 == written->errors);
+    CU_ASSERT(buf.len == written->bytes);
+    CU_ASSERT(first_len == written->peak_bytes);
+    CU_ASSERT(2 == parsed_stats->calls);
+    CU_ASSERT(1 == parsed_stats->errors);
+    CU_ASSERT(first_len + strlen(broken) == parsed_stats->bytes);
+    CU_ASSERT(1 == parsed_stats->allocations);
+
+    unsigned long long timed = 0;
+    for (int i = 0; i < AUTOJSON_STATS_BUCKETS; i++) {
+        timed += written->latency_ns[i];
+    }
+    CU_ASSERT(2 == timed);
+
+    /* One JSON object per function */
+    char *text;
+    size_t text_len;
+    FILE *file = open_memstream(&text, &text_len);
+    autojson_stats_foreach(autojson_stats_print, file);
+    fclose(file);
+    CU_ASSERT(NULL != strstr(text, "{\"structure\": \"var_string\", \"op\": \"write_json\", \"calls\": 2, "));
+    free(text);
+
+    autojson_stats_reset();
+    memset(recorded, 0, sizeof(recorded));
+    autojson_stats_foreach(record_stats, recorded);
+    CU_ASSERT(NULL == recorded[0].structure);
+    autojson_buf_fini(&buf);
+}
+#endif
+
+void projection(void)
+{
+    struct envelope e;
+    const char *doc = "{\"id\": 7, \"body\": {\"a\": 1, \"s\": \"text\"},"
+                      " \"history\": [{\"i\": 2, \"s\": []}]}";
+    json_t *json = json_loads(doc, 0, NULL);
+
+    CU_ASSERT(ENVELOPE_PATH_body__s == envelope_path_index("body.s"));
+    CU_ASSERT(ENVELOPE_PATH_history == envelope_path_index("history"));
+    CU_ASSERT(-1 == envelope_path_index("body.x"));
+    CU_ASSERT(5 == ENVELOPE_PATHS);
+
+    /* Unselected fields are left zeroed */
+    CU_ASSERT(0 == envelope_from_json_fields(json, &e, 1ULL << ENVELOPE_PATH_body__s));
+    CU_ASSERT(0 == e.id);
+    CU_ASSERT(0 == e.body.a);
+    CU_ASSERT(0 == strcmp("text", e.body.s));
+    CU_ASSERT(NULL == e.history);
+    envelope_free(&e);
+
+    CU_ASSERT(0 == envelope_from_json_fields(json, &e, 1ULL << ENVELOPE_PATH_id | 1ULL << ENVELOPE_PATH_history));
+    CU_ASSERT(7 == e.id);
+    CU_ASSERT(NULL == e.body.s);
+    CU_ASSERT(2 == e.history[0]->i);
+    CU_ASSERT(NULL == e.history[1]);
+    envelope_free(&e);
+
+    /* Selecting a record selects all of it */
+    CU_ASSERT(0 == envelope_from_json_fields(json, &e, 1ULL << ENVELOPE_PATH_body));
+    CU_ASSERT(1 == e.body.a);
+    CU_ASSERT(0 == strcmp("text", e.body.s));
+    envelope_free(&e);
+    json_decref(json);
+
+    /* Only selected fields have to be there */
+    json = json_loads("{\"id\": 1}", 0, NULL);
+    CU_ASSERT(0 == envelope_from_json_fields(json, &e, 1ULL << ENVELOPE_PATH_id));
+    CU_ASSERT(0 != envelope_from_json_fields(json, &e, 1ULL << ENVELOPE_PATH_body__a));
+    json_decref(json);
+
+    /* Past 63 fields, the rest share the last bit */
+    struct wide w = {.f0 = 1, .f62 = 62, .f63 = 63, .f69 = 69};
+    json = wide_to_json(&w);
+    CU_ASSERT(64 == WIDE_PATHS);
+    CU_ASSERT(63 == WIDE_PATH_f63);
+    CU_ASSERT(63 == wide_path_index("f69"));
+    CU_ASSERT(0 == wide_from_json_fields(json, &w, 1ULL << WIDE_PATH_f62));
+    CU_ASSERT(62 == w.f62);
+    CU_ASSERT(0 == w.f0);
+    CU_ASSERT(0 == w.f69);
+    CU_ASSERT(0 == wide_from_json_fields(json, &w, 1ULL << WIDE_PATH_f69));
+    CU_ASSERT(0 == w.f62);
+    CU_ASSERT(63 == w.f63);
+    CU_ASSERT(69 == w.f69);
+    json_decref(json);
+}
+
+void reuse_parser(void)
+{
+    struct nested_var_list n;
+    struct var_string v;
+    json_t *one = json_loads("{\"a\": 1, \"s\": [{\"i\": 1, \"s\": []}]}", 0, NULL);
+    json_t *two = json_loads("{\"a\": 2, \"s\": [{\"i\": 1, \"s\": [{\"a\": 5, \"e\": 0, \"string\": \"x\", \"l\": 1}]},"
+                             " {\"i\": 2, \"s\": []}]}", 0, NULL);
+    json_t *bad = json_loads("{\"a\": 3, \"s\": [{\"i\": \"one\", \"s\": []}]}", 0, NULL);
+
+    memset(&n, 0, sizeof(n));
+    CU_ASSERT(0 == nested_var_list_from_json_reuse(two, &n));
+    struct var_list **pointers = n.s;
+    struct var_list *items = *n.s;
+    struct scalars *inner = *n.s[0]->s;
+
+    /* The same shape again fits in the memory already there */
+#ifdef AUTOJSON_STATS
+    unsigned long long allocations = autojson_stats_allocations;
+#endif
+    CU_ASSERT(0 == nested_var_list_from_json_reuse(two, &n));
+#ifdef __GLIBC__
+#ifdef AUTOJSON_STATS
+    CU_ASSERT(allocations == autojson_stats_allocations);
+#endif
+    CU_ASSERT(pointers == n.s);
+    CU_ASSERT(items == *n.s);
+    CU_ASSERT(inner == *n.s[0]->s);
+#endif
+    CU_ASSERT(5 == n.s[0]->s[0]->a);
+    CU_ASSERT(NULL == n.s[2]);
+
+    /* Shrinking frees the elements that went away, growing starts from zeroed ones */
+    CU_ASSERT(0 == nested_var_list_from_json_reuse(one, &n));
+    CU_ASSERT(1 == n.a);
+    CU_ASSERT(NULL == n.s[0]->s[0]);
+    CU_ASSERT(NULL == n.s[1]);
+    CU_ASSERT(0 == nested_var_list_from_json_reuse(two, &n));
+#ifdef __GLIBC__
+    CU_ASSERT(pointers == n.s);
+#endif
+    CU_ASSERT(2 == n.s[1]->i);
+    CU_ASSERT(NULL == n.s[1]->s[0]);
+    CU_ASSERT(0 == strcmp("x", n.s[0]->s[0]->string));
+
+    /* A failure leaves the structure zeroed, ready for the next message */
+    CU_ASSERT(0 != nested_var_list_from_json_reuse(bad, &n));
+    CU_ASSERT(NULL == n.s);
+    CU_ASSERT(0 == n.a);
+    CU_ASSERT(0 == nested_var_list_from_json_reuse(one, &n));
+    nested_var_list_free(&n);
+    json_decref(one);
+    json_decref(two);
+    json_decref(bad);
+
+    /* Strings only move when they no longer fit */
+    struct var_string short_value = {.a = 1, .s = "short"};
+    struct var_string long_value = {.a = 2, .s = VAR_STRING VAR_STRING};
+    json_t *short_string = var_string_to_json(&short_value);
+    json_t *long_string = var_string_to_json(&long_value);
+    memset(&v, 0, sizeof(v));
+    CU_ASSERT(0 == var_string_from_json_reuse(long_string, &v));
+    char *s = v.s;
+    CU_ASSERT(0 == var_string_from_json_reuse(short_string, &v));
+#ifdef __GLIBC__
+    CU_ASSERT(s == v.s);
+#endif
+    CU_ASSERT(0 == strcmp("short", v.s));
+    CU_ASSERT(0 == var_string_from_json_reuse(long_string, &v));
+#ifdef __GLIBC__
+    CU_ASSERT(s == v.s);
+#endif
+    CU_ASSERT(0 == strcmp(VAR_STRING VAR_STRING, v.s));
+    var_string_free(&v);
+    json_decref(short_string);
+    json_decref(long_string);
+}
+
+void reuse_capacity(void)
+{
+    struct reused_buffers r;
+    json_t *big = json_loads("{\"name\": \"a longer name\", \"list\": [{\"a\": 5, \"e\": 0, \"string\": \"x\", \"l\": 1}, {\"a\": 5, \"e\": 0, \"string\": \"x\", \"l\": 1}],"
+                             " \"ids\": [1, 2, 3]}", 0, NULL);
+    json_t *small = json_loads("{\"name\": \"short\", \"list\": [{\"a\": 5, \"e\": 0, \"string\": \"x\", \"l\": 1}], \"ids\": [4]}", 0, NULL);
+    json_t *empty = json_loads("{\"name\": \"\", \"list\": [], \"ids\": []}", 0, NULL);
+
+    /* cap= fields are not serialized, they follow the buffers the reuse parser allocates */
+    memset(&r, 0, sizeof(r));
+    CU_ASSERT(0 == reused_buffers_from_json_reuse(big, &r));
+    CU_ASSERT(14 == r.name_cap);
+    CU_ASSERT(2 == r.list_cap);
+    CU_ASSERT(3 == r.ids_cap);
+    json_t *json = reused_buffers_to_json(&r);
+    CU_ASSERT(3 == json_object_size(json));
+    json_decref(json);
+
+    /* Smaller messages fit where the big one was, whatever the allocator */
+    char *name = r.name;
+    struct scalars **list = r.list;
+    long long *ids = r.ids;
+    CU_ASSERT(0 == reused_buffers_from_json_reuse(small, &r));
+    CU_ASSERT(name == r.name);
+    CU_ASSERT(list == r.list);
+    CU_ASSERT(ids == r.ids);
+    CU_ASSERT(14 == r.name_cap);
+    CU_ASSERT(1 == r.n_ids);
+    CU_ASSERT(4 == r.ids[0]);
+    CU_ASSERT(0 == reused_buffers_from_json_reuse(big, &r));
+    CU_ASSERT(name == r.name);
+    CU_ASSERT(ids == r.ids);
+    CU_ASSERT(0 == strcmp("a longer name", r.name));
+
+    /* An empty list gives its items back, and the capacity with them */
+    CU_ASSERT(0 == reused_buffers_from_json_reuse(empty, &r));
+    CU_ASSERT(0 == r.list_cap);
+    CU_ASSERT(NULL == r.list[0]);
+    CU_ASSERT(0 == reused_buffers_from_json_reuse(big, &r));
+    CU_ASSERT(2 == r.list_cap);
+    CU_ASSERT(NULL != r.list[1]);
+    reused_buffers_free(&r);
+
+    /* Structures from other parsers start with an unknown capacity of 0 */
+    CU_ASSERT(0 == reused_buffers_from_json(big, &r));
+    CU_ASSERT(0 == r.name_cap);
+    CU_ASSERT(0 == reused_buffers_from_json_reuse(small, &r));
+    CU_ASSERT(6 == r.name_cap);
+    CU_ASSERT(0 == strcmp("short", r.name));
+    reused_buffers_free(&r);
+    json_decref(big);
+    json_decref(small);
+    json_decref(empty);
+}
+
+void counted_arrays(void)
+{
+    struct var_string items[] = {{.a = 1, .s = "one"}, {.a = 2, .s = "two"}, {.a = 3, .s = "three"}};
+    long long ids[] = {-LONG_NUM, 0, 42, LONG_NUM};
+    struct batch b = {.items = items, .n_items = ARRAY_LENGTH(items),
+                      .ids = ids, .n_ids = ARRAY_LENGTH(ids), .tag = 9};
+    struct batch parsed;
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+    struct autojson_error err;
+
+    /* The count fields are not serialized, the arrays carry their own length */
+    json_t *json = batch_to_json(&b);
+    CU_ASSERT(3 == json_object_size(json));
+    CU_ASSERT(3 == json_array_size(json_object_get(json, "items")));
+    CU_ASSERT(LONG_NUM == json_integer_value(json_array_get(json_object_get(json, "ids"), 3)));
+    CU_ASSERT(0 == batch_write_json(&b, &buf));
+    CU_ASSERT(buf.len == batch_json_size(&b));
+    assert_matches_jansson(batch_to_json(&b), &buf);
+
+    CU_ASSERT(0 == batch_from_json(json, &parsed));
+    CU_ASSERT(3 == parsed.n_items);
+    CU_ASSERT(4 == parsed.n_ids);
+    CU_ASSERT(0 == strcmp("three", parsed.items[2].s));
+    CU_ASSERT(batch_equal(&b, &parsed));
+    parsed.ids[0]++;
+    CU_ASSERT(!batch_equal(&b, &parsed));
+    batch_free(&parsed);
+
+    CU_ASSERT(0 == batch_parse_json(buf.data, buf.len, &parsed, &err));
+    CU_ASSERT(batch_equal(&b, &parsed));
+    batch_free(&parsed);
+
+    buf.len = 0;
+    CU_ASSERT(0 == batch_to_msgpack(&b, &buf));
+    CU_ASSERT(0 == batch_from_msgpack(buf.data, buf.len, &parsed, &err));
+    CU_ASSERT(batch_equal(&b, &parsed));
+    batch_free(&parsed);
+    for (size_t len = 0; len < buf.len; len++) {
+        CU_ASSERT(0 != batch_from_msgpack(buf.data, len, &parsed, &err));
+    }
+    autojson_buf_fini(&buf);
+
+    /* Parsing into a previous result keeps the arrays while they fit */
+    memset(&parsed, 0, sizeof(parsed));
+    CU_ASSERT(0 == batch_from_json_reuse(json, &parsed));
+    long long *kept = parsed.ids;
+    CU_ASSERT(0 == batch_from_json_reuse(json, &parsed));
+    CU_ASSERT(kept == parsed.ids);
+    CU_ASSERT(batch_equal(&b, &parsed));
+    batch_free(&parsed);
+    json_decref(json);
+
+    /* NULL arrays are empty ones, and a bad element fails the whole parse */
+    struct batch empty = {.tag = 1};
+    json = batch_to_json(&empty);
+    CU_ASSERT(0 == json_array_size(json_object_get(json, "items")));
+    CU_ASSERT(0 == batch_from_json(json, &parsed));
+    CU_ASSERT(0 == parsed.n_ids);
+    CU_ASSERT(batch_equal(&empty, &parsed));
+    batch_free(&parsed);
+    json_decref(json);
+
+    json = json_loads("{\"items\": [{\"a\": 1, \"s\": \"x\"}, {\"a\": \"two\"}], \"ids\": [], \"tag\": 0}", 0, NULL);
+    CU_ASSERT(0 != batch_from_json(json, &parsed));
+    json_decref(json);
+
+    /* A failure after an array was parsed releases it and leaves the structure zeroed */
+    json = json_loads("{\"items\": [{\"a\": 1, \"s\": \"x\"}], \"ids\": [1, \"two\"], \"tag\": 0}", 0, NULL);
+    CU_ASSERT(0 != batch_from_json(json, &parsed));
+    CU_ASSERT(NULL == parsed.items);
+    CU_ASSERT(0 == parsed.n_items);
+    CU_ASSERT(NULL == parsed.ids);
+    batch_free(&parsed);
+    json_decref(json);
+}
+
+/* Feeds len bytes of doc in chunks of step bytes, or of 1 to 13 bytes when step is 0 */
+static int push_parse_nested(const char *doc, size_t len, size_t step, struct nested_var_list *out,
+                             struct autojson_error *err)
+{
+    struct nested_var_list_parser parser;
+    unsigned seed = 1;
+
+    nested_var_list_parser_init(&parser);
+    for (size_t offset = 0; offset < len;) {
+        size_t n = step ? step : 1 + (seed = seed * 1103515245 + 12345) / 65536 % 13;
+        n = n < len - offset ? n : len - offset;
+
+        /* A buffer per chunk, gone once it is fed like a reused socket buffer */
+        char *chunk = malloc(n);
+        memcpy(chunk, doc + offset, n);
+        int rc = nested_var_list_parser_feed(&parser, chunk, n);
+        free(chunk);
+        if (0 != rc) {
+            break;
+        }
+
+        offset += n;
+    }
+
+    return nested_var_list_parser_finish(&parser, out, err);
+}
+
+void push_parser(void)
+{
+    const char *doc = "{\"s\": [{\"i\": 7, \"unknown\": [{\"x\": null}, 1.5e3, true],"
+                      "          \"s\": [{\"a\": -1, \"e\": 1, \"l\": 17592186044416, \"str\\u0069ng\": \"tab\\t\\u00e9\"},"
+                      "                  {\"a\": 2, \"e\": 0, \"l\": 3, \"string\": \"\"}]},"
+                      "        {\"s\": [], \"i\": 8}],"
+                      " \"a\": 100}\n";
+    struct nested_var_list expected, parsed;
+    struct autojson_buf expected_json = AUTOJSON_BUF_INIT, parsed_json = AUTOJSON_BUF_INIT;
+    struct autojson_error err;
+    size_t steps[] = {1, 2, 7, 0, strlen(doc)};
+
+    CU_ASSERT(0 == nested_var_list_parse_json(doc, strlen(doc), &expected, &err));
+    CU_ASSERT(0 == nested_var_list_write_json(&expected, &expected_json));
+    for (size_t i = 0; i < ARRAY_LENGTH(steps); i++) {
+        CU_ASSERT(0 == push_parse_nested(doc, strlen(doc), steps[i], &parsed, &err));
+        CU_ASSERT(0 == strcmp("tab\t\xc3\xa9", parsed.s[0]->s[0]->string));
+        CU_ASSERT(NULL == parsed.s[2]);
+        parsed_json.len = 0;
+        CU_ASSERT(0 == nested_var_list_write_json(&parsed, &parsed_json));
+        CU_ASSERT(expected_json.len == parsed_json.len);
+        CU_ASSERT(0 == memcmp(expected_json.data, parsed_json.data, expected_json.len));
+        nested_var_list_free(&parsed);
+    }
+
+    autojson_buf_fini(&expected_json);
+    autojson_buf_fini(&parsed_json);
+    nested_var_list_free(&expected);
+
+    /* Input that stops anywhere before the final '}' fails, with everything parsed so far released */
+    for (size_t len = 0; len < strlen(doc) - 1; len++) {
+        CU_ASSERT(0 != push_parse_nested(doc, len, 0, &parsed, &err));
+        CU_ASSERT(NULL == parsed.s);
+        CU_ASSERT(0 == strcmp("unexpected end of input", err.text));
+        CU_ASSERT(len == err.position);
+    }
+
+    /* Positions and lines count from the start of the whole input */
+    const char *bad = "{\"a\": 1,\n \"s\": [{\"i\": 1, \"s\": [{\"a\": 1, \"e\": x}]}]}";
+    CU_ASSERT(0 != push_parse_nested(bad, strlen(bad), 3, &parsed, &err));
+    CU_ASSERT(strchr(bad, 'x') - bad == err.position);
+    CU_ASSERT(2 == err.line);
+    CU_ASSERT(NULL == parsed.s);
+
+    const char *errors[][2] = {
+        {"{\"a\": 1, \"s\": [{\"i\": 1, \"s\": []}, {\"i\": \"two\", \"s\": []}]}", "integer expected"},
+        {"{\"a\": 1, \"s\": [{\"i\": 1, \"s\": [{\"a\": 1, \"e\": 0, \"l\": 2, \"string\": 3}]}]}", "string expected"},
+        {"{\"a\": 1, \"a\": 2, \"s\": []}", "duplicate key"},
+        {"{\"a\": 1, \"s\": [{\"i\": 1}]}", "missing key"},
+        {"{\"a\": 1, \"s\": {}}", "'[' expected"},
+        {"{\"a\": 1, \"s\": []} {}", "end of input expected"},
+        {"{\"a\": 1 \"s\": []}", "',' or '}' expected"},
+        {"[]", "'{' expected"},
+    };
+    for (size_t i = 0; i < ARRAY_LENGTH(errors); i++) {
+        CU_ASSERT(0 != push_parse_nested(errors[i][0], strlen(errors[i][0]), 0, &parsed, &err));
+        CU_ASSERT(0 == strcmp(errors[i][1], err.text));
+        CU_ASSERT(NULL == parsed.s);
+    }
+
+    /* Counted arrays, a byte at a time */
+    struct var_string items[] = {{.a = 1, .s = "one"}, {.a = 2, .s = "two"}, {.a = 3, .s = "three"}};
+    long long ids[] = {-LONG_NUM, 0, 42, LONG_NUM, 5};
+    struct batch b = {.items = items, .n_items = ARRAY_LENGTH(items), .ids = ids, .n_ids = ARRAY_LENGTH(ids), .tag = 9};
+    struct batch batch;
+    struct batch_parser parser;
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+
+    CU_ASSERT(0 == batch_write_json(&b, &buf));
+    batch_parser_init(&parser);
+    for (size_t i = 0; i < buf.len; i++) {
+        CU_ASSERT(0 == batch_parser_feed(&parser, &buf.data[i], 1));
+    }
+
+    CU_ASSERT(0 == batch_parser_finish(&parser, &batch, &err));
+    CU_ASSERT(batch_equal(&b, &batch));
+    batch_free(&batch);
+    autojson_buf_fini(&buf);
+
+    const char *bad_batch = "{\"items\": [{\"a\": 1, \"s\": \"x\"}, {\"a\": 2, \"s\": 2}], \"ids\": [], \"tag\": 0}";
+    batch_parser_init(&parser);
+    CU_ASSERT(0 != batch_parser_feed(&parser, bad_batch, strlen(bad_batch)));
+    CU_ASSERT(0 != batch_parser_feed(&parser, "", 0));
+    CU_ASSERT(0 != batch_parser_finish(&parser, &batch, &err));
+    CU_ASSERT(0 == strcmp("string expected", err.text));
+    CU_ASSERT(NULL == batch.items);
+    CU_ASSERT(0 == batch.n_items);
+}
+
+void trusted_strings(void)
+{
+    struct audit_entry e = {.who = {.name = "root", .alias = "admin"}, .action = "login", .message = "ok"};
+    struct audit_entry parsed;
+
+    json_t *json = audit_entry_to_json(&e);
+    CU_ASSERT(0 == audit_entry_from_json(json, &parsed));
+    CU_ASSERT(audit_entry_equal(&e, &parsed));
+    audit_entry_free(&parsed);
+    json_decref(json);
+
+    /* Checked strings that aren't UTF-8 are left out, trusted ones are taken as they are */
+    e.action = "\xff";
+    e.message = "\xff";
+    json = audit_entry_to_json(&e);
+    CU_ASSERT(0 == strcmp("\xff", json_string_value(json_object_get(json, "action"))));
+    CU_ASSERT(NULL == json_object_get(json, "message"));
+    json_decref(json);
+}
+
+/* Resident set size in pages, from /proc/self/statm */
+static long resident_pages(void)
+{
+    long size, resident = -1;
+    FILE *statm = fopen("/proc/self/statm", "r");
+    if (NULL != statm) {
+        if (2 != fscanf(statm, "%ld %ld", &size, &resident)) {
+            resident = -1;
+        }
+
+        fclose(statm);
+    }
+
+    return resident;
+}
+
+void serializer_rss(void)
+{
+    struct nested_fixture fixture;
+    build_nested_fixture(&fixture);
+
+    /* Once the allocator has warmed up, serializing and releasing again and again uses no more memory */
+    long before = 0;
+    for (int i = 0; i < 200000; i++) {
+        if (1000 == i) {
+            before = resident_pages();
+        }
+
+        json_t *json = nested_var_list_to_json(&fixture.nested);
+        json_decref(json);
+    }
+
+#ifndef __SANITIZE_ADDRESS__
+    /* Leaking even the smallest json_t per call would take thousands of pages; ASan's quarantine grows instead */
+    CU_ASSERT(resident_pages() - before < 64);
+#endif
+}
+
+void field_index(void)
+{
+    CU_ASSERT(SCALARS_FIELD_string == scalars_field_index("string", 6));
+    CU_ASSERT(SCALARS_FIELD_l == scalars_field_index("l", 1));
+    CU_ASSERT(-1 == scalars_field_index("strinG", 6));
+    CU_ASSERT(-1 == scalars_field_index("s", 1));
+    CU_ASSERT(-1 == scalars_field_index("", 0));
+    CU_ASSERT(4 == SCALARS_FIELDS);
 }
 
 void register_tests(CU_pSuite suite)
@@ -152,6 +1246,26 @@ void register_tests(CU_pSuite suite)
     ADD_TEST("var_lists", var_lists);
     ADD_TEST("var_string", var_string);
     ADD_TEST("nested_var_list", nested_var_list);
+    ADD_TEST("direct_writer", direct_writer);
+    ADD_TEST("stream_parser", stream_parser);
+    ADD_TEST("field_index", field_index);
+    ADD_TEST("msgpack", msgpack);
+    ADD_TEST("json_size", json_size);
+    ADD_TEST("json_lines", json_lines);
+    ADD_TEST("fixed_arrays", fixed_arrays);
+    ADD_TEST("borrowed_strings", borrowed_strings);
+    ADD_TEST("diff_and_patch", diff_and_patch);
+    ADD_TEST("parallel_writer", parallel_writer);
+    ADD_TEST("projection", projection);
+    ADD_TEST("reuse_parser", reuse_parser);
+    ADD_TEST("reuse_capacity", reuse_capacity);
+    ADD_TEST("counted_arrays", counted_arrays);
+    ADD_TEST("push_parser", push_parser);
+    ADD_TEST("trusted_strings", trusted_strings);
+    ADD_TEST("serializer_rss", serializer_rss);
+#ifdef AUTOJSON_STATS
+    ADD_TEST("stats", stats);
+#endif
 }
 
 int main(int argc, char **argv)
@@ -0,0 +1,138 @@
+#include "test_header_arena_auto.h"
+#include "CUnit/Basic.h"
+#include "CUnit/Console.h"
+#include "CUnit/Automated.h"
+#include "CUnit/CUCurses.h"
+#include <assert.h>
+#include <string.h>
+
+#define ADD_TEST(name, func) assert(NULL != CU_add_test(suite, name, func))
+
+int init_suite_success(void) { return 0; }
+int clean_suite_success(void) { return 0; }
+
+static void register_suite(CU_pSuite *suite, const char *name)
+{
+    (*suite) = CU_add_suite(name, init_suite_success, clean_suite_success);
+    assert(NULL != *suite);
+}
+
+static const char nested_doc[] =
+    "{\"a\": 100, \"s\": [{\"i\": 1, \"s\": [{\"a\": 5, \"e\": 1, \"l\": 7, \"string\": \"first\"},"
+    "                                      {\"a\": 6, \"e\": 0, \"l\": 8, \"string\": \"second\"}]},"
+    "                    {\"i\": 2, \"s\": []}]}";
+
+static void check_nested(const struct nested_var_list *nested)
+{
+    CU_ASSERT(100 == nested->a);
+    CU_ASSERT(1 == nested->s[0]->i);
+    CU_ASSERT(5 == nested->s[0]->s[0]->a);
+    CU_ASSERT(8 == nested->s[0]->s[1]->l);
+    CU_ASSERT(0 == strcmp("second", nested->s[0]->s[1]->string));
+    CU_ASSERT(NULL == nested->s[0]->s[2]);
+    CU_ASSERT(2 == nested->s[1]->i);
+    CU_ASSERT(NULL == nested->s[1]->s[0]);
+    CU_ASSERT(NULL == nested->s[2]);
+}
+
+void arena_from_json(void)
+{
+    struct autojson_arena arena;
+    struct nested_var_list nested;
+    json_t *json = json_loads(nested_doc, 0, NULL);
+
+    autojson_arena_init(&arena, 0);
+    CU_ASSERT(0 == nested_var_list_from_json(json, &nested, &arena));
+    check_nested(&nested);
+    nested_var_list_free(&nested);
+
+    /* Resetting hands the same memory out again */
+    struct var_list **first = nested.s;
+    autojson_arena_reset(&arena);
+    CU_ASSERT(0 == nested_var_list_from_json(json, &nested, &arena));
+    CU_ASSERT(first == nested.s);
+    check_nested(&nested);
+
+    autojson_arena_fini(&arena);
+    json_decref(json);
+}
+
+void arena_parse_json(void)
+{
+    struct autojson_arena arena;
+    struct nested_var_list nested;
+    struct var_string v;
+    const char *var_doc = "{\"a\": 1, \"s\": \"a string long enough to outgrow a tiny block\"}";
+
+    /* Small blocks force the arena to chain several of them */
+    autojson_arena_init(&arena, 64);
+    CU_ASSERT(0 == nested_var_list_parse_json(nested_doc, strlen(nested_doc), &nested, &arena, NULL));
+    check_nested(&nested);
+    CU_ASSERT(0 == var_string_parse_json(var_doc, strlen(var_doc), &v, &arena, NULL));
+    CU_ASSERT(0 == strcmp("a string long enough to outgrow a tiny block", v.s));
+    var_string_free(&v);
+
+    autojson_arena_reset(&arena);
+    CU_ASSERT(0 == nested_var_list_parse_json(nested_doc, strlen(nested_doc), &nested, &arena, NULL));
+    check_nested(&nested);
+    autojson_arena_fini(&arena);
+}
+
+void arena_from_msgpack(void)
+{
+    struct autojson_arena arena;
+    struct autojson_buf buf = AUTOJSON_BUF_INIT;
+    struct nested_var_list nested;
+
+    autojson_arena_init(&arena, 64);
+    CU_ASSERT(0 == nested_var_list_parse_json(nested_doc, strlen(nested_doc), &nested, &arena, NULL));
+    CU_ASSERT(0 == nested_var_list_to_msgpack(&nested, &buf));
+
+    autojson_arena_reset(&arena);
+    CU_ASSERT(0 == nested_var_list_from_msgpack(buf.data, buf.len, &nested, &arena, NULL));
+    check_nested(&nested);
+    autojson_arena_fini(&arena);
+    autojson_buf_fini(&buf);
+}
+
+void arena_borrowed(void)
+{
+    struct autojson_arena arena;
+    struct borrowed b;
+    const char *plain = "{\"name\": \"plain\", \"id\": 1}";
+    const char *escaped = "{\"name\": \"tab\\there\", \"id\": 2}";
+
+    /* Plain strings still point into the input, escaped ones are decoded into the arena */
+    autojson_arena_init(&arena, 0);
+    CU_ASSERT(0 == borrowed_parse_json(plain, strlen(plain), &b, &arena, NULL));
+    CU_ASSERT(plain + 10 == b.name);
+    CU_ASSERT(5 == b.name_len);
+    CU_ASSERT(0 == borrowed_parse_json(escaped, strlen(escaped), &b, &arena, NULL));
+    CU_ASSERT(8 == b.name_len);
+    CU_ASSERT(0 == memcmp("tab\there", b.name, b.name_len));
+    autojson_arena_fini(&arena);
+}
+
+void register_tests(CU_pSuite suite)
+{
+    ADD_TEST("arena_from_json", arena_from_json);
+    ADD_TEST("arena_parse_json", arena_parse_json);
+    ADD_TEST("arena_from_msgpack", arena_from_msgpack);
+    ADD_TEST("arena_borrowed", arena_borrowed);
+}
+
+int main(int argc, char **argv)
+{
+    if (CUE_SUCCESS != CU_initialize_registry())
+      return CU_get_error();
+
+    CU_pSuite suite = NULL;
+    register_suite(&suite, "arena");
+    register_tests(suite);
+
+   CU_basic_set_mode(CU_BRM_VERBOSE);
+   CU_basic_run_tests();
+   printf("\n");
+   CU_basic_show_failures(CU_get_failure_list());
+   printf("\n\n");
+}
@@ -1,5 +1,6 @@
 #pragma once
 
+#include <stddef.h>
 #include "../autojson.h"
 
 enum some_enum {
@@ -32,3 +33,95 @@ struct nested_var_list {
     int a;
     JSONABLE;
 };
+
+struct samples {
+    int values[4];
+    long long totals[2];
+    enum some_enum kinds[3];
+    struct var_string pair[2];
+    JSONABLE;
+};
+
+/// borrow
+struct borrowed {
+    const char *name; ///< len=name_len
+    size_t name_len;
+    int id;
+    JSONABLE;
+};
+
+struct borrowed_view {
+    char *kept;
+    const char *view; ///< borrow len=view_len
+    size_t view_len;
+    JSONABLE;
+};
+
+struct envelope {
+    int id;
+    struct var_string body;
+    struct var_list **history;
+    JSONABLE;
+};
+
+struct batch {
+    struct var_string *items; ///< count=n_items
+    size_t n_items;
+    long long *ids; ///< count=n_ids
+    size_t n_ids;
+    int tag;
+    JSONABLE;
+};
+
+/* More members than a projection mask has bits */
+struct wide {
+    int f0, f1, f2, f3, f4, f5, f6, f7, f8, f9;
+    int f10, f11, f12, f13, f14, f15, f16, f17, f18, f19;
+    int f20, f21, f22, f23, f24, f25, f26, f27, f28, f29;
+    int f30, f31, f32, f33, f34, f35, f36, f37, f38, f39;
+    int f40, f41, f42, f43, f44, f45, f46, f47, f48, f49;
+    int f50, f51, f52, f53, f54, f55, f56, f57, f58, f59;
+    int f60, f61, f62, f63, f64, f65, f66, f67, f68, f69;
+    JSONABLE;
+};
+
+struct reused_buffers {
+    char *name; ///< cap=name_cap
+    size_t name_cap;
+    struct scalars **list; ///< cap=list_cap
+    size_t list_cap;
+    long long *ids; ///< count=n_ids cap=ids_cap
+    size_t n_ids;
+    size_t ids_cap;
+    JSONABLE;
+};
+
+struct sample_point {
+    int id;
+    long long readings[3];
+    enum some_enum kinds[2];
+    char label[6];
+    JSONABLE;
+};
+
+struct sample_frame {
+    struct sample_point points[2];
+    struct scalars origin;
+    int flags; ///< noserialize
+    long t;
+    JSONABLE;
+};
+
+/// trusted
+struct trusted_names {
+    char name[8];
+    char *alias;
+    JSONABLE;
+};
+
+struct audit_entry {
+    struct trusted_names who;
+    char *action; ///< trusted
+    char *message;
+    JSONABLE;
+};
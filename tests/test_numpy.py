@@ -0,0 +1,73 @@
+"""Checks the --numpy-module bindings of test_header.h against the C writers.
+
+Records are laid out through the generated dtypes, written to JSON lines
+by the C <struct>_write_json_lines() of libtest_header_auto.so and by the
+generated Python <struct>_to_json_lines(), and the two must be the same
+bytes. Run with `make test-numpy`.
+"""
+
+import ctypes
+import os
+import sys
+
+import numpy as np
+
+tests = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [tests, os.path.dirname(tests)]
+import test_header_numpy_auto as auto
+
+class AutojsonBuf(ctypes.Structure):
+    _fields_ = [('data', ctypes.c_void_p), ('len', ctypes.c_size_t), ('cap', ctypes.c_size_t),
+                ('owned', ctypes.c_int), ('error', ctypes.c_int)]
+
+lib = ctypes.CDLL(os.path.join(tests, 'libtest_header_auto.so'))
+
+def c_json_lines(struct, records):
+    buf = AutojsonBuf(None, 0, 0, 1, 0)
+    write = getattr(lib, '{0}_write_json_lines'.format(struct))
+    assert 0 == write(ctypes.c_void_p(records.ctypes.data), ctypes.c_size_t(len(records)), ctypes.byref(buf))
+    lines = ctypes.string_at(buf.data, buf.len)
+    lib.autojson_buf_fini(ctypes.byref(buf))
+    return lines
+
+def check(struct, records):
+    expected = c_json_lines(struct, records)
+    assert expected == getattr(auto, '{0}_to_json_lines'.format(struct))(records.tobytes()), struct
+    return expected
+
+def test_scalars():
+    strings = [b'', b'plain', b'quote " backslash \\ tab \t control \x01\x1f', b'\xc3\xa9 utf-8',
+               b'x' * 499, b'cut\x00after']
+    records = np.zeros(len(strings) * 100, dtype = auto.SCALARS_DTYPE)
+    records['a'] = np.arange(len(records)) - 300
+    records['e'] = np.arange(len(records)) % 2
+    records['l'] = (np.arange(len(records)) - 50) * (1 << 44)
+    records['string'] = strings * 100
+    lines = check('scalars', records).splitlines()
+    assert b'{"a":-298,"e":0,"string":"quote \\" backslash \\\\ tab \\t control \\u0001\\u001F","l":-844424930131968}' == lines[2]
+    assert b'"string":"cut"' in lines[5]
+    check('scalars', records[:0])
+
+def test_nested():
+    frames = np.zeros(1000, dtype = auto.SAMPLE_FRAME_DTYPE)
+    frames['t'] = np.arange(1000) * -(1 << 40)
+    frames['points']['id'] = np.arange(2000).reshape(1000, 2)
+    frames['points']['readings'] = np.arange(6000).reshape(1000, 2, 3) - 3000
+    frames['points']['kinds'][:, 1] = 1
+    frames['points']['label'] = b'label'
+    frames['origin']['string'] = b'origin'
+
+    # flags is not serialized, and was never declared to numpy either
+    assert 'flags' not in auto.SAMPLE_FRAME_DTYPE.names
+    check('sample_frame', frames)
+    check('sample_point', frames['points'].reshape(-1).copy())
+
+def test_no_fixed_layout():
+    assert not hasattr(auto, 'VAR_LIST_DTYPE')
+    assert not hasattr(auto, 'var_list_to_json_lines')
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('{0}: ok'.format(name))
@@ -0,0 +1,147 @@
+#include "test_header_tables_auto.h"
+#include "CUnit/Basic.h"
+#include "CUnit/Console.h"
+#include "CUnit/Automated.h"
+#include "CUnit/CUCurses.h"
+#include <assert.h>
+#include <string.h>
+
+#define ADD_TEST(name, func) assert(NULL != CU_add_test(suite, name, func))
+
+int init_suite_success(void) { return 0; }
+int clean_suite_success(void) { return 0; }
+
+static void register_suite(CU_pSuite *suite, const char *name)
+{
+    (*suite) = CU_add_suite(name, init_suite_success, clean_suite_success);
+    assert(NULL != *suite);
+}
+
+static const char nested_doc[] =
+    "{\"a\": 100, \"s\": [{\"i\": 1, \"s\": [{\"a\": 5, \"e\": 1, \"l\": 7, \"string\": \"first\"},"
+    "                                      {\"a\": 6, \"e\": 0, \"l\": 8, \"string\": \"second\"}]},"
+    "                    {\"i\": 2, \"s\": []}]}";
+
+void tables_from_json(void)
+{
+    struct nested_var_list nested;
+    json_t *json = json_loads(nested_doc, 0, NULL);
+
+    CU_ASSERT(0 == nested_var_list_from_json(json, &nested));
+    CU_ASSERT(100 == nested.a);
+    CU_ASSERT(1 == nested.s[0]->i);
+    CU_ASSERT(5 == nested.s[0]->s[0]->a);
+    CU_ASSERT(8 == nested.s[0]->s[1]->l);
+    CU_ASSERT(0 == strcmp("second", nested.s[0]->s[1]->string));
+    CU_ASSERT(NULL == nested.s[0]->s[2]);
+    CU_ASSERT(2 == nested.s[1]->i);
+    CU_ASSERT(NULL == nested.s[1]->s[0]);
+    CU_ASSERT(NULL == nested.s[2]);
+    nested_var_list_free(&nested);
+    json_decref(json);
+}
+
+void tables_round_trip(void)
+{
+    struct samples s = {.values = {1, -2, 3, -4}, .totals = {1LL << 40, -(1LL << 41)},
+                        .kinds = {ENUM_VAL_2, ENUM_VAL_1, ENUM_VAL_2},
+                        .pair = {{.a = 1, .s = "one"}, {.a = 2, .s = "two"}}};
+    struct samples parsed;
+
+    json_t *json = samples_to_json(&s);
+    CU_ASSERT(0 == samples_from_json(json, &parsed));
+    CU_ASSERT(samples_equal(&s, &parsed));
+    CU_ASSERT(-(1LL << 41) == parsed.totals[1]);
+    CU_ASSERT(ENUM_VAL_2 == parsed.kinds[2]);
+    CU_ASSERT(0 == strcmp("two", parsed.pair[1].s));
+
+    parsed.values[3]++;
+    CU_ASSERT(!samples_equal(&s, &parsed));
+    samples_free(&parsed);
+    json_decref(json);
+}
+
+void tables_errors(void)
+{
+    struct nested_var_list nested;
+    const char *docs[] = {
+        "[]",
+        "{\"a\": 1}",
+        "{\"a\": 1, \"s\": [{\"i\": 1, \"s\": [{\"a\": 5, \"e\": 1, \"l\": 7, \"string\": 3}]}]}",
+        "{\"a\": 1, \"s\": [{\"i\": 1, \"s\": []}, {\"i\": \"two\", \"s\": []}]}",
+    };
+
+    /* Failures release everything parsed so far and leave the structure zeroed */
+    for (size_t i = 0; i < sizeof(docs) / sizeof(docs[0]); i++) {
+        json_t *json = json_loads(docs[i], 0, NULL);
+        CU_ASSERT(0 != nested_var_list_from_json(json, &nested));
+        CU_ASSERT(NULL == nested.s);
+        CU_ASSERT(0 == nested.a);
+        json_decref(json);
+    }
+}
+
+void tables_borrowed(void)
+{
+    struct borrowed b = {.name = "truncated", .name_len = 5, .id = 3};
+    struct borrowed parsed;
+
+    json_t *json = borrowed_to_json(&b);
+    CU_ASSERT(0 == borrowed_from_json(json, &parsed));
+    CU_ASSERT(json_string_value(json_object_get(json, "name")) == parsed.name);
+    CU_ASSERT(5 == parsed.name_len);
+    CU_ASSERT(0 == memcmp("trunc", parsed.name, 5));
+    CU_ASSERT(borrowed_equal(&b, &parsed));
+    borrowed_free(&parsed);
+    json_decref(json);
+}
+
+void tables_counted(void)
+{
+    struct var_string items[] = {{.a = 1, .s = "one"}, {.a = 2, .s = "two"}};
+    long long ids[] = {1LL << 40, -3};
+    struct batch b = {.items = items, .n_items = 2, .ids = ids, .n_ids = 2, .tag = 4};
+    struct batch parsed;
+
+    json_t *json = batch_to_json(&b);
+    CU_ASSERT(0 == batch_from_json(json, &parsed));
+    CU_ASSERT(2 == parsed.n_items);
+    CU_ASSERT(0 == strcmp("two", parsed.items[1].s));
+    CU_ASSERT(-3 == parsed.ids[1]);
+    CU_ASSERT(batch_equal(&b, &parsed));
+    parsed.n_ids--;
+    CU_ASSERT(!batch_equal(&b, &parsed));
+    batch_free(&parsed);
+    json_decref(json);
+
+    json = json_loads("{\"items\": [], \"ids\": [1, \"x\"], \"tag\": 0}", 0, NULL);
+    CU_ASSERT(0 != batch_from_json(json, &parsed));
+    CU_ASSERT(NULL == parsed.ids);
+    CU_ASSERT(0 == parsed.n_ids);
+    json_decref(json);
+}
+
+void register_tests(CU_pSuite suite)
+{
+    ADD_TEST("tables_from_json", tables_from_json);
+    ADD_TEST("tables_round_trip", tables_round_trip);
+    ADD_TEST("tables_errors", tables_errors);
+    ADD_TEST("tables_borrowed", tables_borrowed);
+    ADD_TEST("tables_counted", tables_counted);
+}
+
+int main(int argc, char **argv)
+{
+    if (CUE_SUCCESS != CU_initialize_registry())
+      return CU_get_error();
+
+    CU_pSuite suite = NULL;
+    register_suite(&suite, "tables");
+    register_tests(suite);
+
+   CU_basic_set_mode(CU_BRM_VERBOSE);
+   CU_basic_run_tests();
+   printf("\n");
+   CU_basic_show_failures(CU_get_failure_list());
+   printf("\n\n");
+}